@@ -0,0 +1,343 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import deque
+from collections.abc import AsyncIterator, Awaitable, Callable, Iterator
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, fields
+from typing import TypeVar
+
+import httpx
+
+from api.language_model import LanguageModelAPI
+from data.base_classes import GenerationLLMResponse
+from utils.logger import get_pylogger
+from utils.metrics import LLM_BACKEND_REQUESTS
+
+log = get_pylogger(__name__)
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_OPEN_SECONDS = 30
+DEFAULT_HEALTH_PATH = "/health"
+DEFAULT_HEALTH_INTERVAL = 10
+DEFAULT_HEALTH_TIMEOUT = 5
+# hedge delay is p95 of the last generations, it is not trusted until enough were measured
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 200
+# hedges are limited to share of generations, so slow nodes under load do not double it
+HEDGE_MAX_SHARE = 0.1
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+T = TypeVar("T")
+
+
+def is_backend_failure(exception: Exception) -> bool:
+    r"""Return whether error means backend is down or overloaded, not that request is bad."""
+    if isinstance(exception, httpx.HTTPStatusError):
+        return exception.response.status_code >= 500
+    return isinstance(exception, httpx.TransportError)
+
+
+def is_retryable(exception: Exception) -> bool:
+    r"""Return whether request surely was not generated, so it can be sent to another backend."""
+    if isinstance(exception, httpx.HTTPStatusError):
+        return exception.response.status_code in {502, 503, 504}
+    return isinstance(exception, (httpx.ConnectError, httpx.ConnectTimeout))
+
+
+@dataclass
+class Backend:
+    """State of one LLM api node."""
+
+    api: LanguageModelAPI
+    outstanding: int = 0
+    healthy: bool = True
+    state: str = CLOSED
+    failures: int = 0
+    open_until: float = 0.0
+    requests: int = 0
+    errors: int = 0
+
+    @property
+    def address(self) -> str:
+        """Return base url of backend."""
+        return str(self.api.base_api_path)
+
+    def available(self, now: float) -> bool:
+        """Return whether backend can get a request, open circuit lets one trial request after
+        cooldown"""
+        if not self.healthy:
+            return False
+        if self.state == OPEN:
+            return now >= self.open_until
+        return self.state == CLOSED
+
+    def as_dict(self) -> dict:
+        """Return state without api client."""
+        return {
+            "address": self.address,
+            **{field.name: getattr(self, field.name) for field in fields(self)[1:]},
+        }
+
+
+@dataclass
+class BalancerMetrics:
+    """Counters of requests routed between LLM api nodes."""
+
+    retries: int = 0
+    generations: int = 0
+    hedged: int = 0
+    hedge_wins: int = 0
+    circuit_opens: int = 0
+
+    def as_dict(self) -> dict:
+        """Return counters."""
+        return asdict(self)
+
+
+class BalancedLanguageModelAPI:
+    """Class sends every request to LLM api node with the fewest outstanding requests.
+
+    Nodes failing health check are skipped, nodes failing failure_threshold requests in a row are
+    skipped for open_seconds and then get one trial request. With hedge, generation slower than
+    p95 of recent ones is sent to a second node too and the first answer is returned.
+    """
+
+    def __init__(
+        self,
+        apis: list[LanguageModelAPI],
+        failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+        open_seconds: float = DEFAULT_OPEN_SECONDS,
+        health_path: str = DEFAULT_HEALTH_PATH,
+        health_interval: float = DEFAULT_HEALTH_INTERVAL,
+        health_timeout: float = DEFAULT_HEALTH_TIMEOUT,
+        hedge: bool = False,
+    ):
+        self.backends = [Backend(api) for api in apis]
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.health_path = health_path
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.hedge = hedge
+        self.metrics = BalancerMetrics()
+        self._latencies: deque[float] = deque(maxlen=HEDGE_WINDOW)
+        self._next = 0
+        # health checks are started inside running event loop on first call
+        self._worker: asyncio.Task | None = None
+
+    def stats(self) -> dict:
+        """Return counters with state of every backend."""
+        return {
+            **self.metrics.as_dict(),
+            "hedge_delay_seconds": self.hedge_delay(),
+            "backends": [backend.as_dict() for backend in self.backends],
+        }
+
+    def hedge_delay(self) -> float | None:
+        """Return p95 of recent generation times or None while too few were measured."""
+        if len(self._latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+    async def generate(self, text: str) -> GenerationLLMResponse:
+        """Function will call the least loaded LLM api node and return answer for user text
+        Args:
+            text: user question with context
+        """
+        self.metrics.generations += 1
+        return await self._request(lambda api: api.generate(text), hedge=self.hedge)
+
+    async def generate_batch(self, texts: list[str]) -> list[GenerationLLMResponse]:
+        """Function will call batched api of the least loaded node, batches are not hedged
+        Args:
+            texts: user questions with context
+        """
+        return await self._request(lambda api: api.generate_batch(texts), hedge=False)
+
+    async def generate_stream(self, text: str) -> AsyncIterator[GenerationLLMResponse]:
+        """Function streams answer from the least loaded node, stream is sent to another node
+        only when it failed before the first update
+        Args:
+            text: user question with context
+        """
+        self._start_health_checks()
+        tried: list[Backend] = []
+        while True:
+            backend = self._pick(tried)
+            tried.append(backend)
+            received = False
+            try:
+                with self._track(backend):
+                    async for response in backend.api.generate_stream(text):
+                        received = True
+                        yield response
+                return
+            except Exception as exception:  # pylint: disable=broad-except
+                if received or not self._can_retry(exception, tried):
+                    raise
+                self._log_retry(backend, exception)
+
+    async def aclose(self) -> None:
+        """Stop health checks and close clients of all nodes."""
+        if self._worker is not None:
+            self._worker.cancel()
+        await asyncio.gather(*[backend.api.aclose() for backend in self.backends])
+
+    async def _request(self, call: Callable[[LanguageModelAPI], Awaitable[T]], hedge: bool) -> T:
+        self._start_health_checks()
+        tried: list[Backend] = []
+        while True:
+            backend = self._pick(tried)
+            tried.append(backend)
+            try:
+                if hedge:
+                    return await self._send_hedged(backend, call, tried)
+                return await self._send(backend, call)
+            except Exception as exception:  # pylint: disable=broad-except
+                if not self._can_retry(exception, tried):
+                    raise
+                self._log_retry(backend, exception)
+
+    async def _send(
+        self,
+        backend: Backend,
+        call: Callable[[LanguageModelAPI], Awaitable[T]],
+        measure: bool = False,
+    ) -> T:
+        started_at = time.perf_counter()
+        with self._track(backend):
+            result = await call(backend.api)
+        if measure:
+            self._latencies.append(time.perf_counter() - started_at)
+        return result
+
+    async def _send_hedged(
+        self,
+        backend: Backend,
+        call: Callable[[LanguageModelAPI], Awaitable[T]],
+        tried: list[Backend],
+    ) -> T:
+        delay = self.hedge_delay()
+        tasks = [asyncio.create_task(self._send(backend, call, measure=True))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                hedge = self._start_hedge(call, tried)
+                if hedge is not None:
+                    tasks.append(hedge)
+            return await self._first_success(tasks)
+        finally:
+            # slower node stops generating as soon as its request is closed
+            for task in tasks:
+                task.cancel()
+
+    def _start_hedge(
+        self, call: Callable[[LanguageModelAPI], Awaitable[T]], tried: list[Backend]
+    ) -> asyncio.Task[T] | None:
+        if self.metrics.hedged >= HEDGE_MAX_SHARE * self.metrics.generations:
+            return None
+        second = self._pick(tried, fallback=False)
+        if second is None:
+            return None
+        tried.append(second)
+        self.metrics.hedged += 1
+        return asyncio.create_task(self._send(second, call, measure=True))
+
+    async def _first_success(self, tasks: list[asyncio.Task[T]]) -> T:
+        pending = set(tasks)
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not tasks[0]:
+                        self.metrics.hedge_wins += 1
+                    return task.result()
+                error = task.exception()
+            if not pending:
+                raise error
+
+    def _pick(self, exclude: list[Backend], fallback: bool = True) -> Backend | None:
+        now = time.monotonic()
+        # start from the next node every time, so idle nodes get requests in turn
+        self._next = (self._next + 1) % len(self.backends)
+        backends = self.backends[self._next :] + self.backends[: self._next]
+        backends = [backend for backend in backends if backend not in exclude]
+        candidates = [backend for backend in backends if backend.available(now)]
+        if not candidates:
+            if not fallback or not backends:
+                return None
+            # every node looks down, the least loaded one is tried instead of failing at once
+            candidates = backends
+        backend = min(candidates, key=lambda candidate: candidate.outstanding)
+        if backend.state == OPEN and backend.available(now):
+            backend.state = HALF_OPEN
+        return backend
+
+    @contextmanager
+    def _track(self, backend: Backend) -> Iterator[None]:
+        backend.outstanding += 1
+        backend.requests += 1
+        try:
+            yield
+        except Exception as exception:
+            if is_backend_failure(exception):
+                LLM_BACKEND_REQUESTS.labels(backend.address, "failure").inc()
+                self._record_failure(backend)
+            else:
+                LLM_BACKEND_REQUESTS.labels(backend.address, "error").inc()
+                backend.state = CLOSED
+            raise
+        else:
+            LLM_BACKEND_REQUESTS.labels(backend.address, "success").inc()
+            backend.failures = 0
+            backend.state = CLOSED
+        finally:
+            backend.outstanding -= 1
+            if backend.state == HALF_OPEN:
+                # trial request was cancelled, the next request becomes trial
+                backend.state = OPEN
+
+    def _record_failure(self, backend: Backend) -> None:
+        backend.failures += 1
+        backend.errors += 1
+        if backend.state == HALF_OPEN or backend.failures >= self.failure_threshold:
+            if backend.state != OPEN:
+                self.metrics.circuit_opens += 1
+                log.warning(
+                    "LLM api node %s is skipped for %ss", backend.address, self.open_seconds
+                )
+            backend.state = OPEN
+            backend.open_until = time.monotonic() + self.open_seconds
+
+    def _can_retry(self, exception: Exception, tried: list[Backend]) -> bool:
+        return is_retryable(exception) and len(tried) < len(self.backends)
+
+    def _log_retry(self, backend: Backend, exception: Exception) -> None:
+        self.metrics.retries += 1
+        log.warning("Retry request failed by LLM api node %s: %r", backend.address, exception)
+
+    def _start_health_checks(self) -> None:
+        if self._worker is None and self.health_interval > 0:
+            self._worker = asyncio.create_task(self._check_health_periodically())
+
+    async def _check_health_periodically(self) -> None:
+        while True:
+            results = await asyncio.gather(
+                *[
+                    backend.api.check_health(self.health_path, self.health_timeout)
+                    for backend in self.backends
+                ]
+            )
+            for backend, healthy in zip(self.backends, results):
+                if healthy != backend.healthy:
+                    log.warning(
+                        "LLM api node %s is %s", backend.address, "up" if healthy else "down"
+                    )
+                backend.healthy = healthy
+            await asyncio.sleep(self.health_interval)
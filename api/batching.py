@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections.abc import AsyncIterator
+from dataclasses import asdict, dataclass
+
+from api.balancer import BalancedLanguageModelAPI
+from api.language_model import LanguageModelAPI
+from data.base_classes import GenerationLLMResponse
+from utils.logger import get_pylogger
+from utils.metrics import LLM_BATCH_FILL_RATE, LLM_BATCH_QUEUE_DELAY_SECONDS
+
+log = get_pylogger(__name__)
+
+DEFAULT_MAX_BATCH_SIZE = 8
+DEFAULT_MAX_WAIT_MS = 10
+
+
+@dataclass
+class BatchingMetrics:
+    """Counters of batches sent to LLM api."""
+
+    batches: int = 0
+    prompts: int = 0
+    queue_delay_seconds_total: float = 0.0
+    queue_delay_seconds_max: float = 0.0
+    max_batch_size: int = DEFAULT_MAX_BATCH_SIZE
+
+    @property
+    def fill_rate(self) -> float:
+        """Return average share of batch slots filled by prompts."""
+        if not self.batches:
+            return 0.0
+        return self.prompts / (self.batches * self.max_batch_size)
+
+    @property
+    def queue_delay_seconds_avg(self) -> float:
+        """Return average time prompt waited for its batch to be sent."""
+        if not self.prompts:
+            return 0.0
+        return self.queue_delay_seconds_total / self.prompts
+
+    def as_dict(self) -> dict:
+        """Return counters with derived metrics."""
+        return {
+            **asdict(self),
+            "fill_rate": self.fill_rate,
+            "queue_delay_seconds_avg": self.queue_delay_seconds_avg,
+        }
+
+
+@dataclass
+class _PendingPrompt:
+    text: str
+    future: asyncio.Future
+    enqueued_at: float
+
+
+class BatchingLanguageModelAPI:
+    """Class collects concurrent generate calls and sends them to LLM api as one batch."""
+
+    def __init__(
+        self,
+        api: LanguageModelAPI | BalancedLanguageModelAPI,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        max_wait_ms: float = DEFAULT_MAX_WAIT_MS,
+    ):
+        self.api = api
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.metrics = BatchingMetrics(max_batch_size=max_batch_size)
+        # queue and worker are created inside running event loop on first call
+        self._queue: asyncio.Queue[_PendingPrompt] | None = None
+        self._worker: asyncio.Task | None = None
+        self._requests: set[asyncio.Task] = set()
+
+    async def generate(self, text: str) -> GenerationLLMResponse:
+        """Function waits for batch with user text to be generated and returns its answer
+        Args:
+            text: user question with context
+        """
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._collect_batches())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_PendingPrompt(text, future, time.perf_counter()))
+        return await future
+
+    async def generate_batch(self, texts: list[str]) -> list[GenerationLLMResponse]:
+        """Function sends already collected texts as one batch
+        Args:
+            texts: user questions with context
+        """
+        return await self.api.generate_batch(texts)
+
+    def generate_stream(self, text: str) -> AsyncIterator[GenerationLLMResponse]:
+        """Function streams answer for user text, streams are never batched
+        Args:
+            text: user question with context
+        """
+        return self.api.generate_stream(text)
+
+    async def aclose(self) -> None:
+        """Stop collecting batches and close LLM api client."""
+        if self._worker is not None:
+            self._worker.cancel()
+        await self.api.aclose()
+
+    async def _collect_batches(self) -> None:
+        queue = self._queue
+        while True:
+            batch = [await queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # batch is sent in background, so the next one is collected while it is generated
+            request = asyncio.create_task(self._send_batch(batch))
+            self._requests.add(request)
+            request.add_done_callback(self._requests.discard)
+
+    async def _send_batch(self, batch: list[_PendingPrompt]) -> None:
+        sent_at = time.perf_counter()
+        for pending in batch:
+            delay = sent_at - pending.enqueued_at
+            self.metrics.queue_delay_seconds_total += delay
+            self.metrics.queue_delay_seconds_max = max(self.metrics.queue_delay_seconds_max, delay)
+            LLM_BATCH_QUEUE_DELAY_SECONDS.observe(delay)
+        LLM_BATCH_FILL_RATE.observe(len(batch) / self.max_batch_size)
+        self.metrics.batches += 1
+        self.metrics.prompts += len(batch)
+        log.debug("Send batch of %s prompts to LLM api", len(batch))
+
+        try:
+            responses = await self.api.generate_batch([pending.text for pending in batch])
+            if len(responses) != len(batch):
+                raise ValueError(f"LLM api returned {len(responses)} answers for {len(batch)}")
+        except Exception as exception:  # pylint: disable=broad-except
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(exception)
+            return
+
+        # callers which were cancelled while waiting do not get their answer
+        for pending, response in zip(batch, responses):
+            if not pending.future.done():
+                pending.future.set_result(response)
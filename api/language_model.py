@@ -1,19 +1,80 @@
-import requests
+from __future__ import annotations
+
+import json
+from collections.abc import AsyncIterator
+
+import httpx
 
 from data.base_classes import GenerationLLMResponse
 
+DEFAULT_TIMEOUT = 180
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_MAX_CONNECTIONS = 100
+
 
 class LanguageModelAPI:
     """Class contains methods to work with LLM generation api."""
 
-    def __init__(self, base_api_path):
+    def __init__(
+        self,
+        base_api_path,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+        timeout: float = DEFAULT_TIMEOUT,
+        connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+    ):
         self.base_api_path = base_api_path
+        # keep-alive connections are reused by all requests, at most max_connections are open
+        self.client = httpx.AsyncClient(
+            base_url=base_api_path,
+            limits=httpx.Limits(
+                max_connections=max_connections, max_keepalive_connections=max_connections
+            ),
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+        )
 
-    def generate(self, text: str) -> GenerationLLMResponse:
+    async def generate(self, text: str) -> GenerationLLMResponse:
         """Function will call LLM api and return answer for user text
         Args:
             text: user question with context
         """
-        path = f"{self.base_api_path}/generate"
-        answer = requests.post(url=path, json={"text": text}, timeout=180).json()
-        return GenerationLLMResponse(**answer)
+        response = await self.client.post("/generate", json={"text": text})
+        response.raise_for_status()
+        return GenerationLLMResponse(**response.json())
+
+    async def generate_batch(self, texts: list[str]) -> list[GenerationLLMResponse]:
+        """Function will call batched LLM api and return answers in the order of texts
+        Args:
+            texts: user questions with context
+        """
+        response = await self.client.post("/generate_batch", json={"texts": texts})
+        response.raise_for_status()
+        return [GenerationLLMResponse(**result) for result in response.json()["results"]]
+
+    async def generate_stream(self, text: str) -> AsyncIterator[GenerationLLMResponse]:
+        """Function will call streaming LLM api and yield partial answers for user text.
+        LLM api sends one JSON line with all texts generated so far on every update, upstream
+        request is closed as soon as the caller stops iterating
+        Args:
+            text: user question with context
+        """
+        async with self.client.stream("POST", "/generate_stream", json={"text": text}) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line:
+                    yield GenerationLLMResponse(**json.loads(line))
+
+    async def check_health(self, path: str, timeout: float) -> bool:
+        """Function returns whether LLM api server answers, error statuses below 500 mean it is up
+        Args:
+            path: path requested by GET
+            timeout: max time of health check in seconds
+        """
+        try:
+            response = await self.client.get(path, timeout=timeout)
+        except httpx.HTTPError:
+            return False
+        return response.status_code < 500
+
+    async def aclose(self) -> None:
+        """Close all pooled connections."""
+        await self.client.aclose()
@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+from dataclasses import asdict, dataclass
+
+from api.balancer import BalancedLanguageModelAPI
+from api.batching import BatchingLanguageModelAPI
+from api.language_model import LanguageModelAPI
+from data.base_classes import GenerationLLMResponse
+from utils.logger import get_pylogger
+from utils.metrics import LLM_CALLS_SAVED
+
+log = get_pylogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL_SECONDS = 60
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+# rough size of cached response object without its texts
+RESPONSE_OVERHEAD_BYTES = 256
+
+
+def prompt_key(text: str) -> str:
+    r"""Return cache key of final prompt text."""
+    return hashlib.sha256(text.encode("UTF-8")).hexdigest()
+
+
+def response_size(response: GenerationLLMResponse) -> int:
+    r"""Return approximate memory used by cached response."""
+    return RESPONSE_OVERHEAD_BYTES + sum(len(text) for text in response.texts)
+
+
+@dataclass
+class ResponseCacheMetrics:
+    """Counters of LLM api calls saved by response cache."""
+
+    hits: int = 0
+    coalesced: int = 0
+    misses: int = 0
+    evictions: int = 0
+    entries: int = 0
+    bytes: int = 0
+
+    @property
+    def saved_calls(self) -> int:
+        """Return number of generate calls which did not reach LLM api."""
+        return self.hits + self.coalesced
+
+    def as_dict(self) -> dict:
+        """Return counters with derived metrics."""
+        return {**asdict(self), "saved_calls": self.saved_calls}
+
+
+@dataclass
+class _CachedResponse:
+    response: GenerationLLMResponse
+    expires_at: float
+    size: int
+
+
+class CachingLanguageModelAPI:
+    """Class answers repeated prompts from LRU cache and shares one LLM call between identical
+    prompts generated at the same time."""
+
+    def __init__(
+        self,
+        api: LanguageModelAPI | BalancedLanguageModelAPI | BatchingLanguageModelAPI,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        self.api = api
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.metrics = ResponseCacheMetrics()
+        self._entries: OrderedDict[str, _CachedResponse] = OrderedDict()
+        self._in_flight: dict[str, asyncio.Task] = {}
+
+    async def generate(self, text: str) -> GenerationLLMResponse:
+        """Function returns cached answer for user text or waits for its generation
+        Args:
+            text: user question with context
+        """
+        key = prompt_key(text)
+        response = self._get(key)
+        if response is not None:
+            self.metrics.hits += 1
+            LLM_CALLS_SAVED.labels("cache").inc()
+            return response
+
+        request = self._in_flight.get(key)
+        if request is None:
+            self.metrics.misses += 1
+            request = asyncio.create_task(self._generate(key, text))
+            self._in_flight[key] = request
+            request.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.metrics.coalesced += 1
+            LLM_CALLS_SAVED.labels("coalesced").inc()
+        # cancelled caller does not cancel generation other callers are waiting for
+        return await asyncio.shield(request)
+
+    async def generate_batch(self, texts: list[str]) -> list[GenerationLLMResponse]:
+        """Function sends already collected texts as one batch, batches are not cached
+        Args:
+            texts: user questions with context
+        """
+        return await self.api.generate_batch(texts)
+
+    async def generate_stream(self, text: str) -> AsyncIterator[GenerationLLMResponse]:
+        """Function yields cached answer at once or streams it from LLM api, completed stream
+        is cached for the next identical prompt
+        Args:
+            text: user question with context
+        """
+        key = prompt_key(text)
+        response = self._get(key)
+        if response is not None:
+            self.metrics.hits += 1
+            LLM_CALLS_SAVED.labels("cache").inc()
+            yield response
+            return
+
+        self.metrics.misses += 1
+        response = None
+        async for response in self.api.generate_stream(text):
+            yield response
+        if response is not None:
+            self._put(key, response)
+
+    async def aclose(self) -> None:
+        """Cancel shared generations and close LLM api client."""
+        for request in list(self._in_flight.values()):
+            request.cancel()
+        await self.api.aclose()
+
+    async def _generate(self, key: str, text: str) -> GenerationLLMResponse:
+        response = await self.api.generate(text)
+        self._put(key, response)
+        return response
+
+    def _get(self, key: str) -> GenerationLLMResponse | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry.response
+
+    def _put(self, key: str, response: GenerationLLMResponse) -> None:
+        size = response_size(response)
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = _CachedResponse(response, time.monotonic() + self.ttl_seconds, size)
+        self.metrics.bytes += size
+        while len(self._entries) > self.max_entries or self.metrics.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.metrics.evictions += 1
+        self.metrics.entries = len(self._entries)
+
+    def _remove(self, key: str) -> None:
+        self.metrics.bytes -= self._entries.pop(key).size
+        self.metrics.entries = len(self._entries)
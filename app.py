@@ -1,55 +1,292 @@
 """Root file of service running REST api."""
 from __future__ import annotations
 
+import time
+
+STARTUP_STARTED_AT = time.perf_counter()
+
+# pylint: disable=wrong-import-position
+import asyncio
+import json
 import logging
 import os
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from itertools import islice
+from typing import Literal, Optional
 
 from bson.objectid import ObjectId
-from fastapi import FastAPI, status
-from huggingface_hub import login as hf_login
-from transformers import AutoTokenizer
+from fastapi import FastAPI, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
+from api.balancer import BalancedLanguageModelAPI
+from api.batching import BatchingLanguageModelAPI
 from api.language_model import LanguageModelAPI
+from api.response_cache import CachingLanguageModelAPI
 from data.base_classes import (
     GenerateRequest,
     GenerationChoiceResponse,
+    GenerationLLMResponse,
     SetMessagePossibleContextIds,
     SetUserChoice,
     SetUserCustomAnswer,
     UserCreateRequest,
 )
 from data.user_context import BaseMessage, ModelAnswer, RoleEnum
-from database.Interface import DataBase
+from database.AsyncInterface import AsyncDataBase
+from database.cached import CachedDataBase
+from database.instrumented import InstrumentedDataBase
+from database.Interface import ChoiceNotFoundError, DataBase
+from database.journal import WriteJournal
+from database.memory import InMemoryDataBase
 from database.mongo import MongoDataBase
+from database.mongo_async import AsyncMongoDataBase
+from database.mongo_bucketed import BucketedMongoDataBase
+from database.threaded import ThreadedDataBase
+from database.write_behind import WriteBehindDataBase
 from language_model.Chat import Conversation
+from language_model.prompt_cache import PromptPrefixCache
+from language_model.templates import TemplateRegistry
+from language_model.tokenizer_loader import TokenizerLoader
 from utils.logger import get_pylogger
+from utils.metrics import (
+    GENERATE_STAGE_SECONDS,
+    GENERATED_TOKENS,
+    PROMPT_TOKENS,
+    export_metrics,
+)
 
 log = get_pylogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 connection_string = os.environ["DATABASE_CONNECTION_STRING"]
 TEMPLATE_PATH = os.environ["TEMPLATE_PATH"]
-HF_TOKEN = os.environ["HF_TOKEN"]
+TEMPLATES_DIR = os.environ.get("TEMPLATES_DIR")
+HF_TOKEN = os.environ.get("HF_TOKEN")
 MODEL_NAME = os.environ["MODEL_NAME"]
-LM_API_ADDRESS = os.environ["LM_API_ADDRESS"]
+TOKENIZER_PATH = os.environ.get("TOKENIZER_PATH")
+TOKENIZER_PRELOAD = os.environ.get("TOKENIZER_PRELOAD", "0") == "1"
+LM_API_ADDRESSES = os.environ["LM_API_ADDRESS"].split(",")
 CONTEXT_SIZE = int(os.environ["CONTEXT_SIZE"])
 TABLE_NAME = os.environ["TABLE_NAME"]
+DATABASE_BACKEND = os.environ.get("DATABASE_BACKEND", "embedded")
+DATABASE_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", 100))
+PROMPT_CACHE_SIZE = int(os.environ.get("PROMPT_CACHE_SIZE", 1024))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 0))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 300))
+USER_CACHE_MAX_MB = int(os.environ.get("USER_CACHE_MAX_MB", 64))
+PROMPT_MAX_TOKENS = int(os.environ.get("PROMPT_MAX_TOKENS", 512))
+LM_API_MAX_CONNECTIONS = int(os.environ.get("LM_API_MAX_CONNECTIONS", 100))
+LM_API_TIMEOUT = float(os.environ.get("LM_API_TIMEOUT", 180))
+LM_API_CONNECT_TIMEOUT = float(os.environ.get("LM_API_CONNECT_TIMEOUT", 10))
+LM_API_HEALTH_PATH = os.environ.get("LM_API_HEALTH_PATH", "/health")
+LM_API_HEALTH_INTERVAL = float(os.environ.get("LM_API_HEALTH_INTERVAL", 10))
+LM_API_FAILURE_THRESHOLD = int(os.environ.get("LM_API_FAILURE_THRESHOLD", 5))
+LM_API_OPEN_SECONDS = float(os.environ.get("LM_API_OPEN_SECONDS", 30))
+LM_API_HEDGE = os.environ.get("LM_API_HEDGE", "0") == "1"
+LM_BATCH_SIZE = int(os.environ.get("LM_BATCH_SIZE", 1))
+LM_BATCH_WAIT_MS = float(os.environ.get("LM_BATCH_WAIT_MS", 10))
+LM_RESPONSE_CACHE_SIZE = int(os.environ.get("LM_RESPONSE_CACHE_SIZE", 1024))
+LM_RESPONSE_CACHE_TTL = float(os.environ.get("LM_RESPONSE_CACHE_TTL", 60))
+LM_RESPONSE_CACHE_MAX_MB = int(os.environ.get("LM_RESPONSE_CACHE_MAX_MB", 16))
+WRITE_BEHIND_JOURNAL_DIR = os.environ.get("WRITE_BEHIND_JOURNAL_DIR")
+WRITE_BEHIND_FLUSH_MS = float(os.environ.get("WRITE_BEHIND_FLUSH_MS", 50))
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", 500))
+WRITE_BEHIND_MAX_RETRIES = int(os.environ.get("WRITE_BEHIND_MAX_RETRIES", 10))
+CHECK_QUERY_PLANS = os.environ.get("CHECK_QUERY_PLANS", "0") == "1"
+ARCHIVE_ON_CLEAR = os.environ.get("ARCHIVE_ON_CLEAR", "0") == "1"
+CANDIDATES_TTL = float(os.environ.get("CANDIDATES_TTL", 7 * 24 * 60 * 60))
+# table of embedded storage users are copied from while bucketed service takes them over
+MIGRATION_SOURCE_TABLE = os.environ.get("MIGRATION_SOURCE_TABLE")
+# full prompts are large, writing them to log takes noticeable time of every request
+LOG_PROMPTS = os.environ.get("LOG_PROMPTS", "1") == "1"
 DATABASE_NAME = "chat"
+STREAM_MEDIA_TYPES = {"sse": "text/event-stream", "ndjson": "application/x-ndjson"}
+
+DATABASE_BACKENDS: dict[
+    str, type[MongoDataBase | BucketedMongoDataBase | AsyncMongoDataBase | InMemoryDataBase]
+] = {
+    "embedded": MongoDataBase,
+    "bucketed": BucketedMongoDataBase,
+    "async": AsyncMongoDataBase,
+    # keeps users in process memory, used by benchmarks
+    "memory": InMemoryDataBase,
+}
+# backends keeping messages inside user document, they move cleared history into archive
+ARCHIVE_BACKENDS = {"embedded", "async"}
+# backends keeping candidates of model answers out of messages until user picks one
+CANDIDATES_BACKENDS = {"embedded", "bucketed", "async"}
+ARCHIVE_EXPORT_BATCH_SIZE = 500
+
+# seconds spent by every startup phase
+startup_phases = {"imports": time.perf_counter() - STARTUP_STARTED_AT}
+
+# clients hold sockets and pymongo threads which do not survive fork, so they are created by
+# every worker process in lifespan
+storage: MongoDataBase | BucketedMongoDataBase | AsyncMongoDataBase | InMemoryDataBase
+database: AsyncDataBase
+user_cache: CachedDataBase | None = None
+threaded_database: ThreadedDataBase | None = None
+write_behind: WriteBehindDataBase | None = None
+lm_backends: BalancedLanguageModelAPI | None = None
+lm_api: CachingLanguageModelAPI
+# turns of streamed answers being stored, they outlive requests of disconnected clients
+saving_tasks: set[asyncio.Task] = set()
+
+tokenizer_loader = TokenizerLoader(MODEL_NAME, local_path=TOKENIZER_PATH, hf_token=HF_TOKEN)
+if TOKENIZER_PRELOAD:
+    # loaded before workers are forked, so all of them share its memory
+    log.info("Load tokenizer before fork")
+    tokenizer_loader.load()
+prompt_cache = PromptPrefixCache(max_users=PROMPT_CACHE_SIZE)
+templates = TemplateRegistry.from_paths(TEMPLATE_PATH, TEMPLATES_DIR)
+
+
+def open_database() -> None:
+    r"""Create database client of current process."""
+    # pylint: disable=global-statement
+    global storage, database, user_cache, threaded_database, write_behind
+    log.info("Open database connection")
+    options: dict[str, bool | float | str] = {}
+    if DATABASE_BACKEND in ARCHIVE_BACKENDS:
+        options["archive_on_clear"] = ARCHIVE_ON_CLEAR
+    elif ARCHIVE_ON_CLEAR:
+        log.warning("%s storage does not archive cleared history", DATABASE_BACKEND)
+    if DATABASE_BACKEND in CANDIDATES_BACKENDS:
+        options["candidates_ttl_seconds"] = CANDIDATES_TTL
+    if DATABASE_BACKEND == "bucketed" and MIGRATION_SOURCE_TABLE:
+        options["migration_source_table"] = MIGRATION_SOURCE_TABLE
+    elif MIGRATION_SOURCE_TABLE:
+        log.warning(
+            "%s storage does not copy users, MIGRATION_SOURCE_TABLE is ignored", DATABASE_BACKEND
+        )
+    storage = DATABASE_BACKENDS[DATABASE_BACKEND](
+        connection_string=connection_string,
+        database_name=DATABASE_NAME,
+        table_name=TABLE_NAME,
+        max_pool_size=DATABASE_POOL_SIZE,
+        **options,
+    )
+    if isinstance(storage, AsyncMongoDataBase):
+        if USER_CACHE_SIZE > 0:
+            log.warning("async storage does not cache context windows, USER_CACHE_SIZE is ignored")
+        instrumented = InstrumentedDataBase(storage)
+    else:
+        blocking_database: DataBase = storage
+        if USER_CACHE_SIZE > 0:
+            user_cache = CachedDataBase(
+                storage,
+                window_size=CONTEXT_SIZE,
+                max_users=USER_CACHE_SIZE,
+                ttl_seconds=USER_CACHE_TTL,
+                max_bytes=USER_CACHE_MAX_MB * 1024 * 1024,
+            )
+            blocking_database = user_cache
+        # blocking drivers run in threads, routes await every backend the same way
+        threaded_database = ThreadedDataBase(blocking_database, max_workers=DATABASE_POOL_SIZE)
+        instrumented = InstrumentedDataBase(threaded_database)
+
+    if WRITE_BEHIND_JOURNAL_DIR:
+        write_behind = WriteBehindDataBase(
+            instrumented,
+            WriteJournal(WRITE_BEHIND_JOURNAL_DIR),
+            flush_interval_ms=WRITE_BEHIND_FLUSH_MS,
+            max_batch_size=WRITE_BEHIND_BATCH_SIZE,
+            max_retries=WRITE_BEHIND_MAX_RETRIES,
+        )
+    database = instrumented if write_behind is None else write_behind
+
+
+def open_lm_api() -> None:
+    r"""Create LLM api client of current process."""
+    global lm_api, lm_backends  # pylint: disable=global-statement
+    apis = [
+        LanguageModelAPI(
+            address.strip(),
+            max_connections=LM_API_MAX_CONNECTIONS,
+            timeout=LM_API_TIMEOUT,
+            connect_timeout=LM_API_CONNECT_TIMEOUT,
+        )
+        for address in LM_API_ADDRESSES
+    ]
+    backend: LanguageModelAPI | BalancedLanguageModelAPI = apis[0]
+    if len(apis) > 1:
+        backend = lm_backends = BalancedLanguageModelAPI(
+            apis,
+            failure_threshold=LM_API_FAILURE_THRESHOLD,
+            open_seconds=LM_API_OPEN_SECONDS,
+            health_path=LM_API_HEALTH_PATH,
+            health_interval=LM_API_HEALTH_INTERVAL,
+            hedge=LM_API_HEDGE,
+        )
+    api: LanguageModelAPI | BalancedLanguageModelAPI | BatchingLanguageModelAPI = backend
+    if LM_BATCH_SIZE > 1:
+        api = BatchingLanguageModelAPI(
+            backend, max_batch_size=LM_BATCH_SIZE, max_wait_ms=LM_BATCH_WAIT_MS
+        )
+    # identical prompts generated at the same time share one LLM call even without cache
+    lm_api = CachingLanguageModelAPI(
+        api,
+        max_entries=LM_RESPONSE_CACHE_SIZE,
+        ttl_seconds=LM_RESPONSE_CACHE_TTL,
+        max_bytes=LM_RESPONSE_CACHE_MAX_MB * 1024 * 1024,
+    )
 
-log.info("Open database connection")
-database: DataBase = MongoDataBase(
-    connection_string=connection_string, database_name=DATABASE_NAME, table_name=TABLE_NAME
-)
 
-log.info("Logging into HF")
-hf_login(HF_TOKEN)
+async def check_query_plans() -> None:
+    r"""Log hot queries which scan the whole collection."""
+    if isinstance(storage, AsyncMongoDataBase):
+        collection_scans = await storage.find_collection_scans()
+    else:
+        collection_scans = await run_in_threadpool(storage.find_collection_scans)
+    if collection_scans:
+        log.warning("Queries scan the whole collection: %s", ", ".join(collection_scans))
 
-log.info("Building tokenizer model")
-tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
 
-lm_api = LanguageModelAPI(LM_API_ADDRESS)
+async def load_tokenizer() -> None:
+    r"""Wait for tokenizer and log time of every startup phase."""
+    try:
+        await tokenizer_loader.wait()
+    except Exception:  # pylint: disable=broad-except
+        log.exception("Can not load tokenizer, it is loaded again by the next generate request")
+        return
+    startup_phases["tokenizer"] = tokenizer_loader.load_seconds
+    startup_phases["total"] = time.perf_counter() - STARTUP_STARTED_AT
+    log.info(
+        "Startup phases in seconds: %s",
+        ", ".join(f"{phase}={seconds:.3f}" for phase, seconds in startup_phases.items()),
+    )
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    r"""Open connections and start loading tokenizer on startup, close connections on shutdown."""
+    loading = asyncio.create_task(load_tokenizer())
+    phase_started_at = time.perf_counter()
+    open_database()
+    if isinstance(storage, AsyncMongoDataBase):
+        await storage.ensure_indexes()
+    if CHECK_QUERY_PLANS:
+        await check_query_plans()
+    if write_behind is not None:
+        await write_behind.start()
+    startup_phases["database"] = time.perf_counter() - phase_started_at
+    open_lm_api()
+    yield
+    loading.cancel()
+    await asyncio.gather(*saving_tasks, return_exceptions=True)
+    await lm_api.aclose()
+    if write_behind is not None:
+        await write_behind.aclose()
+    if threaded_database is not None:
+        threaded_database.close()
+    if isinstance(storage, AsyncMongoDataBase):
+        storage.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/ping")
@@ -58,11 +295,46 @@ def ping():
     return {"ping": "pong"}
 
 
+@app.get("/ready")
+def ready():
+    r"""Readiness check route, service is ready to generate when tokenizer is loaded."""
+    if not tokenizer_loader.ready:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Tokenizer is loading"
+        )
+    return {"ready": True}
+
+
+@app.get("/metrics")
+def metrics():
+    r"""Metrics in Prometheus text format."""
+    content, content_type = export_metrics()
+    return Response(content=content, headers={"Content-Type": content_type})
+
+
+@app.get("/stats")
+def stats():
+    r"""Counters of service components."""
+    counters: dict = {"startup_seconds": startup_phases}
+    counters["llm_response_cache"] = lm_api.metrics.as_dict()
+    if lm_backends is not None:
+        counters["llm_backends"] = lm_backends.stats()
+    if isinstance(lm_api.api, BatchingLanguageModelAPI):
+        counters["llm_batching"] = lm_api.api.metrics.as_dict()
+    if user_cache is not None:
+        counters["user_cache"] = user_cache.stats()
+    if write_behind is not None:
+        counters["write_behind"] = write_behind.metrics.as_dict()
+    return counters
+
+
 @app.post("/users", status_code=status.HTTP_201_CREATED)
-def create_user(user: UserCreateRequest):
+async def create_user(user: UserCreateRequest):
     r"""Create new user."""
     try:
-        database.create_user(user_id=user.user_id, username=user.username, chat_id=user.chat_id)
+        await database.create_user(
+            user_id=user.user_id, username=user.username, chat_id=user.chat_id
+        )
     except ValueError:
         pass
 
@@ -70,93 +342,339 @@ def create_user(user: UserCreateRequest):
 
 
 @app.delete("/users/{user_id}/context")
-def clear_history(user_id: str):
+async def clear_history(user_id: str):
     r"""
     Remove all user messages
     Args:
         user_id: User id passed to store in database
     """
-    database.clear_history(user_id=user_id)
+    await database.clear_history(user_id=user_id)
+    prompt_cache.invalidate(user_id)
     log.info("Clear history user %s", user_id)
     return {"status": "history_cleared"}
 
 
 @app.delete("/users/{user_id}", status_code=status.HTTP_200_OK)
-def delete_user(user_id: str):
+async def delete_user(user_id: str):
     r"""
     Remove all information about user from database
     Args:
         user_id: User id passed to store in database
     """
-    database.remove_user(user_id=user_id)
+    await database.remove_user(user_id=user_id)
+    prompt_cache.invalidate(user_id)
     log.info("Remove user %s", user_id)
     return {"user_id": user_id}
 
 
 @app.get("/users/{user_id}")
-def get_user(user_id: str):
+async def get_user(user_id: str):
     r"""
     Get all user property by user id
     Args:
         user_id: User id passed to store in database
     """
-    user = database.get_user(user_id=user_id)
-    return user
+    user = await database.get_user(user_id=user_id)
+    # documents hold only JSON types, so they are sent without jsonable_encoder walking them
+    return JSONResponse(None if user is None else user.to_bson())
 
 
+# FastAPI evaluates annotations of routes, X | None needs Python 3.10
 @app.get("/users")
-def get_users():
-    r"""Get all user."""
-    all_users = database.get_all_users()
-    return all_users
+async def get_users(  # pylint: disable=consider-alternative-union-syntax
+    after: Optional[str] = None,
+    limit: Optional[int] = None,
+    include_history: bool = True,
+    stream: bool = False,
+):
+    r"""
+    Get all user, whole list is returned when no paging parameter is passed
+    Args:
+        after: return users with user id greater than this one
+        limit: max number of returned users
+        include_history: if false, users are returned without messages
+        stream: write users as JSON lines while they are read from database
+    """
+    users = database.iter_users(after, limit, include_history)
+    if stream:
+        lines = (json.dumps(user.to_bson(), ensure_ascii=False) + "\n" async for user in users)
+        return StreamingResponse(lines, media_type=STREAM_MEDIA_TYPES["ndjson"])
+    page = [user.to_bson() async for user in users]
+    if after is None and limit is None:
+        return JSONResponse(page)
+
+    return JSONResponse({"users": page, "next_after": page[-1]["user_id"] if page else None})
 
 
 @app.get("/users/{user_id}/context")
-def get_users_not_deleted_messages(user_id: str, limit: int):
+async def get_users_not_deleted_messages(user_id: str, limit: int):
     r"""Get all user."""
-    messages = database.get_context(user_id, limit)
+    messages = await database.get_context(user_id, limit)
     return messages
 
 
-@app.patch("/users/{user_id}/context/generate")
-def generate(user_id: str, generate_request: GenerateRequest):
+async def archived_messages(user_id: str) -> AsyncIterator[BaseMessage]:
     r"""
-    Update state of user, run language model and return response
+    Yield archived messages of user from the oldest one
+    Args:
+        user_id: User id passed to store in database
+    """
+    if isinstance(storage, AsyncMongoDataBase):
+        async for message in storage.iter_archived_messages(user_id):
+            yield message
+        return
+    messages = storage.iter_archived_messages(user_id)
+    loop = asyncio.get_running_loop()
+    # chunks are read by threads of blocking database calls
+    executor = None if threaded_database is None else threaded_database.executor
+    while True:
+        # one thread hop per batch instead of per message
+        batch = await loop.run_in_executor(
+            executor, list, islice(messages, ARCHIVE_EXPORT_BATCH_SIZE)
+        )
+        for message in batch:
+            yield message
+        if len(batch) < ARCHIVE_EXPORT_BATCH_SIZE:
+            return
+
+
+@app.get("/users/{user_id}/archive")
+async def export_archive(user_id: str):
+    r"""
+    Stream archived messages of user as JSON lines, chunks are read from database while sending
+    Args:
+        user_id: User id passed to store in database
+    """
+    if not isinstance(storage, (MongoDataBase, AsyncMongoDataBase)):
+        raise HTTPException(
+            status_code=status.HTTP_501_NOT_IMPLEMENTED,
+            detail=f"{DATABASE_BACKEND} storage has no archive",
+        )
+    lines = (
+        json.dumps(message.to_bson(), ensure_ascii=False) + "\n"
+        async for message in archived_messages(user_id)
+    )
+    return StreamingResponse(lines, media_type=STREAM_MEDIA_TYPES["ndjson"])
+
+
+@dataclass
+class GenerationPrompt:
+    r"""Prompt built for LLM with conversation messages it was built from."""
+
+    conversation: Conversation
+    context_for_generation: list[BaseMessage]
+    user_question: BaseMessage
+    text: str
+
+
+def build_generation_prompt(
+    user_id: str,
+    text: str,
+    system_prompt: BaseMessage,
+    user_messages: list[BaseMessage],
+    template_name: str | None = None,
+) -> GenerationPrompt:
+    r"""
+    Build prompt for LLM from user context, blocking so must run in threadpool
     Args:
         user_id: id of user, must be unique
-        generate_request: user question
+        text: user question
+        system_prompt: system prompt of user
+        user_messages: the newest messages of user
+        template_name: name of conversation template, default template is used if not set
     """
+    user_question = BaseMessage(id=str(ObjectId()), role=RoleEnum.user, context=text)
+
+    context_for_generation: list[BaseMessage] = user_messages + [user_question]
 
-    system_prompt, user_messages = database.get_context(user_id, CONTEXT_SIZE)
-    user_question = BaseMessage(
-        id=str(ObjectId()), role=RoleEnum.user, context=generate_request.text
+    tokenizer = tokenizer_loader.tokenizer
+    with GENERATE_STAGE_SECONDS.labels("template").time():
+        conversation = templates.get(template_name).create_conversation(
+            system_prompt.context, tokenizer
+        )
+        prompt_cache.expand(user_id, conversation, user_messages)
+    with GENERATE_STAGE_SECONDS.labels("prompt").time():
+        conversation.expand([user_question])
+        text_for_generation = conversation.get_prompt_for_generate(
+            tokenizer, max_tokens=PROMPT_MAX_TOKENS
+        )
+    if conversation.prompt_token_count is not None:
+        PROMPT_TOKENS.inc(conversation.prompt_token_count)
+    if LOG_PROMPTS:
+        log.info("Context for model generation %s", text_for_generation)
+    return GenerationPrompt(
+        conversation=conversation,
+        context_for_generation=context_for_generation,
+        user_question=user_question,
+        text=text_for_generation,
     )
 
-    context_for_generation: list[BaseMessage] = user_messages + [user_question]
 
-    conversation = Conversation.from_template(TEMPLATE_PATH, system_prompt=system_prompt.context)
-    conversation.expand(context_for_generation)
-    text_for_generation = conversation.get_prompt_for_generate(tokenizer)
-    log.info("Context for model generation %s", text_for_generation)
+async def prepare_generation_prompt(
+    user_id: str, generate_request: GenerateRequest
+) -> GenerationPrompt:
+    r"""
+    Read user context and build prompt for LLM
+    Args:
+        user_id: id of user, must be unique
+        generate_request: user question
+    """
+    template_name = generate_request.template_name
+    if template_name is not None and template_name not in templates:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown template {template_name}"
+        )
+    try:
+        await tokenizer_loader.wait()
+    except Exception as exception:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Tokenizer is not loaded"
+        ) from exception
+    with GENERATE_STAGE_SECONDS.labels("get_context").time():
+        system_prompt, user_messages = await database.get_context(
+            user_id, CONTEXT_SIZE, max_tokens=PROMPT_MAX_TOKENS
+        )
+    # tokenizer calls are blocking, event loop is not held while prompt is built
+    return await run_in_threadpool(
+        build_generation_prompt,
+        user_id,
+        generate_request.text,
+        system_prompt,
+        user_messages,
+        template_name,
+    )
+
 
-    model_response = lm_api.generate(text_for_generation)
-    model_answer_id = str(ObjectId())
+def build_model_answer(
+    prompt: GenerationPrompt, model_response: GenerationLLMResponse
+) -> ModelAnswer:
+    r"""
+    Create model answer with token counts of question and answer, blocking so must run in
+    threadpool
+    Args:
+        prompt: prompt passed to LLM
+        model_response: texts generated by LLM
+    """
     model_answer = ModelAnswer(
-        id=model_answer_id,
+        id=str(ObjectId()),
         role=RoleEnum.bot,
         context=model_response.texts[0],
         possible_contexts=model_response.texts,
         user_choice=False,
         possible_contexts_ids=[],
     )
-    database.update_user_text(user_id=user_id, texts=[user_question, model_answer])
+    tokenizer = tokenizer_loader.tokenizer
+    with GENERATE_STAGE_SECONDS.labels("answer_tokens").time():
+        conversation = prompt.conversation
+        conversation.expand([model_answer])
+        # token counts of messages formatted by template let database trim context by budget
+        token_counts = conversation.get_message_token_counts(tokenizer)
+        prompt.user_question.token_count, model_answer.token_count = token_counts[-2:]
+        generated_ids = tokenizer(model_response.texts, add_special_tokens=False)["input_ids"]
+    GENERATED_TOKENS.inc(sum(len(ids) for ids in generated_ids))
+    return model_answer
+
+
+async def save_model_answer(
+    user_id: str, prompt: GenerationPrompt, model_response: GenerationLLMResponse
+) -> str:
+    r"""
+    Store user question with model answer
+    Args:
+        user_id: id of user, must be unique
+        prompt: prompt passed to LLM
+        model_response: texts generated by LLM
+    Returns:
+        id of stored model answer
+    """
+    model_answer = await run_in_threadpool(build_model_answer, prompt, model_response)
+    with GENERATE_STAGE_SECONDS.labels("update_user_text").time():
+        await database.update_user_text(
+            user_id=user_id, texts=[prompt.user_question, model_answer]
+        )
+    prompt_cache.remember(
+        user_id,
+        prompt.conversation,
+        [message.id for message in prompt.context_for_generation + [model_answer]],
+    )
     log.info("update_user_text model answer")
-    print(model_response.texts)
+    return model_answer.id
+
+
+@app.patch("/users/{user_id}/context/generate")
+async def generate(user_id: str, generate_request: GenerateRequest):
+    r"""
+    Update state of user, run language model and return response
+    Args:
+        user_id: id of user, must be unique
+        generate_request: user question
+    """
+    prompt = await prepare_generation_prompt(user_id, generate_request)
+    with GENERATE_STAGE_SECONDS.labels("llm").time():
+        model_response = await lm_api.generate(prompt.text)
+    if LOG_PROMPTS:
+        log.info("Model answers %s", model_response.texts)
+    model_answer_id = await save_model_answer(user_id, prompt, model_response)
     return GenerationChoiceResponse(messages=model_response.texts, answer_id=model_answer_id)
 
 
+def encode_stream_event(payload: dict, stream_format: str, event: str | None = None) -> str:
+    r"""
+    Encode one streaming update as server-sent event or JSON line
+    Args:
+        payload: data passed to client
+        stream_format: sse or ndjson
+        event: name of server-sent event, default event is used when it is not set
+    """
+    data = json.dumps(payload, ensure_ascii=False)
+    if stream_format == "ndjson":
+        return data + "\n"
+    if event is None:
+        return f"data: {data}\n\n"
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+@app.patch("/users/{user_id}/context/generate/stream")
+async def generate_stream(
+    user_id: str,
+    generate_request: GenerateRequest,
+    stream_format: Literal["sse", "ndjson"] = "sse",
+):
+    r"""
+    Update state of user, run language model and stream partial responses
+    Args:
+        user_id: id of user, must be unique
+        generate_request: user question
+        stream_format: sse for server-sent events or ndjson for JSON lines
+    """
+    prompt = await prepare_generation_prompt(user_id, generate_request)
+
+    async def stream_answer() -> AsyncIterator[str]:
+        # when client disconnects during generation this generator is cancelled, leaving
+        # generate_stream closes upstream request and nothing is stored
+        model_response: GenerationLLMResponse | None = None
+        with GENERATE_STAGE_SECONDS.labels("llm").time():
+            async for model_response in lm_api.generate_stream(prompt.text):
+                yield encode_stream_event({"messages": model_response.texts}, stream_format)
+        if model_response is None:
+            return
+
+        # answer generated to the end is stored even if client disconnects while it is saved
+        saving = asyncio.create_task(save_model_answer(user_id, prompt, model_response))
+        saving_tasks.add(saving)
+        saving.add_done_callback(saving_tasks.discard)
+        model_answer_id = await asyncio.shield(saving)
+        yield encode_stream_event(
+            {"messages": model_response.texts, "answer_id": model_answer_id, "done": True},
+            stream_format,
+            event="done",
+        )
+
+    return StreamingResponse(stream_answer(), media_type=STREAM_MEDIA_TYPES[stream_format])
+
+
 @app.post("/users/{user_id}/context/{answer_id}/possible_contexts_ids")
-def set_message_possible_context_ids(
+async def set_message_possible_context_ids(
     user_id: str, answer_id: str, set_message_possible_ids: SetMessagePossibleContextIds
 ):
     r"""
@@ -166,28 +684,34 @@ def set_message_possible_context_ids(
         answer_id: DB id of model answer
         set_message_possible_ids: id of messages proposed by model
     """
-    database.set_message_possible_context_ids(
+    await database.set_message_possible_context_ids(
         user_id, answer_id, set_message_possible_ids.possible_contexts_ids
     )
     return {"ids": set_message_possible_ids.possible_contexts_ids}
 
 
 @app.post("/users/{user_id}/context/messages/custom_answer")
-def set_user_choice_custom_answer(user_id: str, user_custom_answer: SetUserCustomAnswer):
+async def set_user_choice_custom_answer(user_id: str, user_custom_answer: SetUserCustomAnswer):
     r"""
     Update state of message
     Args:
         user_id: id of user, must be unique
         user_custom_answer: text of user proposed answer
     """
-    database.update_user_custom_choice(
-        user_id, user_custom_answer.message_id, user_custom_answer.custom_text
-    )
+    try:
+        await database.update_user_custom_choice(
+            user_id, user_custom_answer.message_id, user_custom_answer.custom_text
+        )
+    except ChoiceNotFoundError as exception:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=str(exception)
+        ) from exception
+    prompt_cache.invalidate(user_id)
     return {"text": user_custom_answer.custom_text}
 
 
 @app.post("/users/{user_id}/context/{answer_id}/user_choice")
-def set_user_choice_answer(user_id: str, answer_id: str, user_choice: SetUserChoice):
+async def set_user_choice_answer(user_id: str, answer_id: str, user_choice: SetUserChoice):
     r"""
     Update state of message
     Args:
@@ -195,5 +719,12 @@ def set_user_choice_answer(user_id: str, answer_id: str, user_choice: SetUserCho
         answer_id: DB id of model answer
         user_choice: id of message chosen by the user
     """
-    choice_text = database.update_user_choice(user_id, answer_id, user_choice.message_id)
+    try:
+        choice_text = await database.update_user_choice(user_id, answer_id, user_choice.message_id)
+    except ChoiceNotFoundError as exception:
+        # candidates of answers expire, see CANDIDATES_TTL_SECONDS
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=str(exception)
+        ) from exception
+    prompt_cache.invalidate(user_id)
     return {"text": choice_text}
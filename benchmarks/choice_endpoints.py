@@ -0,0 +1,228 @@
+"""Measure latency and round trips of user choice updates against MongoDB.
+
+Previous implementations of choice updates are kept here as a reference to compare with. They
+run on answers with inline candidates as they were stored before candidates collection, current
+updates are measured on answers of candidates collection and on inline answers they fall back to:
+
+    DATABASE_CONNECTION_STRING=mongodb://localhost:27017 python -m benchmarks.choice_endpoints
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import statistics
+import time
+from collections import Counter
+from collections.abc import Callable
+
+from bson.objectid import ObjectId
+from pymongo import monitoring
+from pymongo.collection import Collection
+
+from data.user_context import BaseMessage, ModelAnswer, RoleEnum
+from database.mongo import MongoDataBase
+
+DATABASE_NAME = "chat"
+
+
+class RoundTripCounter(monitoring.CommandListener):
+    """Count commands sent to MongoDB."""
+
+    def __init__(self):
+        self.commands: Counter = Counter()
+
+    def started(self, event):
+        """Count started command."""
+        self.commands[event.command_name] += 1
+
+    def succeeded(self, event):
+        """Ignore finished command."""
+
+    def failed(self, event):
+        """Ignore failed command."""
+
+    def total(self) -> int:
+        """Return number of sent commands."""
+        return sum(self.commands.values())
+
+
+def legacy_update_user_choice(
+    collection: Collection, user_id: str, answer_id: str, user_choice_idx: str
+) -> str:
+    r"""Update user choice with separate set, read and write of chosen text."""
+    query = {"user_id": user_id, "context.id": answer_id}
+    collection.update_one(query, {"$set": {"context.$.user_choice": user_choice_idx}})
+    message = collection.find_one(query, {"context.$": 1})["context"][0]
+    index_of_user_choice = message["possible_contexts_ids"].index(message["user_choice"])
+    user_choice_text = message["possible_contexts"][index_of_user_choice]
+    collection.update_one(query, {"$set": {"context.$.context": user_choice_text}})
+    return user_choice_text
+
+
+def legacy_update_user_custom_choice(
+    collection: Collection, user_id: str, message_choice_id: str, custom_text: str
+) -> None:
+    r"""Update custom choice with debug read of the whole user document."""
+    query = {"user_id": user_id, "context.possible_contexts_ids": message_choice_id}
+    collection.find_one(query)
+    collection.update_one(
+        query, {"$set": {"context.$.user_choice": "custom", "context.$.context": custom_text}}
+    )
+
+
+def build_turn(idx: int) -> tuple[BaseMessage, ModelAnswer]:
+    r"""Return question and model answer having three candidates."""
+    question = BaseMessage(id=str(ObjectId()), role=RoleEnum.user, context=f"question {idx}")
+    answer = ModelAnswer(
+        id=str(ObjectId()),
+        role=RoleEnum.bot,
+        context="candidate 0",
+        possible_contexts=[f"candidate {choice} of {idx}" for choice in range(3)],
+        possible_contexts_ids=[str(ObjectId()) for _ in range(3)],
+    )
+    return question, answer
+
+
+def fill_user(database: MongoDataBase, user_id: str, answers: int) -> list[list[str]]:
+    r"""
+    Create user with answers stored by the service, candidates are kept in candidates collection
+    Returns:
+        candidate ids of every answer, answer id is the first element
+    """
+    database.create_user(user_id=user_id, username=None, chat_id=user_id)
+    answers_ids = []
+    for idx in range(answers):
+        question, answer = build_turn(idx)
+        database.update_user_text(user_id, [question, answer])
+        answers_ids.append([answer.id] + answer.possible_contexts_ids)
+    return answers_ids
+
+
+def fill_inline_user(database: MongoDataBase, user_id: str, answers: int) -> list[list[str]]:
+    r"""
+    Create user with answers stored before candidates collection, candidates are kept inline
+    Returns:
+        candidate ids of every answer, answer id is the first element
+    """
+    database.create_user(user_id=user_id, username=None, chat_id=user_id)
+    turns = [build_turn(idx) for idx in range(answers)]
+    database.collection.update_one(
+        {"user_id": user_id},
+        {
+            "$push": {
+                "context": {"$each": [message.to_bson() for turn in turns for message in turn]}
+            }
+        },
+    )
+    return [[answer.id] + answer.possible_contexts_ids for _, answer in turns]
+
+
+def measure(name: str, counter: RoundTripCounter, calls: list[Callable[[], object]]) -> dict:
+    r"""Run calls one by one and return latency and round trips per call."""
+    latencies = []
+    counter.commands.clear()
+    for call in calls:
+        start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start)
+    return {
+        "name": name,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "max_ms": max(latencies) * 1000,
+        "round_trips": counter.total() / len(calls),
+    }
+
+
+def main():
+    r"""Compare previous and current choice updates on a temporary table."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--answers", type=int, default=500, help="answers stored for user")
+    parser.add_argument("--calls", type=int, default=200, help="measured calls of each method")
+    args = parser.parse_args()
+
+    counter = RoundTripCounter()
+    monitoring.register(counter)
+    table_name = f"benchmark_choice_{ObjectId()}"
+    database = MongoDataBase(
+        connection_string=os.environ["DATABASE_CONNECTION_STRING"],
+        database_name=DATABASE_NAME,
+        table_name=table_name,
+    )
+    collection = database.collection
+    try:
+        # legacy updates and inline fallback run on answers with inline candidates
+        legacy = fill_inline_user(database, "legacy_user", args.answers)[-args.calls :]
+        inline = fill_inline_user(database, "inline_user", args.answers)[-args.calls :]
+        stored = fill_user(database, "candidates_user", args.answers)[-args.calls :]
+        results = [
+            measure(
+                "legacy update_user_choice",
+                counter,
+                [
+                    lambda ids=ids: legacy_update_user_choice(
+                        collection, "legacy_user", ids[0], ids[2]
+                    )
+                    for ids in legacy
+                ],
+            ),
+            measure(
+                "update_user_choice candidates",
+                counter,
+                [
+                    lambda ids=ids: database.update_user_choice("candidates_user", ids[0], ids[3])
+                    for ids in stored
+                ],
+            ),
+            measure(
+                "update_user_choice inline",
+                counter,
+                [
+                    lambda ids=ids: database.update_user_choice("inline_user", ids[0], ids[3])
+                    for ids in inline
+                ],
+            ),
+            measure(
+                "legacy update_user_custom_choice",
+                counter,
+                [
+                    lambda ids=ids: legacy_update_user_custom_choice(
+                        collection, "legacy_user", ids[1], "custom"
+                    )
+                    for ids in legacy
+                ],
+            ),
+            measure(
+                "update_user_custom_choice candidates",
+                counter,
+                [
+                    lambda ids=ids: database.update_user_custom_choice(
+                        "candidates_user", ids[1], "custom"
+                    )
+                    for ids in stored
+                ],
+            ),
+            measure(
+                "update_user_custom_choice inline",
+                counter,
+                [
+                    lambda ids=ids: database.update_user_custom_choice(
+                        "inline_user", ids[1], "custom"
+                    )
+                    for ids in inline
+                ],
+            ),
+        ]
+    finally:
+        for table in (collection, database.candidates, database.archive):
+            table.drop()
+
+    print(f"{'method':<40}{'p50 ms':>10}{'max ms':>10}{'round trips':>14}")
+    for result in results:
+        print(
+            f"{result['name']:<40}{result['p50_ms']:>10.2f}{result['max_ms']:>10.2f}"
+            f"{result['round_trips']:>14.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,532 @@
+"""Replay conversation traffic against service running with in-memory database and stub LLM.
+
+For every combination of --users and --history service is started in fresh process seeded with
+that many users having that many messages. Sessions of synthetic users go through all routes,
+recorded sessions are replayed instead when --replay is set. Results are written as JSON with
+sorted keys, so results of two releases can be compared by diff:
+
+    python -m benchmarks.load_test --users 10,1000 --history 0,200 --output load_test.json
+
+Replay file has one request per line: {"session": "1", "method": "PATCH", "path": "...",
+"json": {...}, "params": {...}}. Requests of one session are sent in order, sessions run
+concurrently. "{answer_id}" in path or body is replaced by answer id of the last generate
+request of the session. --record writes sessions of the last scenario in this format.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import IO, Any
+
+import httpx
+from bson.objectid import ObjectId
+
+from benchmarks.serve import benchmark_user_id
+from benchmarks.toy_tokenizer import build_toy_tokenizer, synthetic_lines
+from utils.logger import get_pylogger
+
+log = get_pylogger(__name__)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATE_PATH = os.path.join(ROOT, "templates", "chat_conversation_template.json")
+ANSWER_ID = "{answer_id}"
+READY_TIMEOUT = 300
+STREAM_SHARE = 0.1
+CUSTOM_ANSWER_SHARE = 0.1
+READ_CONTEXT_SHARE = 0.2
+CLEAR_HISTORY_SHARE = 0.05
+
+
+def percentile(values: list[float], share: float) -> float:
+    r"""
+    Return nearest-rank percentile
+    Args:
+        values: sorted values
+        share: percentile divided by 100
+    """
+    return values[max(0, math.ceil(share * len(values)) - 1)]
+
+
+def latency_summary(latencies: list[float]) -> dict:
+    r"""Return p50, p95 and p99 in milliseconds rounded for stable diffs."""
+    latencies = sorted(latencies)
+    if not latencies:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None}
+    return {
+        f"p{round(share * 100)}_ms": round(percentile(latencies, share) * 1000, 2)
+        for share in (0.5, 0.95, 0.99)
+    }
+
+
+def route_name(method: str, path: str) -> str:
+    r"""Return route template of request path, e.g. PATCH /users/{user_id}/context/generate."""
+    parts = path.split("?")[0].strip("/").split("/")
+    if len(parts) > 1 and parts[0] == "users":
+        parts[1] = "{user_id}"
+    if len(parts) > 4 and parts[2] == "context" and parts[3] not in ("messages", "generate"):
+        parts[3] = "{answer_id}"
+    return f"{method} /{'/'.join(parts)}"
+
+
+def peak_rss_mb(pid: int) -> float | None:
+    r"""Return peak resident memory of process, None where /proc is not available."""
+    try:
+        with open(f"/proc/{pid}/status", encoding="UTF-8") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def free_port() -> int:
+    r"""Return port free at the moment of call."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def is_ready(url: str) -> bool:
+    r"""Return whether url answers 200."""
+    try:
+        return httpx.get(url, timeout=1).status_code == 200
+    except httpx.HTTPError:
+        return False
+
+
+def wait_until_ready(process: subprocess.Popen, output: IO[bytes], ready_url: str) -> None:
+    r"""
+    Poll ready_url until it answers 200, raise error when process exits or timeout is reached
+    Args:
+        process: started process
+        output: file of process output, its tail is shown when process exits
+        ready_url: url polled until process is ready
+    """
+    deadline = time.monotonic() + READY_TIMEOUT
+    while not is_ready(ready_url):
+        if process.poll() is not None:
+            output.seek(0)
+            raise RuntimeError(f"{process.args} exited:\n{output.read().decode()[-4000:]}")
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"{ready_url} is not ready in {READY_TIMEOUT}s")
+        time.sleep(0.2)
+
+
+@contextmanager
+def running_process(command: list[str], env: dict, ready_url: str) -> Iterator[subprocess.Popen]:
+    r"""
+    Start process and wait until ready_url answers 200, process is stopped on exit
+    Args:
+        command: command line of process
+        env: environment of process
+        ready_url: url polled until process is ready
+    """
+    with tempfile.TemporaryFile() as output:
+        process = subprocess.Popen(
+            command, env=env, cwd=ROOT, stdout=output, stderr=subprocess.STDOUT
+        )
+        try:
+            wait_until_ready(process, output, ready_url)
+            yield process
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+@dataclass
+class Recorder:
+    """Latencies of sent requests by route and optionally the requests themselves."""
+
+    latencies: dict[str, list[float]] = field(default_factory=lambda: defaultdict(list))
+    errors: dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    recorded: list[dict] | None = None
+
+    async def send(
+        self,
+        client: httpx.AsyncClient,
+        session: str,
+        method: str,
+        path: str,
+        answer_id: str | None = None,
+        **kwargs: Any,
+    ) -> httpx.Response | None:
+        r"""
+        Send request and record its latency, failed request returns None
+        Args:
+            client: client of service
+            session: id of session request belongs to
+            method: HTTP method
+            path: request path, may contain answer id placeholder
+            answer_id: value of answer id placeholder
+            kwargs: json and params of request
+        """
+        if self.recorded is not None:
+            self.recorded.append({"session": session, "method": method, "path": path, **kwargs})
+        if answer_id is not None:
+            path = path.replace(ANSWER_ID, answer_id)
+            if "json" in kwargs:
+                kwargs["json"] = json.loads(
+                    json.dumps(kwargs["json"]).replace(ANSWER_ID, answer_id)
+                )
+        name = route_name(method, path)
+        started_at = time.perf_counter()
+        try:
+            response = await client.request(method, path, **kwargs)
+        except httpx.HTTPError as exception:
+            log.warning("%s failed: %r", name, exception)
+            self.errors[name] += 1
+            return None
+        self.latencies[name].append(time.perf_counter() - started_at)
+        if response.is_error:
+            self.errors[name] += 1
+            return None
+        return response
+
+    def summary(self) -> dict:
+        r"""Return counts and latency percentiles of every route and of all requests."""
+        routes = {
+            name: {
+                "requests": len(self.latencies[name]),
+                "errors": self.errors[name],
+                **latency_summary(self.latencies[name]),
+            }
+            for name in sorted(set(self.latencies) | set(self.errors))
+        }
+        all_latencies = [latency for latencies in self.latencies.values() for latency in latencies]
+        return {
+            "requests": len(all_latencies),
+            "errors": sum(self.errors.values()),
+            "latency": latency_summary(all_latencies),
+            "routes": routes,
+        }
+
+
+def generated_answer(response: httpx.Response | None) -> dict | None:
+    r"""Return answer of generate or the last update of streamed generate."""
+    if response is None:
+        return None
+    lines = [line for line in response.text.splitlines() if line]
+    return json.loads(lines[-1]) if lines else None
+
+
+async def synthetic_session(
+    client: httpx.AsyncClient,
+    recorder: Recorder,
+    session: str,
+    user_id: str,
+    turns: int,
+    context_size: int,
+) -> None:
+    r"""
+    Send conversation of one user through all routes
+    Args:
+        client: client of service
+        recorder: recorder of requests
+        session: id of session
+        user_id: id of seeded user
+        turns: number of generate requests
+        context_size: limit of context requests
+    """
+    rng = random.Random(session)
+    lines = synthetic_lines(turns, rng.randrange(1 << 30))
+    await recorder.send(
+        client, session, "GET", f"/users/{user_id}/context", params={"limit": context_size}
+    )
+    for line in lines:
+        if rng.random() < STREAM_SHARE:
+            response = await recorder.send(
+                client,
+                session,
+                "PATCH",
+                f"/users/{user_id}/context/generate/stream",
+                params={"stream_format": "ndjson"},
+                json={"text": line},
+            )
+        else:
+            response = await recorder.send(
+                client, session, "PATCH", f"/users/{user_id}/context/generate", json={"text": line}
+            )
+        answer = generated_answer(response)
+        if answer is None:
+            continue
+
+        answer_id = answer["answer_id"]
+        candidate_ids = [str(ObjectId()) for _ in answer["messages"]]
+        await recorder.send(
+            client,
+            session,
+            "POST",
+            f"/users/{user_id}/context/{ANSWER_ID}/possible_contexts_ids",
+            answer_id,
+            json={"possible_contexts_ids": candidate_ids},
+        )
+        if rng.random() < CUSTOM_ANSWER_SHARE:
+            await recorder.send(
+                client,
+                session,
+                "POST",
+                f"/users/{user_id}/context/messages/custom_answer",
+                json={"message_id": candidate_ids[0], "custom_text": rng.choice(lines)},
+            )
+        else:
+            await recorder.send(
+                client,
+                session,
+                "POST",
+                f"/users/{user_id}/context/{ANSWER_ID}/user_choice",
+                answer_id,
+                json={"message_id": rng.choice(candidate_ids)},
+            )
+        if rng.random() < READ_CONTEXT_SHARE:
+            await recorder.send(
+                client,
+                session,
+                "GET",
+                f"/users/{user_id}/context",
+                params={"limit": context_size},
+            )
+
+    await recorder.send(client, session, "GET", f"/users/{user_id}")
+    await recorder.send(
+        client,
+        session,
+        "GET",
+        "/users",
+        params={"after": user_id, "limit": 20, "include_history": "false"},
+    )
+    if rng.random() < CLEAR_HISTORY_SHARE:
+        await recorder.send(client, session, "DELETE", f"/users/{user_id}/context")
+    new_user_id = f"new-{session}"
+    await recorder.send(
+        client,
+        session,
+        "POST",
+        "/users",
+        json={"user_id": new_user_id, "username": new_user_id, "chat_id": new_user_id},
+    )
+    await recorder.send(client, session, "DELETE", f"/users/{new_user_id}")
+
+
+async def replayed_session(
+    client: httpx.AsyncClient, recorder: Recorder, session: str, requests: list[dict]
+) -> None:
+    r"""
+    Send recorded requests of one session in order
+    Args:
+        client: client of service
+        recorder: recorder of requests
+        session: id of session
+        requests: recorded requests
+    """
+    answer_id = None
+    for request in requests:
+        response = await recorder.send(
+            client,
+            session,
+            request["method"],
+            request["path"],
+            answer_id,
+            **{key: request[key] for key in ("json", "params") if key in request},
+        )
+        if request["path"].endswith(("/generate", "/generate/stream")):
+            answer = generated_answer(response)
+            answer_id = answer["answer_id"] if answer else None
+
+
+def read_replay(path: str) -> dict[str, list[dict]]:
+    r"""Return recorded requests grouped by session."""
+    sessions: dict[str, list[dict]] = defaultdict(list)
+    with open(path, encoding="UTF-8") as replay:
+        for line in replay:
+            if line.strip():
+                request = json.loads(line)
+                sessions[str(request.get("session", "0"))].append(request)
+    return sessions
+
+
+async def run_traffic(base_url: str, args: argparse.Namespace, users: int) -> dict:
+    r"""
+    Run sessions with at most args.concurrency of them at once
+    Args:
+        base_url: url of service
+        args: command line arguments
+        users: number of seeded users
+    """
+    recorder = Recorder(recorded=[] if args.record else None)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=600) as client:
+
+        async def limited(session) -> None:
+            async with semaphore:
+                await session
+
+        if args.replay:
+            sessions = [
+                replayed_session(client, recorder, session, requests)
+                for session, requests in read_replay(args.replay).items()
+            ]
+        else:
+            rng = random.Random(0)
+            user_ids = [benchmark_user_id(rng.randrange(users)) for _ in range(args.sessions)]
+            sessions = [
+                synthetic_session(
+                    client, recorder, str(index), user_id, args.turns, args.context_size
+                )
+                for index, user_id in enumerate(user_ids)
+            ]
+        started_at = time.perf_counter()
+        await asyncio.gather(*[limited(session) for session in sessions])
+        duration = time.perf_counter() - started_at
+
+    if args.record:
+        with open(args.record, "w", encoding="UTF-8") as record:
+            for request in recorder.recorded:
+                record.write(json.dumps(request, ensure_ascii=False) + "\n")
+    summary = recorder.summary()
+    summary["duration_seconds"] = round(duration, 2)
+    summary["rps"] = round(summary["requests"] / duration, 2) if duration else None
+    return summary
+
+
+def service_env(args: argparse.Namespace, llm_url: str, tokenizer_path: str) -> dict:
+    r"""Return environment of service process, --env values override defaults."""
+    env = {
+        **os.environ,
+        "DATABASE_BACKEND": "memory",
+        "DATABASE_CONNECTION_STRING": "memory://",
+        "TABLE_NAME": "benchmark",
+        "TEMPLATE_PATH": TEMPLATE_PATH,
+        "MODEL_NAME": "toy",
+        "TOKENIZER_PATH": tokenizer_path,
+        "LM_API_ADDRESS": llm_url,
+        "CONTEXT_SIZE": str(args.context_size),
+        "LOG_PROMPTS": "0",
+    }
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    for value in args.env:
+        key, _, value = value.partition("=")
+        env[key] = value
+    return env
+
+
+def parse_sizes(value: str) -> list[int]:
+    r"""Parse comma separated sizes."""
+    return [int(size) for size in value.split(",")]
+
+
+def run_scenarios(args: argparse.Namespace, llm_url: str, tokenizer_path: str) -> list[dict]:
+    r"""
+    Start service for every combination of users and history length and run traffic against it
+    Args:
+        args: command line arguments
+        llm_url: url of running stub LLM api
+        tokenizer_path: tokenizer snapshot passed to service
+    """
+    scenarios = []
+    for users in args.users:
+        for history in args.history:
+            port = free_port()
+            command = [
+                sys.executable,
+                "-m",
+                "benchmarks.serve",
+                f"--port={port}",
+                f"--users={users}",
+                f"--history={history}",
+            ]
+            env = service_env(args, llm_url, tokenizer_path)
+            base_url = f"http://127.0.0.1:{port}"
+            with running_process(command, env, f"{base_url}/ready") as service:
+                log.info("Run traffic with %s users of %s messages", users, history)
+                result = asyncio.run(run_traffic(base_url, args, users))
+                result["peak_rss_mb"] = peak_rss_mb(service.pid)
+            scenarios.append({"users": users, "history": history, **result})
+    return scenarios
+
+
+def print_results(scenarios: list[dict]) -> None:
+    r"""Print table of scenario results."""
+    print(
+        f"{'users':>8}{'history':>9}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}", end=""
+    )
+    print(f"{'errors':>8}{'peak MB':>10}")
+    for scenario in scenarios:
+        latency = scenario["latency"]
+        print(
+            f"{scenario['users']:>8}{scenario['history']:>9}{scenario['rps']:>10}"
+            f"{latency['p50_ms']:>10}{latency['p95_ms']:>10}{latency['p99_ms']:>10}"
+            f"{scenario['errors']:>8}{scenario['peak_rss_mb']!s:>10}"
+        )
+
+
+def main():
+    r"""Run traffic for every combination of users and history length and save results."""
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0], formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--users", type=parse_sizes, default=[100], help="e.g. 10,100,1000")
+    parser.add_argument("--history", type=parse_sizes, default=[0, 100], help="e.g. 0,100")
+    parser.add_argument("--sessions", type=int, default=50, help="synthetic sessions")
+    parser.add_argument("--turns", type=int, default=5, help="generate requests of session")
+    parser.add_argument("--concurrency", type=int, default=16, help="sessions run at once")
+    parser.add_argument("--context-size", type=int, default=10, help="CONTEXT_SIZE of service")
+    parser.add_argument("--llm-latency-ms", type=float, default=50)
+    parser.add_argument("--llm-jitter-ms", type=float, default=10)
+    parser.add_argument("--tokenizer-path", help="tokenizer snapshot, toy tokenizer by default")
+    parser.add_argument("--replay", help="JSON lines file of recorded sessions")
+    parser.add_argument("--record", help="write sent requests to JSON lines file")
+    parser.add_argument(
+        "--env", action="append", default=[], help="KEY=VALUE passed to service, repeatable"
+    )
+    parser.add_argument("--output", help="JSON file of results")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        tokenizer_path = args.tokenizer_path
+        if tokenizer_path is None:
+            tokenizer_path = os.path.join(workdir, "tokenizer")
+            build_toy_tokenizer().save_pretrained(tokenizer_path)
+
+        llm_port = free_port()
+        llm_url = f"http://127.0.0.1:{llm_port}"
+        llm_command = [
+            sys.executable,
+            "-m",
+            "benchmarks.stub_llm",
+            f"--port={llm_port}",
+            f"--latency-ms={args.llm_latency_ms}",
+            f"--jitter-ms={args.llm_jitter_ms}",
+        ]
+        with running_process(llm_command, dict(os.environ), f"{llm_url}/health"):
+            scenarios = run_scenarios(args, llm_url, tokenizer_path)
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "record")}
+    results = {"config": config, "scenarios": scenarios}
+    if args.output:
+        with open(args.output, "w", encoding="UTF-8") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+            output.write("\n")
+
+    print_results(scenarios)
+
+
+if __name__ == "__main__":
+    main()
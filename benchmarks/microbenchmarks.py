@@ -0,0 +1,267 @@
+"""Measure CPU-heavy hot paths of prompt building and BSON mapping and gate their regressions.
+
+Every case runs for every history length and message size with toy tokenizer, or with snapshot
+passed by --tokenizer-path. Times are divided by time of a fixed pure Python loop measured in the
+same run, so baseline saved on one machine can be checked on another one:
+
+    python -m benchmarks.microbenchmarks --save-baseline
+    python -m benchmarks.microbenchmarks --threshold 0.2  # exit code 1 when a case got slower
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import timeit
+from collections.abc import Callable
+
+from bson.objectid import ObjectId
+from transformers import AutoTokenizer, PreTrainedTokenizer
+
+from benchmarks.toy_tokenizer import WORDS, build_toy_tokenizer
+from data.user_context import BaseMessage, ModelAnswer, RoleEnum, User
+from database.mongo import BASE_PROMPT, new_user_document
+from language_model.Chat import Conversation
+from utils.logger import get_pylogger
+
+log = get_pylogger(__name__)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATE_PATH = os.path.join(ROOT, "templates", "chat_conversation_template.json")
+DEFAULT_BASELINE = os.path.join(ROOT, "benchmarks", "microbenchmarks_baseline.json")
+PROMPT_MAX_TOKENS = 512
+CALIBRATION_LOOPS = 100_000
+# cases slower than threshold are measured again before run fails, noisy machine rarely repeats
+CONFIRM_ATTEMPTS = 2
+# slowdown below this many calibration units, about 15 us, is timer and allocator noise, cases
+# taking a few microseconds change by more than any threshold between runs of the same code
+MIN_DELTA = 0.002
+
+
+def calibration() -> None:
+    r"""Fixed pure Python work, its time is the unit of all results."""
+    total = 0
+    for idx in range(CALIBRATION_LOOPS):
+        total += idx % 7
+    str(total).encode()
+
+
+def message_text(size: int, seed: int) -> str:
+    r"""Return text of about size characters."""
+    words = []
+    length = 0
+    while length < size:
+        word = WORDS[(seed + len(words) * 7) % len(WORDS)]
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:size]
+
+
+def conversation_history(history: int, size: int) -> list[BaseMessage]:
+    r"""Return alternating user questions and model answers with three candidates."""
+    messages: list[BaseMessage] = []
+    for idx in range(history):
+        text = message_text(size, idx)
+        if idx % 2 == 0:
+            messages.append(BaseMessage(id=str(ObjectId()), role=RoleEnum.user, context=text))
+        else:
+            candidates = [text, message_text(size, idx + 1), message_text(size, idx + 2)]
+            messages.append(
+                ModelAnswer(
+                    id=str(ObjectId()),
+                    role=RoleEnum.bot,
+                    context=text,
+                    possible_contexts=candidates,
+                    possible_contexts_ids=[str(ObjectId()) for _ in candidates],
+                )
+            )
+    return messages
+
+
+def benchmark_cases(
+    tokenizer: PreTrainedTokenizer, history: int, size: int
+) -> dict[str, Callable[[], object]]:
+    r"""
+    Return hot path calls for history of given length and message size
+    Args:
+        tokenizer: tokenizer of prompts
+        history: number of messages
+        size: characters of every message
+    """
+    system_prompt = BaseMessage(id=RoleEnum.system, role=RoleEnum.system, context=BASE_PROMPT)
+    messages = conversation_history(history, size)
+    question = BaseMessage(id=str(ObjectId()), role=RoleEnum.user, context=message_text(size, 0))
+    template = Conversation.from_template(TEMPLATE_PATH, system_prompt=BASE_PROMPT)
+    expanded = Conversation(template.message_template, BASE_PROMPT)
+    expanded.expand([system_prompt] + messages + [question])
+    document = new_user_document("user", "user", "user")
+    document["_id"] = ObjectId()
+    document["context"] = [message.to_bson() for message in messages]
+    answer = messages[-1] if history > 1 else question
+
+    def new_conversation() -> Conversation:
+        conversation = Conversation(template.message_template, BASE_PROMPT)
+        conversation.expand([system_prompt] + messages + [question])
+        return conversation
+
+    return {
+        "Conversation.expand": new_conversation,
+        "Conversation.shrink": lambda: expanded.shrink(
+            tokenizer, expanded.messages, PROMPT_MAX_TOKENS
+        ),
+        "Conversation.get_prompt_for_generate": lambda: new_conversation().get_prompt_for_generate(
+            tokenizer, PROMPT_MAX_TOKENS
+        ),
+        "User.from_bson": lambda: User.from_bson(document),
+        "User.from_bson.to_bson": lambda: User.from_bson(document).to_bson(),
+        "User.from_bson.iterate": lambda: list(User.from_bson(document).context),
+        "update_user_text.to_bson": lambda: [text.to_bson() for text in (question, answer)],
+    }
+
+
+def measure(call: Callable[[], object], repeat: int) -> float:
+    r"""Return the best time of one call in seconds."""
+    timer = timeit.Timer(call)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def collect_cases(
+    tokenizer: PreTrainedTokenizer,
+    histories: list[int],
+    sizes: list[int],
+    name_filter: str | None = None,
+) -> dict[str, Callable[[], object]]:
+    r"""
+    Return calls of all cases by case name
+    Args:
+        tokenizer: tokenizer of prompts
+        histories: history lengths
+        sizes: message sizes in characters
+        name_filter: only cases containing this substring are returned
+    """
+    cases = {}
+    for history in histories:
+        for size in sizes:
+            for name, call in benchmark_cases(tokenizer, history, size).items():
+                case = f"{name}[history={history},size={size}]"
+                if not name_filter or name_filter in case:
+                    cases[case] = call
+    return cases
+
+
+def run(cases: dict[str, Callable[[], object]], repeat: int) -> dict[str, float]:
+    r"""
+    Measure cases and return their times in calibration units
+    Args:
+        cases: calls by case name
+        repeat: measurements of every case, the best one is kept
+    """
+    unit = measure(calibration, repeat)
+    results = {}
+    for case, call in cases.items():
+        seconds = measure(call, repeat)
+        results[case] = round(seconds / unit, 6)
+        log.info("%s: %.1f us", case, seconds * 1e6)
+    return results
+
+
+def find_regressions(
+    results: dict[str, float], baseline: dict, threshold: float, min_delta: float = MIN_DELTA
+) -> list[str]:
+    r"""
+    Return cases slower than baseline by more than threshold and by more than min_delta
+    Args:
+        results: results of this run
+        baseline: stored results
+        threshold: allowed relative slowdown, e.g. 0.2 for 20%
+        min_delta: allowed absolute slowdown in calibration units
+    """
+    return [
+        case
+        for case, value in results.items()
+        if case in baseline["cases"]
+        and value - baseline["cases"][case] > max(threshold * baseline["cases"][case], min_delta)
+    ]
+
+
+def print_comparison(results: dict[str, float], baseline: dict, regressions: list[str]) -> None:
+    r"""Print relative change of every case."""
+    print(f"{'case':<64}{'baseline':>12}{'current':>12}{'change':>10}")
+    for case, value in results.items():
+        base_value = baseline["cases"].get(case)
+        if base_value is None:
+            print(f"{case:<64}{'-':>12}{value:>12.4f}{'new':>10}")
+            continue
+        marker = " REGRESSION" if case in regressions else ""
+        change = value / base_value - 1
+        print(f"{case:<64}{base_value:>12.4f}{value:>12.4f}{change:>+10.1%}{marker}")
+
+
+def parse_sizes(value: str) -> list[int]:
+    r"""Parse comma separated sizes."""
+    return [int(size) for size in value.split(",")]
+
+
+def main():
+    r"""Run microbenchmarks and compare them with baseline or save them as new baseline."""
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0], formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--histories", type=parse_sizes, default=[10, 100, 1000])
+    parser.add_argument("--sizes", type=parse_sizes, default=[50, 1000], help="message chars")
+    parser.add_argument("--repeat", type=int, default=5, help="measurements of every case")
+    parser.add_argument("--filter", help="measure only cases containing this substring")
+    parser.add_argument("--tokenizer-path", help="tokenizer snapshot, toy tokenizer by default")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="JSON file of baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="overwrite baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown share")
+    parser.add_argument(
+        "--min-delta", type=float, default=MIN_DELTA, help="allowed slowdown in calibration units"
+    )
+    args = parser.parse_args()
+
+    if args.tokenizer_path:
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path, local_files_only=True)
+    else:
+        tokenizer = build_toy_tokenizer()
+    cases = collect_cases(tokenizer, args.histories, args.sizes, args.filter)
+    results = run(cases, args.repeat)
+    tokenizer_name = args.tokenizer_path or "toy"
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="UTF-8") as output:
+            json.dump(
+                {"tokenizer": tokenizer_name, "cases": results}, output, indent=2, sort_keys=True
+            )
+            output.write("\n")
+        log.info("Saved baseline to %s", args.baseline)
+        return
+    if not os.path.exists(args.baseline):
+        log.error("Baseline %s does not exist, save it by --save-baseline", args.baseline)
+        sys.exit(2)
+
+    with open(args.baseline, encoding="UTF-8") as stored:
+        baseline = json.load(stored)
+    if baseline.get("tokenizer") != tokenizer_name:
+        log.warning("Baseline was measured with tokenizer %s", baseline.get("tokenizer"))
+    regressions = find_regressions(results, baseline, args.threshold, args.min_delta)
+    for _ in range(CONFIRM_ATTEMPTS):
+        if not regressions:
+            break
+        log.info("Measure again %s cases slower than baseline", len(regressions))
+        remeasured = run({case: cases[case] for case in regressions}, args.repeat)
+        for case, value in remeasured.items():
+            results[case] = min(results[case], value)
+        regressions = find_regressions(results, baseline, args.threshold, args.min_delta)
+    print_comparison(results, baseline, regressions)
+    if regressions:
+        log.error(
+            "%s cases are slower by more than %.0f%%", len(regressions), args.threshold * 100
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Run service against in-memory database seeded with synthetic users.
+
+Service is configured by the same environment as app.py, DATABASE_BACKEND must be memory. Users
+are created before the first request is accepted, every one with history messages:
+
+    DATABASE_BACKEND=memory ... python -m benchmarks.serve --users 100 --history 50 --port 8000
+"""
+from __future__ import annotations
+
+import argparse
+import random
+
+import uvicorn
+from bson.objectid import ObjectId
+
+from benchmarks.toy_tokenizer import synthetic_lines
+from data.user_context import BaseMessage, ModelAnswer, RoleEnum
+from database.Interface import DataBase
+from utils.logger import get_pylogger
+
+log = get_pylogger(__name__)
+
+SEED_BATCH_SIZE = 1000
+
+
+def benchmark_user_id(index: int) -> str:
+    r"""Return id of seeded user, ids are sorted in order of index."""
+    return f"user-{index:06d}"
+
+
+def seed_users(database: DataBase, users: int, history: int, seed: int = 0) -> None:
+    r"""
+    Create users with history of questions and model answers having three candidates each
+    Args:
+        database: database to fill
+        users: number of users
+        history: number of messages of every user
+        seed: seed of random generator
+    """
+    rng = random.Random(seed)
+    lines = synthetic_lines(1000, seed)
+    updates: list[tuple[str, list[BaseMessage]]] = []
+    for index in range(users):
+        user_id = benchmark_user_id(index)
+        database.create_user(user_id=user_id, username=user_id, chat_id=user_id)
+        messages: list[BaseMessage] = []
+        for position in range(history):
+            if position % 2 == 0:
+                messages.append(BaseMessage(str(ObjectId()), RoleEnum.user, rng.choice(lines)))
+                continue
+            candidates = rng.sample(lines, 3)
+            candidate_ids = [str(ObjectId()) for _ in candidates]
+            messages.append(
+                ModelAnswer(
+                    id=str(ObjectId()),
+                    role=RoleEnum.bot,
+                    context=candidates[0],
+                    possible_contexts=candidates,
+                    user_choice=candidate_ids[0],
+                    possible_contexts_ids=candidate_ids,
+                )
+            )
+        if messages:
+            updates.append((user_id, messages))
+        if len(updates) >= SEED_BATCH_SIZE:
+            database.update_users_texts(updates)
+            updates = []
+    database.update_users_texts(updates)
+    log.info("Seeded %s users with %s messages each", users, history)
+
+
+def main():
+    r"""Seed in-memory database on startup and serve requests until interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--users", type=int, default=100, help="number of seeded users")
+    parser.add_argument("--history", type=int, default=0, help="messages of every seeded user")
+    args = parser.parse_args()
+
+    # pylint: disable=import-outside-toplevel
+    import app as service
+
+    open_database = service.open_database
+
+    def open_seeded_database() -> None:
+        open_database()
+        seed_users(service.storage, args.users, args.history)
+
+    # lifespan opens database in served process, users are seeded right after that
+    service.open_database = open_seeded_database
+    uvicorn.run(service.app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
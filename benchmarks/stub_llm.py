@@ -0,0 +1,106 @@
+"""Serve stand-in of LLM generation api answering after configurable latency.
+
+Answers are random words, generation takes latency-ms plus uniform jitter. Batch of prompts takes
+the same time as one prompt, stream sends its updates evenly over that time:
+
+    python -m benchmarks.stub_llm --port 8001 --latency-ms 200 --jitter-ms 50
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import random
+from collections.abc import AsyncIterator
+
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel  # pylint: disable=no-name-in-module
+
+from benchmarks.toy_tokenizer import WORDS
+
+DEFAULT_CANDIDATES = 3
+DEFAULT_ANSWER_WORDS = 20
+DEFAULT_STREAM_UPDATES = 5
+
+
+class GenerateBody(BaseModel):
+    text: str
+
+
+class GenerateBatchBody(BaseModel):
+    texts: list[str]
+
+
+def create_stub_llm(
+    latency_ms: float,
+    jitter_ms: float = 0,
+    candidates: int = DEFAULT_CANDIDATES,
+    answer_words: int = DEFAULT_ANSWER_WORDS,
+    stream_updates: int = DEFAULT_STREAM_UPDATES,
+) -> FastAPI:
+    r"""
+    Create application with routes of LLM generation api
+    Args:
+        latency_ms: time of every generation
+        jitter_ms: max random time added to generation
+        candidates: number of answers generated for prompt
+        answer_words: number of words in every answer
+        stream_updates: number of updates sent by stream
+    """
+    stub = FastAPI()
+
+    def generation_seconds() -> float:
+        return (latency_ms + random.uniform(0, jitter_ms)) / 1000
+
+    def answers(words: int = answer_words) -> dict:
+        return {"texts": [" ".join(random.choices(WORDS, k=words)) for _ in range(candidates)]}
+
+    @stub.get("/health")
+    def health():
+        return {"status": "ok"}
+
+    @stub.post("/generate")
+    async def generate(body: GenerateBody):  # pylint: disable=unused-argument
+        await asyncio.sleep(generation_seconds())
+        return answers()
+
+    @stub.post("/generate_batch")
+    async def generate_batch(body: GenerateBatchBody):
+        await asyncio.sleep(generation_seconds())
+        return {"results": [answers() for _ in body.texts]}
+
+    @stub.post("/generate_stream")
+    async def generate_stream(body: GenerateBody):  # pylint: disable=unused-argument
+        update_seconds = generation_seconds() / stream_updates
+
+        async def updates() -> AsyncIterator[str]:
+            for update in range(1, stream_updates + 1):
+                await asyncio.sleep(update_seconds)
+                yield json.dumps(answers(answer_words * update // stream_updates)) + "\n"
+
+        return StreamingResponse(updates(), media_type="application/x-ndjson")
+
+    return stub
+
+
+def main():
+    r"""Run stub LLM api until interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency-ms", type=float, default=200, help="time of generation")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="max random extra time")
+    parser.add_argument("--candidates", type=int, default=DEFAULT_CANDIDATES)
+    parser.add_argument("--answer-words", type=int, default=DEFAULT_ANSWER_WORDS)
+    args = parser.parse_args()
+
+    stub = create_stub_llm(
+        args.latency_ms, args.jitter_ms, args.candidates, args.answer_words, DEFAULT_STREAM_UPDATES
+    )
+    uvicorn.run(stub, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
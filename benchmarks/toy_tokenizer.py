@@ -0,0 +1,75 @@
+"""Build small byte-level BPE tokenizer standing in for the model tokenizer in benchmarks.
+
+It has the same special tokens as the service template and is trained on synthetic Russian and
+English chat lines, so it needs neither Hugging Face Hub nor model weights:
+
+    python -m benchmarks.toy_tokenizer --output /tmp/toy_tokenizer
+"""
+from __future__ import annotations
+
+import argparse
+import random
+
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors, trainers
+from transformers import PreTrainedTokenizerFast
+
+from database.mongo import BASE_PROMPT
+from utils.logger import get_pylogger
+
+log = get_pylogger(__name__)
+
+VOCAB_SIZE = 2000
+SPECIAL_TOKENS = ["<unk>", "<s>", "</s>"]
+WORDS = (
+    "привет как дела что нового да нет хорошо спасибо пока завтра сегодня вечером работа "
+    "hi how are you what is up fine thanks ok lol see you tomorrow tonight work bot user"
+).split()
+
+
+def synthetic_lines(count: int, seed: int = 0) -> list[str]:
+    r"""
+    Return chat lines of random words, the same for the same seed
+    Args:
+        count: number of lines
+        seed: seed of random generator
+    """
+    rng = random.Random(seed)
+    return [" ".join(rng.choices(WORDS, k=rng.randint(3, 30))) for _ in range(count)]
+
+
+def build_toy_tokenizer(vocab_size: int = VOCAB_SIZE) -> PreTrainedTokenizerFast:
+    r"""
+    Train tokenizer on synthetic lines
+    Args:
+        vocab_size: max number of tokens
+    """
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=SPECIAL_TOKENS,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(synthetic_lines(2000) + [BASE_PROMPT], trainer)
+    # bos token is added as model tokenizer does
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="<s> $A", special_tokens=[("<s>", SPECIAL_TOKENS.index("<s>"))]
+    )
+    tokenizer.decoder = decoders.ByteLevel()
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>", unk_token="<unk>"
+    )
+
+
+def main():
+    r"""Save toy tokenizer snapshot loadable by TOKENIZER_PATH."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", required=True, help="directory of tokenizer snapshot")
+    args = parser.parse_args()
+
+    build_toy_tokenizer().save_pretrained(args.output)
+    log.info("Saved toy tokenizer to %s", args.output)
+
+
+if __name__ == "__main__":
+    main()
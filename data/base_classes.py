@@ -1,12 +1,15 @@
 # pylint: disable=no-name-in-module
 
 from dataclasses import dataclass
+from typing import Optional
 
 from pydantic import BaseModel
 
 
 class GenerateRequest(BaseModel):
     text: str
+    # pydantic evaluates annotations, X | None needs Python 3.10
+    template_name: Optional[str] = None  # pylint: disable=consider-alternative-union-syntax
 
 
 class SetMessagePossibleContextIds(BaseModel):
@@ -1,8 +1,29 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from collections.abc import Iterator, Sequence
+from dataclasses import dataclass, field, fields
 
 
+def add_slots(cls):
+    r"""
+    Recreate dataclass with __slots__, so its instances have no __dict__. Python 3.9 has no
+    slots argument of dataclass decorator
+    Args:
+        cls: dataclass, fields of its dataclass parents must be slotted already
+    """
+    inherited = {name for base in cls.__mro__[1:] for name in getattr(base, "__slots__", ())}
+    names = tuple(item.name for item in fields(cls) if item.name not in inherited)
+    namespace = dict(cls.__dict__)
+    for name in names:
+        # defaults are kept by dataclass in __init__, class attributes would shadow the slots
+        namespace.pop(name, None)
+    namespace.pop("__dict__", None)
+    namespace.pop("__weakref__", None)
+    namespace["__slots__"] = names
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+
+@add_slots
 @dataclass
 class User:
     r"""Class hold whole user information."""
@@ -12,21 +33,22 @@ class User:
     chat_id: str
     current_context_start_idx: int
     system_prompt: BaseMessage
-    context: list[BaseMessage]
+    context: Sequence[BaseMessage]
 
     @classmethod
-    def from_bson(cls, user_bson):
-        user_bson = user_bson.copy()
-        user_bson.pop("_id")
-        context = []
-        for o in user_bson["context"]:
-            context.append(BaseMessage(role=o["role"], context=o["context"], id=o["id"]))
+    def from_bson(cls, user_bson: dict) -> User:
+        r"""
+        Build user from stored document without copying it, messages are decoded on access
+        Args:
+            user_bson: user document
+        """
         if "system_prompt" in user_bson:
             system_prompt_bson = user_bson["system_prompt"]
             system_prompt = BaseMessage(
                 role=system_prompt_bson["role"],
                 context=system_prompt_bson["context"],
                 id=system_prompt_bson["id"],
+                token_count=system_prompt_bson.get("token_count"),
             )
         else:
             system_prompt = BaseMessage(role="", context="", id="")
@@ -36,10 +58,25 @@ class User:
             username=user_bson["username"],
             chat_id=user_bson["chat_id"],
             system_prompt=system_prompt,
-            context=context,
+            context=LazyMessages(user_bson.get("context", [])),
             current_context_start_idx=user_bson["current_context_start_idx"],
         )
 
+    def to_bson(self) -> dict:
+        r"""Return user document, the same as dataclasses.asdict does but without deep copy."""
+        if isinstance(self.context, LazyMessages):
+            context = self.context.to_bson()
+        else:
+            context = [message.to_bson() for message in self.context]
+        return {
+            "user_id": self.user_id,
+            "username": self.username,
+            "chat_id": self.chat_id,
+            "current_context_start_idx": self.current_context_start_idx,
+            "system_prompt": self.system_prompt.to_bson(),
+            "context": context,
+        }
+
 
 class RoleEnum:
     system = "system"
@@ -47,17 +84,129 @@ class RoleEnum:
     user = "user"
 
 
+@add_slots
 @dataclass
 class BaseMessage:
     r"""Class hold user messages."""
     id: str
     role: str
     context: str
+    token_count: int | None = None
+
+    def to_bson(self) -> dict:
+        r"""Return message document."""
+        return {
+            "id": self.id,
+            "role": self.role,
+            "context": self.context,
+            "token_count": self.token_count,
+        }
 
 
+@add_slots
 @dataclass
 class ModelAnswer(BaseMessage):
     r"""Class hold model answer with user choice."""
-    possible_contexts: list[str]
-    user_choice: bool
-    possible_contexts_ids: list[str] | None
+    possible_contexts: list[str] = field(default_factory=list)
+    user_choice: bool = False
+    possible_contexts_ids: list[str] | None = None
+
+    def to_bson(self) -> dict:
+        r"""Return message document with candidates."""
+        return {
+            "id": self.id,
+            "role": self.role,
+            "context": self.context,
+            "token_count": self.token_count,
+            "possible_contexts": list(self.possible_contexts),
+            "user_choice": self.user_choice,
+            "possible_contexts_ids": (
+                None if self.possible_contexts_ids is None else list(self.possible_contexts_ids)
+            ),
+        }
+
+
+class LazyMessages(Sequence):
+    r"""
+    Read-only messages of user document, message is built on first access and kept. Like
+    User.from_bson always did, candidates of stored answers are not read
+    Args:
+        documents: stored message documents, they are not copied
+    """
+
+    __slots__ = ("documents", "messages")
+
+    def __init__(self, documents: list[dict]):
+        self.documents = documents
+        self.messages: list[BaseMessage | None] = [None] * len(documents)
+
+    def _message(self, index: int) -> BaseMessage:
+        message = self.messages[index]
+        if message is None:
+            document = self.documents[index]
+            message = BaseMessage(
+                document["id"], document["role"], document["context"], document.get("token_count")
+            )
+            self.messages[index] = message
+        return message
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._message(idx) for idx in range(len(self.documents))[index]]
+        return self._message(range(len(self.documents))[index])
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def __iter__(self) -> Iterator[BaseMessage]:
+        messages = self.messages
+        for idx, document in enumerate(self.documents):
+            message = messages[idx]
+            if message is None:
+                message = BaseMessage(
+                    document["id"],
+                    document["role"],
+                    document["context"],
+                    document.get("token_count"),
+                )
+                messages[idx] = message
+            yield message
+
+    def __add__(self, other: Sequence[BaseMessage]) -> list[BaseMessage]:
+        return [*self, *other]
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Sequence) or isinstance(other, str):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+    def __deepcopy__(self, memo: dict) -> list[BaseMessage]:
+        # dataclasses.asdict deep copies containers it does not know, JSON encoders need a list
+        return [
+            BaseMessage(message.id, message.role, message.context, message.token_count)
+            for message in self
+        ]
+
+    def to_bson(self) -> list[dict]:
+        r"""Return message documents, messages which were never accessed are not built."""
+        return [
+            {
+                "id": document["id"],
+                "role": document["role"],
+                "context": document["context"],
+                "token_count": document.get("token_count"),
+            }
+            if message is None
+            else message.to_bson()
+            for document, message in zip(self.documents, self.messages)
+        ]
+
+
+def message_from_bson(message_bson: dict) -> BaseMessage:
+    r"""Build user message or model answer from stored message document."""
+    if message_bson["role"] == RoleEnum.user:
+        return BaseMessage(**message_bson)
+    return ModelAnswer(**message_bson)
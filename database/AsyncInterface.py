@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+from collections.abc import AsyncIterator
+from typing import Any
+
+from data.user_context import BaseMessage, User
+
+
+class AsyncDataBase(ABC):
+    r"""Counterpart of DataBase awaited from event loop."""
+
+    @abstractmethod
+    async def get_all_users(self) -> Any:
+        r"""Return all users."""
+
+    @abstractmethod
+    async def iter_users(
+        self,
+        after_user_id: str | None = None,
+        limit: int | None = None,
+        include_history: bool = True,
+    ) -> AsyncIterator[User]:
+        r"""
+        Yield users sorted by user id, users are read from database while iterating
+        Args:
+            after_user_id: only users with greater user id are returned
+            limit: max number of users
+            include_history: if false, users are returned without messages
+        """
+        # abstract async generator, implementations are async generators too
+        yield
+
+    @abstractmethod
+    async def update_model_answer(self, user_id: str, message_id: str, content: str) -> Any:
+        r"""
+        Update model answer
+        Args:
+            user_id:
+            message_id:
+            content:
+        """
+
+    @abstractmethod
+    async def create_user(self, user_id: str, username: str | None, chat_id: str):
+        r"""
+        Create new user
+        Args:
+            user_id:
+            chat_id:
+            username:
+        """
+
+    @abstractmethod
+    async def get_object_id_by_user_id(self, user_id: str) -> Any:
+        r"""
+        Return Mongo database ID by user id
+        Args:
+            user_id: unique user id
+        """
+
+    @abstractmethod
+    async def update_user_text(self, user_id: str, texts: list[BaseMessage]) -> None:
+        r"""
+        Add conversation to exists user
+        Args:
+            user_id: unique user id
+            texts: Tuple of conversation parts
+        """
+
+    async def update_users_texts(self, updates: list[tuple[str, list[BaseMessage]]]) -> None:
+        r"""
+        Add conversations to exists users, updates of the same user are applied in order.
+        Default implementation is not idempotent, replayed updates are added again
+        Args:
+            updates: user id with conversation parts
+        """
+        for user_id, texts in updates:
+            await self.update_user_text(user_id=user_id, texts=texts)
+
+    @abstractmethod
+    async def remove_user(self, user_id: str) -> None:
+        r"""
+        Remove user by user id or doing nothing if it not exists
+        Args:
+            user_id: unique user id
+        """
+
+    @abstractmethod
+    async def get_user(self, user_id: str) -> User | None:
+        r"""
+        Get user object by object id
+        Args:
+            user_id: unique user id
+        """
+
+    @abstractmethod
+    async def get_context(
+        self, user_id: str, limit: int, max_tokens: int | None = None
+    ) -> tuple[BaseMessage, list[BaseMessage]]:
+        r"""Get user object by object id.
+
+        Args:
+            user_id: unique user id
+            limit: max number of messages
+            max_tokens: max sum of message token counts, oldest messages are dropped by pairs
+        """
+
+    @abstractmethod
+    async def clear_history(self, user_id: str) -> None:
+        r"""
+        Remove messages of user
+        Args:
+            user_id: User id passed to store in database
+        """
+
+    @abstractmethod
+    async def set_message_possible_context_ids(
+        self, user_id: str, answer_id: str, possible_contexts_ids: list[str]
+    ) -> None:
+        r"""
+        Update ids in message
+        Args:
+            user_id: User id passed to store in database
+            possible_contexts_ids: ids of model answer messages
+            answer_id: id of answer storing in database
+        """
+
+    @abstractmethod
+    async def update_user_choice(self, user_id: str, answer_id: str, user_choice_idx: str) -> str:
+        r"""
+        Update ids in message, raises ChoiceNotFoundError when answer or candidate is not found
+        Args:
+            user_id: User id passed to store in database
+            user_choice_idx: id of message user chosen
+            answer_id: answer id storing in DB
+        """
+
+    @abstractmethod
+    async def update_user_custom_choice(
+        self, user_id: str, message_choice_id: str, custom_text: str
+    ) -> None:
+        r"""
+        Update ids in message, raises ChoiceNotFoundError when no answer has the candidate
+        Args:
+            user_id: User id passed to store in database
+            custom_text: text of user variant of answer
+            message_choice_id: id of message that was variant of model output
+        """
@@ -1,11 +1,16 @@
 from __future__ import annotations
 
 from abc import ABC, abstractmethod
+from collections.abc import Iterator
 from typing import Any
 
 from data.user_context import BaseMessage, User
 
 
+class ChoiceNotFoundError(ValueError):
+    r"""Model answer chosen by user is not stored or it has no such candidate, e.g. expired."""
+
+
 class DataBase(ABC):
     @abstractmethod
     def __init__(self, connection_string: str, database_name: str, table_name: str):
@@ -15,6 +20,21 @@ class DataBase(ABC):
     def get_all_users(self) -> Any:
         r"""Return all users."""
 
+    @abstractmethod
+    def iter_users(
+        self,
+        after_user_id: str | None = None,
+        limit: int | None = None,
+        include_history: bool = True,
+    ) -> Iterator[User]:
+        r"""
+        Yield users sorted by user id, users are read from database while iterating
+        Args:
+            after_user_id: only users with greater user id are returned
+            limit: max number of users
+            include_history: if false, users are returned without messages
+        """
+
     @abstractmethod
     def update_model_answer(self, user_id: str, message_id: str, content: str) -> Any:
         r"""
@@ -61,6 +81,16 @@ class DataBase(ABC):
             texts: Tuple of conversation parts
         """
 
+    def update_users_texts(self, updates: list[tuple[str, list[BaseMessage]]]) -> None:
+        r"""
+        Add conversations to exists users, updates of the same user are applied in order.
+        Default implementation is not idempotent, replayed updates are added again
+        Args:
+            updates: user id with conversation parts
+        """
+        for user_id, texts in updates:
+            self.update_user_text(user_id=user_id, texts=texts)
+
     @abstractmethod
     def remove_user(self, user_id: str) -> None:
         r"""
@@ -78,12 +108,15 @@ class DataBase(ABC):
         """
 
     @abstractmethod
-    def get_context(self, user_id: str, limit: int) -> tuple[BaseMessage, list[BaseMessage]]:
+    def get_context(
+        self, user_id: str, limit: int, max_tokens: int | None = None
+    ) -> tuple[BaseMessage, list[BaseMessage]]:
         r"""Get user object by object id.
 
         Args:
             user_id: unique user id
             limit: max number of messages
+            max_tokens: max sum of message token counts, oldest messages are dropped by pairs
         """
 
     @abstractmethod
@@ -109,7 +142,7 @@ class DataBase(ABC):
     @abstractmethod
     def update_user_choice(self, user_id: str, answer_id: str, user_choice_idx: str) -> str:
         r"""
-        Update ids in message
+        Update ids in message, raises ChoiceNotFoundError when answer or candidate is not found
         Args:
             user_id: User id passed to store in database
             user_choice_idx: id of message user chosen
@@ -121,7 +154,7 @@ class DataBase(ABC):
         self, user_id: str, message_choice_id: str, custom_text: str
     ) -> None:
         r"""
-        Update ids in message
+        Update ids in message, raises ChoiceNotFoundError when no answer has the candidate
         Args:
             user_id: User id passed to store in database
             custom_text: text of user variant of answer
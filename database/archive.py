@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import zlib
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+import bson
+from bson.binary import Binary
+from pymongo import ReplaceOne
+
+ARCHIVE_SUFFIX = "_archive"
+# messages of one compressed chunk, bigger chunks compress better but are decoded at once
+ARCHIVE_CHUNK_SIZE = 500
+# messages moved by one archive call, the rest is moved by the next call
+ARCHIVE_MAX_MESSAGES = 5000
+COMPRESSION_LEVEL = 6
+CHUNK_CODEC = "zlib-bson"
+
+
+@dataclass
+class ArchivePlan:
+    r"""Writes moving cleared messages of one user into archive."""
+
+    chunks: list[ReplaceOne]
+    trim_filter: dict
+    trim_update: dict
+    count: int
+
+
+def archive_collection_name(table_name: str) -> str:
+    r"""Return name of collection with archived messages of users table."""
+    return table_name + ARCHIVE_SUFFIX
+
+
+def compress_messages(messages: list[dict]) -> Binary:
+    r"""Return message documents encoded as BSON and compressed by zlib."""
+    return Binary(zlib.compress(bson.encode({"messages": messages}), COMPRESSION_LEVEL))
+
+
+def decompress_messages(data: bytes) -> list[dict]:
+    r"""Return message documents of compressed chunk."""
+    return bson.decode(zlib.decompress(data))["messages"]
+
+
+def cleared_window_projection(max_messages: int) -> dict:
+    r"""
+    Return projection of user document reading its oldest messages with position of live window,
+    so archived messages and their positions come from one consistent read
+    Args:
+        max_messages: max number of read messages
+    """
+    return {
+        "_id": 0,
+        "current_context_start_idx": 1,
+        "archived_count": 1,
+        "context": {"$slice": max_messages},
+    }
+
+
+def archive_plan(user_id: str, document: dict, chunk_size: int) -> ArchivePlan | None:
+    r"""
+    Build writes moving messages before live window into archive, None when there are none.
+    Chunks are keyed by position of their first message among all messages of user, so writing
+    them again after interrupted archiving replaces them instead of adding duplicates. Messages
+    are removed only when nobody archived them in between
+    Args:
+        user_id: user id
+        document: user document read by cleared_window_projection
+        chunk_size: max number of messages in one chunk
+    """
+    messages = document.get("context", [])[: document["current_context_start_idx"]]
+    if not messages:
+        return None
+    archived_count = document.get("archived_count", 0)
+    archived_at = datetime.now(timezone.utc)
+    chunks = []
+    for start in range(0, len(messages), chunk_size):
+        chunk_messages = messages[start : start + chunk_size]
+        chunk_filter = {"user_id": user_id, "first_idx": archived_count + start}
+        chunk = {
+            **chunk_filter,
+            "count": len(chunk_messages),
+            "codec": CHUNK_CODEC,
+            "data": compress_messages(chunk_messages),
+            "archived_at": archived_at,
+        }
+        chunks.append(ReplaceOne(chunk_filter, chunk, upsert=True))
+
+    # null matches users archived for the first time, they have no archived_count field
+    trim_filter = {
+        "user_id": user_id,
+        "archived_count": archived_count if archived_count else {"$in": [0, None]},
+        f"context.{len(messages) - 1}.id": messages[-1]["id"],
+    }
+    # messages are pulled by ids, so messages appended after the read are kept
+    trim_update = {
+        "$pull": {"context": {"id": {"$in": [message["id"] for message in messages]}}},
+        "$inc": {"current_context_start_idx": -len(messages), "archived_count": len(messages)},
+    }
+    return ArchivePlan(chunks, trim_filter, trim_update, len(messages))
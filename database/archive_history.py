@@ -0,0 +1,82 @@
+"""Move cleared conversation history of users into compressed archive collection.
+
+Messages before current_context_start_idx are never read by generation. They are copied into
+`<TABLE_NAME>_archive` collection as zlib compressed chunks and removed from user document, so user
+document keeps only its live window. Chunks are written before messages are removed, so the job
+is safe to interrupt and run again, also while the service keeps serving requests:
+
+    python -m database.archive_history --min-messages 100
+    python -m database.archive_history --min-messages 100 --interval 3600  # run every hour
+
+Users of `embedded` and `async` storage are archived, `bucketed` storage is not supported.
+migrate_to_buckets copies archived messages from archive collection, so it may run meanwhile.
+"""
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+import time
+
+from database.archive import ARCHIVE_CHUNK_SIZE
+from database.mongo import MongoDataBase
+from utils.logger import get_pylogger
+
+log = get_pylogger(__name__)
+
+DATABASE_NAME = "chat"
+
+
+def archive_history(
+    database: MongoDataBase, min_messages: int = 1, chunk_size: int = ARCHIVE_CHUNK_SIZE
+) -> int:
+    r"""
+    Archive cleared messages of every user having at least min_messages of them
+    Args:
+        database: database with users to compact
+        min_messages: users with fewer cleared messages are skipped until they have more
+        chunk_size: max number of messages in one compressed chunk
+    Returns:
+        number of archived messages
+    """
+    archived = 0
+    cursor = database.collection.find(
+        {"current_context_start_idx": {"$gte": max(min_messages, 1)}}, {"_id": 0, "user_id": 1}
+    )
+    for document in cursor:
+        user_archived = 0
+        while True:
+            moved = database.archive_history(document["user_id"], chunk_size=chunk_size)
+            if not moved:
+                break
+            user_archived += moved
+        if user_archived:
+            log.info("Archived %s messages of user %s", user_archived, document["user_id"])
+        archived += user_archived
+    return archived
+
+
+def main():
+    r"""Archive cleared history using service environment variables."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--min-messages", type=int, default=1, help="min cleared messages")
+    parser.add_argument("--chunk-size", type=int, default=ARCHIVE_CHUNK_SIZE)
+    parser.add_argument("--interval", type=float, help="seconds between runs, runs once if unset")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    database = MongoDataBase(
+        connection_string=os.environ["DATABASE_CONNECTION_STRING"],
+        database_name=DATABASE_NAME,
+        table_name=os.environ["TABLE_NAME"],
+    )
+    while True:
+        archived = archive_history(database, args.min_messages, args.chunk_size)
+        log.info("Archive finished, %s messages archived", archived)
+        if args.interval is None:
+            return
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Fill token_count of messages saved before token counts were stored.
+
+Run from the repository root with the same environment as the service:
+
+    python -m database.backfill_token_counts
+"""
+from __future__ import annotations
+
+import logging
+import os
+
+from pymongo import UpdateOne
+from transformers import AutoTokenizer, PreTrainedTokenizer
+
+from database.mongo import MongoDataBase
+from language_model.Chat import Conversation
+from utils.logger import get_pylogger
+
+log = get_pylogger(__name__)
+
+DATABASE_NAME = "chat"
+
+
+def backfill_token_counts(
+    database: MongoDataBase,
+    conversation: Conversation,
+    tokenizer: PreTrainedTokenizer,
+    batch_size: int = 500,
+) -> int:
+    r"""
+    Store token count of every message formatted by conversation template
+    Args:
+        database: database with users to update
+        conversation: conversation built from the template used for generation
+        tokenizer: tokenizer of the served model
+        batch_size: max number of updates sent in one bulk write
+    Returns:
+        number of updated messages
+    """
+    updated = 0
+    # null matches both missing token_count and token_count stored as null
+    cursor = database.collection.find(
+        {"context": {"$elemMatch": {"token_count": {"$in": [None]}}}},
+        {
+            "_id": 0,
+            "user_id": 1,
+            "context.id": 1,
+            "context.role": 1,
+            "context.context": 1,
+            "context.token_count": 1,
+        },
+    )
+    for document in cursor:
+        missing = [
+            (idx, message)
+            for idx, message in enumerate(document["context"])
+            if message.get("token_count") is None
+        ]
+        messages = [
+            {
+                "role": conversation.role_mapping.get(message["role"], message["role"]),
+                "content": message["context"],
+            }
+            for _, message in missing
+        ]
+        token_counts = conversation.count_message_tokens(tokenizer, messages)
+
+        # message is matched by id too, so concurrent rewrite of context array is not broken
+        requests = [
+            UpdateOne(
+                {"user_id": document["user_id"], f"context.{idx}.id": message["id"]},
+                {"$set": {f"context.{idx}.token_count": token_count}},
+            )
+            for (idx, message), token_count in zip(missing, token_counts)
+        ]
+        for start in range(0, len(requests), batch_size):
+            result = database.collection.bulk_write(
+                requests[start : start + batch_size], ordered=False
+            )
+            updated += result.modified_count
+        log.info("Backfilled %s messages of user %s", len(requests), document["user_id"])
+    return updated
+
+
+def main():
+    r"""Backfill token counts using service environment variables."""
+    logging.basicConfig(level=logging.INFO)
+    database = MongoDataBase(
+        connection_string=os.environ["DATABASE_CONNECTION_STRING"],
+        database_name=DATABASE_NAME,
+        table_name=os.environ["TABLE_NAME"],
+    )
+    tokenizer = AutoTokenizer.from_pretrained(
+        os.environ["MODEL_NAME"], token=os.environ.get("HF_TOKEN")
+    )
+    conversation = Conversation.from_template(os.environ["TEMPLATE_PATH"], system_prompt="")
+    updated = backfill_token_counts(database, conversation, tokenizer)
+    log.info("Backfill finished, %s messages updated", updated)
+
+
+if __name__ == "__main__":
+    main()
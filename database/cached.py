@@ -0,0 +1,332 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterator
+from dataclasses import dataclass
+from typing import Any
+
+from data.user_context import BaseMessage, ModelAnswer, User
+from database.Interface import DataBase
+from database.utils import trim_to_token_budget
+
+# rough size of message object without its texts
+MESSAGE_OVERHEAD_BYTES = 256
+
+
+def message_size(message: BaseMessage) -> int:
+    r"""Return approximate memory used by message."""
+    size = MESSAGE_OVERHEAD_BYTES + len(message.context)
+    if isinstance(message, ModelAnswer):
+        size += sum(len(text) for text in message.possible_contexts)
+    return size
+
+
+@dataclass
+class _PendingLoad:
+    r"""Reads of user window in flight and number of writes of user made since they started."""
+
+    readers: int = 0
+    generation: int = 0
+
+
+@dataclass
+class CachedContext:
+    r"""System prompt and the newest messages of user."""
+
+    system_prompt: BaseMessage
+    messages: list[BaseMessage]
+    window_size: int
+    complete: bool
+    expires_at: float
+    size: int
+
+
+class CachedDataBase(DataBase):
+    r"""
+    Write-through cache of user context windows in front of another database.
+
+    Messages written by update_user_text are appended to cached window, so conversation of user
+    served by this instance does not read database. Other updates of user drop cached window,
+    writes made by other service instances are seen after ttl_seconds. Window read from database
+    is not cached when user was written while it was read, the read may miss that write.
+    """
+
+    def __init__(
+        self,
+        database: DataBase,
+        window_size: int,
+        max_users: int = 1024,
+        ttl_seconds: float = 300,
+        max_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.database = database
+        self.window_size = window_size
+        self.max_users = max_users
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries: OrderedDict[str, CachedContext] = OrderedDict()
+        # kept only for users with reads in flight
+        self._loads: dict[str, _PendingLoad] = {}
+        self._lock = threading.Lock()
+
+    def stats(self) -> dict:
+        r"""Return cache counters."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "users": len(self._entries),
+            "bytes": self.size,
+        }
+
+    def get_all_users(self) -> Any:
+        return self.database.get_all_users()
+
+    def iter_users(
+        self,
+        after_user_id: str | None = None,
+        limit: int | None = None,
+        include_history: bool = True,
+    ) -> Iterator[User]:
+        r"""
+        Yield users sorted by user id, users are read from database while iterating
+        Args:
+            after_user_id: only users with greater user id are returned
+            limit: max number of users
+            include_history: if false, users are returned without messages
+        """
+        return self.database.iter_users(after_user_id, limit, include_history)
+
+    def update_model_answer(self, user_id: str, message_id: str, content: str) -> Any:
+        r"""
+        Update model answer
+        Args:
+            user_id:
+            message_id:
+            content:
+        """
+        self._invalidate(user_id)
+        return self.database.update_model_answer(user_id, message_id, content)
+
+    def create_user(self, user_id: str, username: str | None, chat_id: str):
+        r"""
+        Create new user
+        Args:
+            user_id:
+            username:
+            chat_id:
+        """
+        return self.database.create_user(user_id=user_id, username=username, chat_id=chat_id)
+
+    def get_object_id_by_user_id(self, user_id: str) -> Any:
+        r"""
+        Return Mongo database ID by user id
+        Args:
+            user_id: unique user id
+        """
+        return self.database.get_object_id_by_user_id(user_id)
+
+    def update_user_text(self, user_id: str, texts: list[BaseMessage]) -> None:
+        r"""
+        Add conversation to exists user and to cached window
+        Args:
+            user_id: unique user id
+            texts: Tuple of conversation parts
+        """
+        self.database.update_user_text(user_id=user_id, texts=texts)
+        self._append(user_id, texts)
+
+    def update_users_texts(self, updates: list[tuple[str, list[BaseMessage]]]) -> None:
+        r"""
+        Add conversations to exists users and to cached windows
+        Args:
+            updates: user id with conversation parts
+        """
+        self.database.update_users_texts(updates)
+        for user_id, texts in updates:
+            self._append(user_id, texts)
+
+    def remove_user(self, user_id: str) -> None:
+        r"""
+        Remove user by user id or doing nothing if it not exists
+        Args:
+            user_id: unique user id
+        """
+        self.database.remove_user(user_id=user_id)
+        self._invalidate(user_id)
+
+    def get_user(self, user_id: str) -> User | None:
+        r"""
+        Get user object by object id
+        Args:
+            user_id: unique user id
+        """
+        return self.database.get_user(user_id=user_id)
+
+    def get_context(
+        self, user_id: str, limit: int, max_tokens: int | None = None
+    ) -> tuple[BaseMessage, list[BaseMessage]]:
+        r"""Get user object by object id.
+
+        Args:
+            user_id: unique user id
+            limit: max number of messages
+            max_tokens: max sum of message token counts
+        """
+        entry = self._get_entry(user_id, limit)
+        if entry is None:
+            # window is cached without token budget, budget is applied on every read
+            window_size = max(limit, self.window_size)
+            generation = self._start_load(user_id)
+            try:
+                system_prompt, messages = self.database.get_context(user_id, window_size)
+                entry = CachedContext(
+                    system_prompt=system_prompt,
+                    messages=messages,
+                    window_size=window_size,
+                    complete=len(messages) < window_size,
+                    expires_at=time.monotonic() + self.ttl_seconds,
+                    size=0,
+                )
+            finally:
+                # entry is still None when read failed
+                self._finish_load(user_id, generation, entry)
+
+        messages = entry.messages[-limit:] if limit > 0 else []
+        if max_tokens is not None:
+            messages = trim_to_token_budget(messages, max_tokens)
+        return entry.system_prompt, messages
+
+    def clear_history(self, user_id: str) -> None:
+        r"""
+        Remove messages of user
+        Args:
+            user_id: User id passed to store in database
+        """
+        self.database.clear_history(user_id=user_id)
+        self._invalidate(user_id)
+
+    def set_message_possible_context_ids(
+        self, user_id: str, answer_id: str, possible_contexts_ids: list[str]
+    ) -> None:
+        r"""
+        Update ids in message
+        Args:
+            user_id: User id passed to store in database
+            possible_contexts_ids: ids of model answer messages
+            answer_id: id of answer storing in database
+        """
+        self.database.set_message_possible_context_ids(user_id, answer_id, possible_contexts_ids)
+        self._invalidate(user_id)
+
+    def update_user_choice(self, user_id: str, answer_id: str, user_choice_idx: str) -> str:
+        r"""
+        Update ids in message
+        Args:
+            user_id: User id passed to store in database
+            user_choice_idx: id of message user chosen
+            answer_id: answer id storing in DB
+        """
+        choice_text = self.database.update_user_choice(user_id, answer_id, user_choice_idx)
+        self._invalidate(user_id)
+        return choice_text
+
+    def update_user_custom_choice(
+        self, user_id: str, message_choice_id: str, custom_text: str
+    ) -> None:
+        r"""
+        Update ids in message
+        Args:
+            user_id: User id passed to store in database
+            custom_text: text of user variant of answer
+            message_choice_id: id of message that was variant of model output
+        """
+        self.database.update_user_custom_choice(user_id, message_choice_id, custom_text)
+        self._invalidate(user_id)
+
+    def _append(self, user_id: str, texts: list[BaseMessage]) -> None:
+        with self._lock:
+            self._bump_generation(user_id)
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            messages = entry.messages + texts
+            if len(messages) > entry.window_size:
+                messages = messages[-entry.window_size :]
+                entry.complete = False
+            self._resize(entry, messages)
+            self._evict()
+
+    def _get_entry(self, user_id: str, limit: int) -> CachedContext | None:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.expires_at <= time.monotonic():
+                self._pop(user_id)
+                entry = None
+            if entry is None or (not entry.complete and len(entry.messages) < limit):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry
+
+    def _start_load(self, user_id: str) -> int:
+        r"""Register read of user window, return generation of user to pass to _finish_load."""
+        with self._lock:
+            load = self._loads.setdefault(user_id, _PendingLoad())
+            load.readers += 1
+            return load.generation
+
+    def _finish_load(self, user_id: str, generation: int, entry: CachedContext | None) -> None:
+        r"""
+        Unregister read of user window and cache read window unless user was written during it
+        Args:
+            user_id: unique user id
+            generation: generation returned by _start_load
+            entry: read window, None when read failed
+        """
+        with self._lock:
+            load = self._loads[user_id]
+            load.readers -= 1
+            if not load.readers:
+                del self._loads[user_id]
+            if entry is None or load.generation != generation or self.max_users <= 0:
+                return
+            self._pop(user_id)
+            self._entries[user_id] = entry
+            self._resize(entry, entry.messages)
+            self._evict()
+
+    def _bump_generation(self, user_id: str) -> None:
+        load = self._loads.get(user_id)
+        if load is not None:
+            load.generation += 1
+
+    def _invalidate(self, user_id: str) -> None:
+        with self._lock:
+            self._bump_generation(user_id)
+            self._pop(user_id)
+
+    def _pop(self, user_id: str) -> None:
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def _resize(self, entry: CachedContext, messages: list[BaseMessage]) -> None:
+        new_size = message_size(entry.system_prompt) + sum(
+            message_size(message) for message in messages
+        )
+        self.size += new_size - entry.size
+        entry.messages = messages
+        entry.size = new_size
+
+    def _evict(self) -> None:
+        while self._entries and (
+            len(self._entries) > self.max_users or self.size > self.max_bytes
+        ):
+            user_id = next(iter(self._entries))
+            self._pop(user_id)
@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+from datetime import datetime, timezone
+
+from pymongo import ASCENDING, IndexModel, UpdateOne
+
+from data.user_context import BaseMessage, ModelAnswer
+from database.Interface import ChoiceNotFoundError
+
+CANDIDATES_SUFFIX = "_candidates"
+# candidates are needed only until user picks one of them, older ones are removed by MongoDB
+CANDIDATES_TTL_SECONDS = 7 * 24 * 60 * 60
+
+
+def candidates_collection_name(table_name: str) -> str:
+    r"""Return name of collection with pending candidates of model answers of users table."""
+    return table_name + CANDIDATES_SUFFIX
+
+
+def candidates_indexes(ttl_seconds: float) -> list[IndexModel]:
+    r"""
+    Return indexes of candidates collection, candidates are found by answer id which is their
+    _id or by id of candidate message
+    Args:
+        ttl_seconds: seconds after which candidates are removed
+    """
+    return [
+        IndexModel([("user_id", ASCENDING), ("ids", ASCENDING)]),
+        IndexModel([("created_at", ASCENDING)], expireAfterSeconds=int(ttl_seconds)),
+    ]
+
+
+def inline_message(message: BaseMessage) -> dict:
+    r"""Return message document stored in user messages, candidates of answer are left out."""
+    document = message.to_bson()
+    document.pop("possible_contexts", None)
+    document.pop("possible_contexts_ids", None)
+    return document
+
+
+def candidates_requests(updates: list[tuple[str, list[BaseMessage]]]) -> list[UpdateOne]:
+    r"""
+    Build writes of candidates of model answers. Replayed answers keep stored candidates, so ids
+    set after the first write are not lost
+    Args:
+        updates: user id with conversation parts
+    """
+    created_at = datetime.now(timezone.utc)
+    return [
+        UpdateOne(
+            {"_id": text.id},
+            {
+                "$setOnInsert": {
+                    "user_id": user_id,
+                    "texts": list(text.possible_contexts),
+                    "ids": list(text.possible_contexts_ids or []),
+                    "created_at": created_at,
+                }
+            },
+            upsert=True,
+        )
+        for user_id, texts in updates
+        for text in texts
+        if isinstance(text, ModelAnswer) and text.possible_contexts
+    ]
+
+
+def chosen_text(candidates: dict, user_choice_idx: str) -> str:
+    r"""
+    Return candidate text chosen by user
+    Args:
+        candidates: candidates document matched by user_choice_idx
+        user_choice_idx: id of message user chosen
+    """
+    return candidates["texts"][candidates["ids"].index(user_choice_idx)]
+
+
+def answer_choice_update(messages_field: str, user_choice: str, text: str) -> dict:
+    r"""
+    Build update storing chosen text of model answer matched by positional operator
+    Args:
+        messages_field: name of messages array field
+        user_choice: id of chosen candidate or custom
+        text: chosen text
+    """
+    return {
+        "$set": {
+            f"{messages_field}.$.user_choice": user_choice,
+            f"{messages_field}.$.context": text,
+        }
+    }
+
+
+def custom_choice_filter(
+    user_id: str, messages_field: str, message_choice_id: str, candidates: dict | None
+) -> dict:
+    r"""
+    Build filter of model answer having candidate message_choice_id
+    Args:
+        user_id: User id passed to store in database
+        messages_field: name of messages array field
+        message_choice_id: id of message that was variant of model output
+        candidates: candidates document of answer, None when candidates are stored inline
+    """
+    if candidates is not None:
+        return {"user_id": user_id, f"{messages_field}.id": candidates["_id"]}
+    return {"user_id": user_id, f"{messages_field}.possible_contexts_ids": message_choice_id}
+
+
+def choice_not_found(user_id: str, answer_id: str, user_choice_idx: str) -> ChoiceNotFoundError:
+    r"""
+    Return error of choice which matched no answer with inline candidates. Answers stored with
+    candidates collection have no inline candidates, so they are not matched after their
+    candidates expired
+    Args:
+        user_id: User id passed to store in database
+        answer_id: answer id storing in DB
+        user_choice_idx: id of message user chosen
+    """
+    return ChoiceNotFoundError(
+        f"Can not find user message or its candidate. user_id: {user_id} "
+        f"answer_id: {answer_id} user_choice_idx: {user_choice_idx}"
+    )
+
+
+def custom_choice_not_found(user_id: str, message_choice_id: str) -> ChoiceNotFoundError:
+    r"""
+    Return error of custom answer which matched no model answer
+    Args:
+        user_id: User id passed to store in database
+        message_choice_id: id of message that was variant of model output
+    """
+    return ChoiceNotFoundError(
+        f"Can not find answer with candidate. user_id: {user_id} "
+        f"message_choice_id: {message_choice_id}"
+    )
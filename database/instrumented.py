@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+from collections.abc import AsyncIterator
+from typing import Any
+
+from data.user_context import BaseMessage, User
+from database.AsyncInterface import AsyncDataBase
+from utils.metrics import DATABASE_CALL_SECONDS
+
+
+class InstrumentedDataBase(AsyncDataBase):
+    r"""Database measuring time of every method call in database_call_seconds histogram."""
+
+    def __init__(self, database: AsyncDataBase):
+        self.database = database
+
+    async def get_all_users(self) -> Any:
+        with DATABASE_CALL_SECONDS.labels("get_all_users").time():
+            return await self.database.get_all_users()
+
+    async def iter_users(
+        self,
+        after_user_id: str | None = None,
+        limit: int | None = None,
+        include_history: bool = True,
+    ) -> AsyncIterator[User]:
+        r"""
+        Yield users sorted by user id, users are read from database while iterating
+        Args:
+            after_user_id: only users with greater user id are returned
+            limit: max number of users
+            include_history: if false, users are returned without messages
+        """
+        # only time to the first user is measured, the rest is paced by the reader
+        users = self.database.iter_users(after_user_id, limit, include_history).__aiter__()
+        with DATABASE_CALL_SECONDS.labels("iter_users").time():
+            try:
+                first_user = await users.__anext__()
+            except StopAsyncIteration:
+                return
+        yield first_user
+        async for user in users:
+            yield user
+
+    async def update_model_answer(self, user_id: str, message_id: str, content: str) -> Any:
+        r"""
+        Update model answer
+        Args:
+            user_id:
+            message_id:
+            content:
+        """
+        with DATABASE_CALL_SECONDS.labels("update_model_answer").time():
+            return await self.database.update_model_answer(user_id, message_id, content)
+
+    async def create_user(self, user_id: str, username: str | None, chat_id: str):
+        r"""
+        Create new user
+        Args:
+            user_id:
+            username:
+            chat_id:
+        """
+        with DATABASE_CALL_SECONDS.labels("create_user").time():
+            return await self.database.create_user(
+                user_id=user_id, username=username, chat_id=chat_id
+            )
+
+    async def get_object_id_by_user_id(self, user_id: str) -> Any:
+        r"""
+        Return Mongo database ID by user id
+        Args:
+            user_id: unique user id
+        """
+        with DATABASE_CALL_SECONDS.labels("get_object_id_by_user_id").time():
+            return await self.database.get_object_id_by_user_id(user_id)
+
+    async def update_user_text(self, user_id: str, texts: list[BaseMessage]) -> None:
+        r"""
+        Add conversation to exists user
+        Args:
+            user_id: unique user id
+            texts: Tuple of conversation parts
+        """
+        with DATABASE_CALL_SECONDS.labels("update_user_text").time():
+            await self.database.update_user_text(user_id=user_id, texts=texts)
+
+    async def update_users_texts(self, updates: list[tuple[str, list[BaseMessage]]]) -> None:
+        r"""
+        Add conversations to exists users, updates of the same user are applied in order
+        Args:
+            updates: user id with conversation parts
+        """
+        with DATABASE_CALL_SECONDS.labels("update_users_texts").time():
+            await self.database.update_users_texts(updates)
+
+    async def remove_user(self, user_id: str) -> None:
+        r"""
+        Remove user by user id or doing nothing if it not exists
+        Args:
+            user_id: unique user id
+        """
+        with DATABASE_CALL_SECONDS.labels("remove_user").time():
+            await self.database.remove_user(user_id=user_id)
+
+    async def get_user(self, user_id: str) -> User | None:
+        r"""
+        Get user object by object id
+        Args:
+            user_id: unique user id
+        """
+        with DATABASE_CALL_SECONDS.labels("get_user").time():
+            return await self.database.get_user(user_id=user_id)
+
+    async def get_context(
+        self, user_id: str, limit: int, max_tokens: int | None = None
+    ) -> tuple[BaseMessage, list[BaseMessage]]:
+        r"""Get user object by object id.
+
+        Args:
+            user_id: unique user id
+            limit: max number of messages
+            max_tokens: max sum of message token counts
+        """
+        with DATABASE_CALL_SECONDS.labels("get_context").time():
+            return await self.database.get_context(user_id, limit, max_tokens)
+
+    async def clear_history(self, user_id: str) -> None:
+        r"""
+        Remove messages of user
+        Args:
+            user_id: User id passed to store in database
+        """
+        with DATABASE_CALL_SECONDS.labels("clear_history").time():
+            await self.database.clear_history(user_id=user_id)
+
+    async def set_message_possible_context_ids(
+        self, user_id: str, answer_id: str, possible_contexts_ids: list[str]
+    ) -> None:
+        r"""
+        Update ids in message
+        Args:
+            user_id: User id passed to store in database
+            possible_contexts_ids: ids of model answer messages
+            answer_id: id of answer storing in database
+        """
+        with DATABASE_CALL_SECONDS.labels("set_message_possible_context_ids").time():
+            await self.database.set_message_possible_context_ids(
+                user_id, answer_id, possible_contexts_ids
+            )
+
+    async def update_user_choice(self, user_id: str, answer_id: str, user_choice_idx: str) -> str:
+        r"""
+        Update ids in message
+        Args:
+            user_id: User id passed to store in database
+            user_choice_idx: id of message user chosen
+            answer_id: answer id storing in DB
+        """
+        with DATABASE_CALL_SECONDS.labels("update_user_choice").time():
+            return await self.database.update_user_choice(user_id, answer_id, user_choice_idx)
+
+    async def update_user_custom_choice(
+        self, user_id: str, message_choice_id: str, custom_text: str
+    ) -> None:
+        r"""
+        Update ids in message
+        Args:
+            user_id: User id passed to store in database
+            custom_text: text of user variant of answer
+            message_choice_id: id of message that was variant of model output
+        """
+        with DATABASE_CALL_SECONDS.labels("update_user_custom_choice").time():
+            await self.database.update_user_custom_choice(user_id, message_choice_id, custom_text)
@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import fcntl
+import json
+import os
+import threading
+import time
+from collections.abc import Iterator
+from typing import IO
+
+from data.user_context import BaseMessage, message_from_bson
+from utils.logger import get_pylogger
+
+log = get_pylogger(__name__)
+
+JOURNAL_SUFFIX = ".jsonl"
+DEAD_LETTER_DIRECTORY = "dead-letter"
+
+
+def dump_update(user_id: str, texts: list[BaseMessage]) -> str:
+    r"""
+    Return journal line of conversation update
+    Args:
+        user_id: unique user id
+        texts: conversation parts
+    """
+    record = {"user_id": user_id, "texts": [text.to_bson() for text in texts]}
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+
+class WriteJournal:
+    r"""
+    Append-only local journal of conversation updates not written to database yet.
+
+    Every process writes its own segment files locked by flock, so segments of crashed
+    processes can be found and replayed by others. Appended update is synced to disk before
+    append returns, concurrent appends share one fsync. Segment is deleted only after its updates
+    are written to database.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # fsync runs without the write lock, lines written meanwhile are synced by the next one
+        self._sync_lock = threading.Lock()
+        self._written = 0
+        self._synced = 0
+        # rotated segments stay open, so their locks are held until they are discarded
+        self._segments: dict[str, IO[str]] = {}
+        self._path, self._file = self._open_segment()
+
+    def append(self, user_id: str, texts: list[BaseMessage]) -> None:
+        r"""
+        Durably store conversation update, blocking so must run in thread
+        Args:
+            user_id: unique user id
+            texts: conversation parts
+        """
+        self.sync(self.write(user_id, texts))
+
+    def write(self, user_id: str, texts: list[BaseMessage]) -> int:
+        r"""
+        Write conversation update without waiting for disk, blocking so must run in thread
+        Args:
+            user_id: unique user id
+            texts: conversation parts
+        Returns:
+            number of written updates, update is durable once sync of this number returns
+        """
+        line = dump_update(user_id, texts)
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self._written += 1
+            return self._written
+
+    def sync(self, written: int) -> None:
+        r"""
+        Wait until updates are synced to disk, blocking so must run in thread
+        Args:
+            written: number of written updates returned by write
+        """
+        with self._sync_lock:
+            if self._synced >= written:
+                # synced by fsync of concurrent append
+                return
+            with self._lock:
+                segment, written = self._file, self._written
+            os.fsync(segment.fileno())
+            self._synced = written
+
+    def rotate(self) -> str:
+        r"""Start new segment and return path of the previous one, its updates are synced."""
+        # segment is not discarded while its fsync is running
+        with self._sync_lock:
+            with self._lock:
+                path, segment, written = self._path, self._file, self._written
+                self._path, self._file = self._open_segment()
+            os.fsync(segment.fileno())
+            self._synced = written
+            return path
+
+    def dead_letter(self, updates: list[tuple[str, list[BaseMessage]]]) -> str:
+        r"""
+        Save updates which can not be written to database, they are not replayed by recover.
+        File has journal format, it is replayed on start when moved back to journal directory
+        Args:
+            updates: user id with conversation parts
+        Returns:
+            path of saved file
+        """
+        directory = os.path.join(self.directory, DEAD_LETTER_DIRECTORY)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{time.time_ns():020d}-{os.getpid()}{JOURNAL_SUFFIX}")
+        with open(path, "w", encoding="UTF-8") as dead_letter:
+            dead_letter.writelines(dump_update(user_id, texts) for user_id, texts in updates)
+            dead_letter.flush()
+            os.fsync(dead_letter.fileno())
+        return path
+
+    def discard(self, paths: list[str]) -> None:
+        r"""Delete segments which updates are written to database."""
+        with self._lock:
+            for path in paths:
+                os.remove(path)
+                self._segments.pop(path).close()
+
+    def close(self) -> None:
+        r"""Close all segments, not discarded segments are replayed on the next start."""
+        with self._lock:
+            if self._file.tell() == 0:
+                os.remove(self._path)
+            for segment in self._segments.values():
+                segment.close()
+            self._segments.clear()
+
+    def recover(self) -> Iterator[tuple[str, list[tuple[str, list[BaseMessage]]]]]:
+        r"""Lock segments left by stopped processes and yield their paths with updates."""
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(JOURNAL_SUFFIX) or path in self._segments:
+                continue
+            segment = open(path, encoding="UTF-8")  # pylint: disable=consider-using-with
+            try:
+                fcntl.flock(segment, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # segment of running process
+                segment.close()
+                continue
+            if not os.path.exists(path):
+                # discarded by its process before lock was taken
+                segment.close()
+                continue
+            with self._lock:
+                self._segments[path] = segment
+            yield path, list(self._read_updates(segment))
+
+    def _open_segment(self) -> tuple[str, IO[str]]:
+        name = f"{time.time_ns():020d}-{os.getpid()}{JOURNAL_SUFFIX}"
+        path = os.path.join(self.directory, name)
+        segment = open(path, "a", encoding="UTF-8")  # pylint: disable=consider-using-with
+        fcntl.flock(segment, fcntl.LOCK_EX)
+        # new directory entry is synced too, so segment is found after power loss
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self._segments[path] = segment
+        return path, segment
+
+    @staticmethod
+    def _read_updates(segment: IO[str]) -> Iterator[tuple[str, list[BaseMessage]]]:
+        for line in segment:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # last line torn by crash was never acknowledged
+                log.warning("Skip broken journal line of %s", segment.name)
+                continue
+            yield record["user_id"], [message_from_bson(text) for text in record["texts"]]
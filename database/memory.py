@@ -0,0 +1,258 @@
+from __future__ import annotations
+
+import copy
+import threading
+from collections.abc import Iterator
+from typing import Any
+
+from bson.objectid import ObjectId
+
+from data.user_context import BaseMessage, User
+from database.Interface import ChoiceNotFoundError, DataBase
+from database.mongo import MAX_POOL_SIZE, context_from_bson, new_user_document
+from database.utils import trim_to_token_budget
+
+
+class InMemoryDataBase(DataBase):
+    r"""
+    Database keeping user documents in process memory, used by benchmarks instead of MongoDB.
+
+    Documents have the same layout as documents of MongoDataBase and are copied on every read and
+    write, so callers pay for conversion of messages as they do with real database. Nothing is
+    persisted, connection arguments are accepted only to be created as any other backend.
+    """
+
+    def __init__(
+        self,
+        connection_string: str = "",
+        database_name: str = "",
+        table_name: str = "",
+        max_pool_size: int = MAX_POOL_SIZE,  # pylint: disable=unused-argument
+    ):
+        self._users: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def find_collection_scans(self) -> list[str]:
+        r"""Return names of hot queries which scan the whole collection, users are kept by id."""
+        return []
+
+    def create_user(self, user_id: str, username: str | None, chat_id: str):
+        r"""
+        Create new user
+        Args:
+            user_id:
+            username:
+            chat_id:
+        """
+        document = new_user_document(user_id, username, chat_id)
+        document["_id"] = ObjectId()
+        with self._lock:
+            if user_id in self._users:
+                raise ValueError(f"User with user_id:{user_id} already exists")
+            self._users[user_id] = document
+
+    def update_model_answer(self, user_id: str, message_id: str, content: str) -> Any:
+        r"""
+        Update model answer
+        Args:
+            user_id:
+            message_id:
+            content:
+        """
+
+    def get_all_users(self) -> Any:
+        return list(self.iter_users())
+
+    def iter_users(
+        self,
+        after_user_id: str | None = None,
+        limit: int | None = None,
+        include_history: bool = True,
+    ) -> Iterator[User]:
+        r"""
+        Yield users sorted by user id
+        Args:
+            after_user_id: only users with greater user id are returned
+            limit: max number of users
+            include_history: if false, users are returned without messages
+        """
+        with self._lock:
+            user_ids = sorted(
+                user_id
+                for user_id in self._users
+                if after_user_id is None or user_id > after_user_id
+            )
+        for user_id in user_ids[:limit]:
+            with self._lock:
+                document = self._users.get(user_id)
+                if document is None:
+                    continue
+                if not include_history:
+                    document = {key: value for key, value in document.items() if key != "context"}
+                document = copy.deepcopy(document)
+            yield User.from_bson(document)
+
+    def update_user_text(self, user_id: str, texts: list[BaseMessage]) -> None:
+        r"""
+        Add conversation to exists user
+        Args:
+            user_id: unique user id
+            texts: Tuple of conversation parts
+        """
+        texts_mapped = [text.to_bson() for text in texts]
+        with self._lock:
+            document = self._users.get(user_id)
+            if document is not None:
+                document["context"].extend(texts_mapped)
+
+    def update_users_texts(self, updates: list[tuple[str, list[BaseMessage]]]) -> None:
+        r"""
+        Add conversations to exists users, replayed updates are skipped
+        Args:
+            updates: user id with conversation parts
+        """
+        with self._lock:
+            for user_id, texts in updates:
+                document = self._users.get(user_id)
+                if document is None or not texts:
+                    continue
+                if any(message["id"] == texts[0].id for message in document["context"]):
+                    continue
+                document["context"].extend(text.to_bson() for text in texts)
+
+    def get_object_id_by_user_id(self, user_id: str) -> Any:
+        r"""
+        Return database ID by user id
+        Args:
+            user_id: User id passed to store in database
+        """
+        with self._lock:
+            document = self._users.get(user_id)
+            return document["_id"] if document is not None else None
+
+    def remove_user(self, user_id: str) -> None:
+        r"""
+        Remove user by user id or doing nothing if it not exists
+        Args:
+            user_id: User id passed to store in database
+        """
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def clear_history(self, user_id: str) -> None:
+        r"""
+        Remove messages of user
+        Args:
+            user_id: User id passed to store in database
+        """
+        with self._lock:
+            document = self._users.get(user_id)
+            if document is not None:
+                document["current_context_start_idx"] = len(document["context"])
+
+    def get_user(self, user_id: str) -> User | None:
+        r"""
+        Get user object by user id
+        Args:
+            user_id: unique user id
+        """
+        with self._lock:
+            document = copy.deepcopy(self._users.get(user_id))
+        if not document:
+            return None
+
+        return User.from_bson(document)
+
+    def get_context(
+        self, user_id: str, limit: int, max_tokens: int | None = None
+    ) -> tuple[BaseMessage, list[BaseMessage]]:
+        r"""
+        Get system prompt and the newest messages of user
+        Args:
+            user_id: user id
+            limit: max number of messages
+            max_tokens: max sum of message token counts
+        """
+        with self._lock:
+            document = self._users.get(user_id)
+            element = None
+            if document is not None:
+                messages = document["context"][document["current_context_start_idx"] :]
+                element = copy.deepcopy(
+                    {
+                        "system_prompt": document["system_prompt"],
+                        "filtered_messages": messages[-limit:] if limit > 0 else [],
+                    }
+                )
+        system_prompt, messages = context_from_bson(element)
+        if max_tokens is not None:
+            messages = trim_to_token_budget(messages, max_tokens)
+        return system_prompt, messages
+
+    def set_message_possible_context_ids(
+        self, user_id: str, answer_id: str, possible_contexts_ids: list[str]
+    ) -> None:
+        r"""
+        Update ids in message
+        Args:
+            user_id: User id passed to store in database
+            possible_contexts_ids: ids of model answer messages
+            answer_id: id of answer storing in database
+        """
+        with self._lock:
+            message = self._find_message(user_id, lambda message: message["id"] == answer_id)
+            if message is not None:
+                message["possible_contexts_ids"] = list(possible_contexts_ids)
+
+    def update_user_choice(self, user_id: str, answer_id: str, user_choice_idx: str) -> str:
+        r"""
+        Update ids in message
+        Args:
+            user_id: User id passed to store in database
+            user_choice_idx: id of message user chosen
+            answer_id: answer id storing in DB
+        """
+        with self._lock:
+            message = self._find_message(
+                user_id,
+                lambda message: message["id"] == answer_id
+                and user_choice_idx in (message.get("possible_contexts_ids") or []),
+            )
+            if message is None:
+                raise ChoiceNotFoundError(
+                    f"Can not find user message or its candidate. user_id: {user_id} "
+                    f"answer_id: {answer_id} user_choice_idx: {user_choice_idx}"
+                )
+            index = message["possible_contexts_ids"].index(user_choice_idx)
+            message["user_choice"] = user_choice_idx
+            message["context"] = message["possible_contexts"][index]
+            return message["context"]
+
+    def update_user_custom_choice(
+        self, user_id: str, message_choice_id: str, custom_text: str
+    ) -> None:
+        r"""
+        Update ids in message
+        Args:
+            user_id: User id passed to store in database
+            custom_text: text of user variant of answer
+            message_choice_id: id of message that was variant of model output
+        """
+        with self._lock:
+            message = self._find_message(
+                user_id,
+                lambda message: message_choice_id in (message.get("possible_contexts_ids") or []),
+            )
+            if message is None:
+                raise ChoiceNotFoundError(
+                    f"Can not find answer with candidate. user_id: {user_id} "
+                    f"message_choice_id: {message_choice_id}"
+                )
+            message["user_choice"] = "custom"
+            message["context"] = custom_text
+
+    def _find_message(self, user_id: str, matches: Any) -> dict | None:
+        document = self._users.get(user_id)
+        if document is None:
+            return None
+        return next((message for message in document["context"] if matches(message)), None)
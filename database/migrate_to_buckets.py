@@ -0,0 +1,88 @@
+"""Copy users with embedded context array into bucketed message collection.
+
+Migration streams source users one by one and copies only messages which were not copied yet.
+Message keeps its position among all messages of user as its sequence number, messages moved
+into archive by archive_history are counted and copied from archive collection. Buckets are
+rewritten whole from source, so a pass interrupted between writes is completed by the next one
+without duplicated messages. Service is switched without downtime:
+
+1. run migration while embedded service keeps writing to the source table, until a pass copies
+   only a few messages;
+2. restart service with DATABASE_BACKEND=bucketed, TABLE_NAME set to the target table and
+   MIGRATION_SOURCE_TABLE set to the source table, rolling restart may keep embedded and
+   bucketed processes running side by side. Bucketed process copies messages written since the
+   last pass before it serves a user for the first time;
+3. once no embedded process is running, run migration until a pass logs no changed users. It
+   copies users not served yet, messages embedded processes wrote after bucketed ones had
+   written to the same user are appended after the messages of bucketed service;
+4. restart service without MIGRATION_SOURCE_TABLE.
+
+Answers chosen in source after they were copied keep the text they had when copied.
+
+    python -m database.migrate_to_buckets --source-table telegram_users --target-table users
+"""
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+
+from pymongo import MongoClient
+from pymongo.collection import Collection
+
+from database.mongo_bucketed import BucketedMongoDataBase, MigrationConflictError
+from utils.logger import get_pylogger
+
+log = get_pylogger(__name__)
+
+DATABASE_NAME = "chat"
+
+
+def migrate(source: Collection, target: BucketedMongoDataBase) -> int:
+    r"""
+    Copy all users from source collection, users are read by cursor one by one
+    Args:
+        source: collection of users with embedded context array
+        target: bucketed database to copy users into
+    Returns:
+        number of copied messages
+    """
+    copied = 0
+    for source_bson in source.find({}, {"_id": 0}).sort("_id", 1):
+        try:
+            user_copied = target.migrate_user(source, source_bson)
+        except MigrationConflictError as exception:
+            # bucketed service copied the user at the same time, the next pass finishes it
+            log.warning("%s, it is copied by the next pass", exception)
+            continue
+        if user_copied:
+            log.info("Copied %s messages of user %s", user_copied, source_bson["user_id"])
+        copied += user_copied
+    return copied
+
+
+def main():
+    r"""Run one migration pass using service environment variables."""
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--source-table", required=True)
+    parser.add_argument("--target-table", required=True)
+    args = parser.parse_args()
+
+    connection_string = os.environ["DATABASE_CONNECTION_STRING"]
+    source = (
+        MongoClient(connection_string)
+        .get_database(DATABASE_NAME)
+        .get_collection(args.source_table)
+    )
+    target = BucketedMongoDataBase(
+        connection_string=connection_string,
+        database_name=DATABASE_NAME,
+        table_name=args.target_table,
+    )
+    copied = migrate(source, target)
+    log.info("Migration pass finished, %s messages copied", copied)
+
+
+if __name__ == "__main__":
+    main()
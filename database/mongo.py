@@ -1,22 +1,350 @@
 from __future__ import annotations
 
-from dataclasses import asdict
+from collections.abc import Iterator
 from typing import Any
 
-from pymongo import MongoClient
-
-from data.user_context import BaseMessage, ModelAnswer, RoleEnum, User
-from database.Interface import DataBase
+from pymongo import ASCENDING, MongoClient, ReturnDocument, UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import OperationFailure
+
+from data.user_context import BaseMessage, RoleEnum, User, message_from_bson
+from database.archive import (
+    ARCHIVE_CHUNK_SIZE,
+    ARCHIVE_MAX_MESSAGES,
+    archive_collection_name,
+    archive_plan,
+    cleared_window_projection,
+    decompress_messages,
+)
+from database.candidates import (
+    CANDIDATES_TTL_SECONDS,
+    answer_choice_update,
+    candidates_collection_name,
+    candidates_indexes,
+    candidates_requests,
+    choice_not_found,
+    chosen_text,
+    custom_choice_filter,
+    custom_choice_not_found,
+    inline_message,
+)
+from database.Interface import ChoiceNotFoundError, DataBase
+from utils.logger import get_pylogger
+
+log = get_pylogger(__name__)
 
 BASE_PROMPT = "Ты цифровой двойник Артема Заболотного, ты должен поддерживать беседу с друзями и быть веселым."
 CUSTOM_USER_CHOICE = "CUSTOM"
+USERS_BATCH_SIZE = 100
+MAX_POOL_SIZE = 100
+# filters of queries run on every request, checked by find_collection_scans, filters are
+# MongoDB documents rather than records
+# pylint: disable-next=consider-using-namedtuple-or-dataclass
+HOT_QUERIES = {
+    "user": {"user_id": ""},
+    "users_page": {"user_id": {"$gt": ""}},
+    "answer": {"user_id": "", "context.id": ""},
+    "answer_by_candidate": {"user_id": "", "context.possible_contexts_ids": ""},
+}
+# pylint: disable-next=consider-using-namedtuple-or-dataclass
+CANDIDATES_HOT_QUERIES = {
+    "candidates": {"_id": "", "user_id": ""},
+    "candidates_by_candidate": {"user_id": "", "ids": ""},
+}
+
+
+def token_budget_expression(messages: Any, max_tokens: int) -> dict:
+    r"""
+    Build aggregation expression keeping the newest messages which fit into token budget.
+    Messages are dropped by pairs from the oldest one as Conversation.shrink does, messages
+    stored without token_count are counted as empty.
+    Args:
+        messages: aggregation expression of messages array
+        max_tokens: max sum of message token counts
+    """
+    budget = {
+        "$reduce": {
+            "input": {"$reverseArray": messages},
+            "initialValue": {"tokens": 0, "kept": 0, "done": False},
+            "in": {
+                "$let": {
+                    "vars": {
+                        "tokens": {
+                            "$add": ["$$value.tokens", {"$ifNull": ["$$this.token_count", 0]}]
+                        }
+                    },
+                    "in": {
+                        "$cond": [
+                            {
+                                "$and": [
+                                    {"$not": ["$$value.done"]},
+                                    {"$lte": ["$$tokens", max_tokens]},
+                                ]
+                            },
+                            {
+                                "tokens": "$$tokens",
+                                "kept": {"$add": ["$$value.kept", 1]},
+                                "done": False,
+                            },
+                            {"tokens": "$$value.tokens", "kept": "$$value.kept", "done": True},
+                        ]
+                    },
+                }
+            },
+        }
+    }
+    dropped = {"$subtract": [{"$size": messages}, "$$budget.kept"]}
+    return {
+        "$let": {
+            "vars": {"budget": budget},
+            "in": {
+                "$slice": [
+                    messages,
+                    {"$add": [dropped, {"$mod": [dropped, 2]}]},
+                    {"$add": [{"$size": messages}, 1]},
+                ]
+            },
+        }
+    }
+
+
+def user_choice_update(messages_field: str, answer_id: str, user_choice_idx: str) -> list[dict]:
+    r"""
+    Build update pipeline setting user choice and chosen text of model answer.
+    Chosen text is taken from possible_contexts by position of user_choice_idx in
+    possible_contexts_ids, so the message must be matched only when it has the chosen id.
+    Args:
+        messages_field: name of messages array field
+        answer_id: id of model answer
+        user_choice_idx: id of message user chosen
+    """
+    answer_id_value = {"$literal": answer_id}
+    user_choice_value = {"$literal": user_choice_idx}
+    choice_text = {
+        "$arrayElemAt": [
+            "$$message.possible_contexts",
+            {"$indexOfArray": ["$$message.possible_contexts_ids", user_choice_value]},
+        ]
+    }
+    return [
+        {
+            "$set": {
+                messages_field: {
+                    "$map": {
+                        "input": f"${messages_field}",
+                        "as": "message",
+                        "in": {
+                            "$cond": [
+                                {"$eq": ["$$message.id", answer_id_value]},
+                                {
+                                    "$mergeObjects": [
+                                        "$$message",
+                                        {"user_choice": user_choice_value, "context": choice_text},
+                                    ]
+                                },
+                                "$$message",
+                            ]
+                        },
+                    }
+                }
+            }
+        }
+    ]
+
+
+def context_pipeline(user_id: str, limit: int, max_tokens: int | None = None) -> list[dict]:
+    r"""
+    Build aggregation reading system prompt and the newest messages of user
+    Args:
+        user_id: user id
+        limit: max number of messages
+        max_tokens: max sum of message token counts
+    """
+    # system prompt and messages window are read by one aggregation, the whole context
+    # array never leaves the database
+    pipeline: list[dict] = [
+        {"$match": {"user_id": user_id}},
+        {"$limit": 1},
+        {
+            "$project": {
+                "_id": 0,
+                "system_prompt": 1,
+                "filtered_messages": {
+                    "$lastN": {
+                        "input": {"$slice": ["$context", "$current_context_start_idx", 100_000]},
+                        "n": limit,
+                    }
+                },
+            }
+        },
+    ]
+    if max_tokens is not None:
+        pipeline.append(
+            {
+                "$set": {
+                    "filtered_messages": token_budget_expression("$filtered_messages", max_tokens)
+                }
+            }
+        )
+    return pipeline
+
+
+def context_from_bson(element: dict | None) -> tuple[BaseMessage, list[BaseMessage]]:
+    r"""Return system prompt and messages read by context_pipeline."""
+    if not element:
+        raise ValueError("Cannot find user!")
+    system_prompt = BaseMessage(**element["system_prompt"])
+
+    responses = [message_from_bson(elem) for elem in element["filtered_messages"]]
+    return system_prompt, responses
+
+
+def new_user_document(user_id: str, username: str | None, chat_id: str) -> dict:
+    r"""
+    Return document of user without messages
+    Args:
+        user_id:
+        username:
+        chat_id:
+    """
+    system_prompt = BaseMessage(RoleEnum.system, RoleEnum.system, BASE_PROMPT)
+    return User(
+        user_id=user_id,
+        username=username,
+        chat_id=chat_id,
+        system_prompt=system_prompt,
+        context=[],
+        current_context_start_idx=0,
+    ).to_bson()
+
+
+def users_query(after_user_id: str | None, include_history: bool) -> tuple[dict, dict | None]:
+    r"""
+    Return filter and projection of users page
+    Args:
+        after_user_id: only users with greater user id are returned
+        include_history: if false, users are returned without messages
+    """
+    query = {} if after_user_id is None else {"user_id": {"$gt": after_user_id}}
+    projection = None if include_history else {"context": 0}
+    return query, projection
+
+
+def user_choice_filter(user_id: str, answer_id: str, user_choice_idx: str) -> dict:
+    r"""Return filter of user document with model answer having the chosen candidate."""
+    return {
+        "user_id": user_id,
+        "context": {"$elemMatch": {"id": answer_id, "possible_contexts_ids": user_choice_idx}},
+    }
+
+
+def inline_choice_arguments(user_id: str, answer_id: str, user_choice_idx: str) -> dict:
+    r"""
+    Return arguments of find_one_and_update storing candidate chosen from inline candidates,
+    updated model answer is returned as the only element of context
+    Args:
+        user_id: User id passed to store in database
+        answer_id: answer id storing in DB
+        user_choice_idx: id of message user chosen
+    """
+    return {
+        "filter": user_choice_filter(user_id, answer_id, user_choice_idx),
+        "update": user_choice_update("context", answer_id, user_choice_idx),
+        "projection": {"_id": 0, "context": {"$elemMatch": {"id": answer_id}}},
+        "return_document": ReturnDocument.AFTER,
+    }
+
+
+def append_texts_requests(updates: list[tuple[str, list[BaseMessage]]]) -> list[UpdateOne]:
+    r"""
+    Build bulk write requests adding conversations to users. Conversation is skipped when its
+    first message is already stored, so replayed requests do not duplicate messages
+    Args:
+        updates: user id with conversation parts
+    """
+    return [
+        UpdateOne(
+            {"user_id": user_id, "context.id": {"$ne": texts[0].id}},
+            {"$push": {"context": {"$each": [inline_message(text) for text in texts]}}},
+        )
+        for user_id, texts in updates
+        if texts
+    ]
+
+
+def plan_stages(plan: Any) -> list[str]:
+    r"""Return names of all stages of explain output."""
+    stages = []
+    if isinstance(plan, dict):
+        if isinstance(plan.get("stage"), str):
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+    return stages
+
+
+def is_collection_scan(explain: dict) -> bool:
+    r"""Return whether query plan of explain output scans the whole collection."""
+    return "COLLSCAN" in plan_stages(explain.get("queryPlanner", explain))
+
+
+def find_collection_scans(collection: Collection, queries: dict[str, dict]) -> list[str]:
+    r"""
+    Explain queries and return names of those which scan the whole collection
+    Args:
+        collection: queried collection
+        queries: filters of hot queries by their names
+    """
+    return [
+        name
+        for name, query in queries.items()
+        if is_collection_scan(collection.find(query).explain())
+    ]
 
 
 class MongoDataBase(DataBase):
-    def __init__(self, connection_string: str, database_name: str, table_name: str):
-        client: MongoClient = MongoClient(connection_string)
+    def __init__(
+        self,
+        connection_string: str,
+        database_name: str,
+        table_name: str,
+        max_pool_size: int = MAX_POOL_SIZE,
+        archive_on_clear: bool = False,
+        candidates_ttl_seconds: float = CANDIDATES_TTL_SECONDS,
+    ):
+        client: MongoClient = MongoClient(connection_string, maxPoolSize=max_pool_size)
         db = client.get_database(database_name)
         self.collection = db.get_collection(table_name)
+        self.archive = db.get_collection(archive_collection_name(table_name))
+        self.candidates = db.get_collection(candidates_collection_name(table_name))
+        self.archive_on_clear = archive_on_clear
+        self.candidates_ttl_seconds = candidates_ttl_seconds
+        self.ensure_indexes()
+
+    def ensure_indexes(self) -> None:
+        r"""Create indexes used by queries, existing indexes are left untouched."""
+        # every query filters by user_id first, so messages are found inside single user document
+        # and no multikey index over all stored messages is needed
+        try:
+            self.collection.create_index([("user_id", ASCENDING)], unique=True)
+        except OperationFailure as exception:
+            # duplicated users created before the index existed, queries still work without it
+            log.error("Can not create unique user_id index: %s", exception)
+        self.archive.create_index([("user_id", ASCENDING), ("first_idx", ASCENDING)], unique=True)
+        try:
+            self.candidates.create_indexes(candidates_indexes(self.candidates_ttl_seconds))
+        except OperationFailure as exception:
+            # index made with another TTL must be changed by collMod, candidates are still found
+            log.error("Can not create candidates indexes: %s", exception)
+
+    def find_collection_scans(self) -> list[str]:
+        r"""Return names of hot queries which scan the whole collection."""
+        return find_collection_scans(self.collection, HOT_QUERIES) + find_collection_scans(
+            self.candidates, CANDIDATES_HOT_QUERIES
+        )
 
     def create_user(self, user_id: str, username: str | None, chat_id: str):
         r"""
@@ -27,23 +355,13 @@ class MongoDataBase(DataBase):
             chat_id:
         """
 
-        doc = self.collection.find_one({"user_id": user_id})
-        if doc:
-            raise ValueError(f"User with user_id:{user_id} already exists")
-
-        system_prompt = BaseMessage(RoleEnum.system, RoleEnum.system, BASE_PROMPT)
-
-        bson = asdict(
-            User(
-                user_id=user_id,
-                username=username,
-                chat_id=chat_id,
-                system_prompt=system_prompt,
-                context=[],
-                current_context_start_idx=0,
-            )
+        bson = new_user_document(user_id, username, chat_id)
+        # upsert is idempotent, concurrent creates of the same user insert it only once
+        result = self.collection.update_one(
+            {"user_id": user_id}, {"$setOnInsert": bson}, upsert=True
         )
-        self.collection.insert_one(bson)
+        if result.upserted_id is None:
+            raise ValueError(f"User with user_id:{user_id} already exists")
 
     def update_model_answer(self, user_id: str, message_id: str, content: str) -> Any:
         r"""
@@ -55,11 +373,29 @@ class MongoDataBase(DataBase):
         """
 
     def get_all_users(self) -> Any:
-        cursor = self.collection.find({})
-        users = []
+        return list(self.iter_users())
+
+    def iter_users(
+        self,
+        after_user_id: str | None = None,
+        limit: int | None = None,
+        include_history: bool = True,
+    ) -> Iterator[User]:
+        r"""
+        Yield users sorted by user id, users are read from database while iterating
+        Args:
+            after_user_id: only users with greater user id are returned
+            limit: max number of users
+            include_history: if false, users are returned without messages
+        """
+        query, projection = users_query(after_user_id, include_history)
+        cursor = self.collection.find(query, projection, batch_size=USERS_BATCH_SIZE).sort(
+            "user_id", ASCENDING
+        )
+        if limit is not None:
+            cursor = cursor.limit(limit)
         for document in cursor:
-            users.append(User.from_bson(document))
-        return users
+            yield User.from_bson(document)
 
     def update_user_text(self, user_id: str, texts: list[BaseMessage]) -> None:
         r"""
@@ -68,18 +404,35 @@ class MongoDataBase(DataBase):
             user_id: unique user id
             texts: Tuple of conversation parts
         """
-        texts_mapped = [asdict(text) for text in texts]
+        requests = candidates_requests([(user_id, texts)])
+        if requests:
+            # candidates are written first, so answer is never stored without them
+            self.candidates.bulk_write(requests, ordered=False)
+        texts_mapped = [inline_message(text) for text in texts]
         self.collection.update_one(
             {"user_id": user_id}, {"$push": {"context": {"$each": texts_mapped}}}
         )
 
+    def update_users_texts(self, updates: list[tuple[str, list[BaseMessage]]]) -> None:
+        r"""
+        Add conversations to exists users by one ordered bulk write, replayed updates are skipped
+        Args:
+            updates: user id with conversation parts
+        """
+        candidates = candidates_requests(updates)
+        if candidates:
+            self.candidates.bulk_write(candidates, ordered=False)
+        requests = append_texts_requests(updates)
+        if requests:
+            self.collection.bulk_write(requests, ordered=True)
+
     def get_object_id_by_user_id(self, user_id: str) -> Any:
         r"""
         Return Mongo database ID by user id
         Args:
             user_id: User id passed to store in database
         """
-        doc = self.collection.find_one({"user_id": user_id})
+        doc = self.collection.find_one({"user_id": user_id}, {"_id": 1})
         if doc:
             return doc["_id"]
         return None
@@ -90,14 +443,13 @@ class MongoDataBase(DataBase):
         Args:
             user_id: User id passed to store in database
         """
-        doc = self.collection.find_one({"user_id": user_id})
-        if not doc:
-            return
-        self.collection.delete_one({"_id": doc["_id"]})
+        self.collection.delete_one({"user_id": user_id})
+        self.archive.delete_many({"user_id": user_id})
+        self.candidates.delete_many({"user_id": user_id})
 
     def clear_history(self, user_id: str) -> None:
         r"""
-        Remove messages of user
+        Remove messages of user, they are moved into archive when archive_on_clear is set
         Args:
             user_id: User id passed to store in database
         """
@@ -105,6 +457,44 @@ class MongoDataBase(DataBase):
             {"user_id": user_id},
             [{"$set": {"current_context_start_idx": {"$size": "$context"}}}],
         )
+        if self.archive_on_clear:
+            self.archive_history(user_id)
+
+    def archive_history(
+        self,
+        user_id: str,
+        chunk_size: int = ARCHIVE_CHUNK_SIZE,
+        max_messages: int = ARCHIVE_MAX_MESSAGES,
+    ) -> int:
+        r"""
+        Move messages before live window into archive collection, return number of moved messages
+        Args:
+            user_id: User id passed to store in database
+            chunk_size: max number of messages in one compressed chunk
+            max_messages: max number of messages moved by this call
+        """
+        document = self.collection.find_one(
+            {"user_id": user_id, "current_context_start_idx": {"$gt": 0}},
+            cleared_window_projection(max_messages),
+        )
+        plan = archive_plan(user_id, document, chunk_size) if document else None
+        if plan is None:
+            return 0
+        # chunks are written first, interrupted call leaves messages in user document
+        self.archive.bulk_write(plan.chunks, ordered=False)
+        result = self.collection.update_one(plan.trim_filter, plan.trim_update)
+        return plan.count if result.modified_count else 0
+
+    def iter_archived_messages(self, user_id: str) -> Iterator[BaseMessage]:
+        r"""
+        Yield archived messages of user from the oldest one, chunks are read while iterating
+        Args:
+            user_id: User id passed to store in database
+        """
+        chunks = self.archive.find({"user_id": user_id}, {"_id": 0, "data": 1}, batch_size=1)
+        for chunk in chunks.sort("first_idx", ASCENDING):
+            for message in decompress_messages(chunk["data"]):
+                yield message_from_bson(message)
 
     def get_user(self, user_id: str) -> User | None:
         r"""
@@ -118,51 +508,20 @@ class MongoDataBase(DataBase):
 
         return User.from_bson(user_bson)
 
-    def get_context(self, user_id: str, limit: int) -> tuple[BaseMessage, list[BaseMessage]]:
+    def get_context(
+        self, user_id: str, limit: int, max_tokens: int | None = None
+    ) -> tuple[BaseMessage, list[BaseMessage]]:
         r"""
         Get user object by object id
         Args:
             user_id: user id
             limit: max number of messages
+            max_tokens: max sum of message token counts
         """
 
-        user_messages = self.collection.aggregate(
-            [
-                {"$match": {"user_id": user_id}},
-                {
-                    "$project": {
-                        "filtered_messages": {
-                            "$slice": ["$context", "$current_context_start_idx", 100_000]
-                        }
-                    }
-                },
-                {
-                    "$project": {
-                        "filtered_messages": {
-                            "$lastN": {"input": "$filtered_messages", "n": limit}
-                        }
-                    }
-                },
-            ]
-        )
-        element = user_messages.try_next()
-        system_prompt_bson = self.collection.find_one({"user_id": user_id})
-        if not system_prompt_bson:
-            raise ValueError("Cannot find user!")
-        system_prompt = BaseMessage(**system_prompt_bson["system_prompt"])
-        if not element:
-            return system_prompt, []
-
-        responses = []
-        for elem in element["filtered_messages"]:
-            if elem["role"] == RoleEnum.user:
-                parsed_object = BaseMessage(**elem)
-            else:
-                parsed_object = ModelAnswer(**elem)
-
-            responses.append(parsed_object)
-
-        return system_prompt, responses
+        pipeline = context_pipeline(user_id, limit, max_tokens)
+        element = next(self.collection.aggregate(pipeline), None)
+        return context_from_bson(element)
 
     def set_message_possible_context_ids(
         self, user_id: str, answer_id: str, possible_contexts_ids: list[str]
@@ -174,6 +533,12 @@ class MongoDataBase(DataBase):
             possible_contexts_ids: ids of model answer messages
             answer_id: id of answer storing in database
         """
+        result = self.candidates.update_one(
+            {"_id": answer_id, "user_id": user_id}, {"$set": {"ids": possible_contexts_ids}}
+        )
+        if result.matched_count:
+            return
+        # answers stored before candidates collection keep their candidates inline
         self.collection.update_one(
             {
                 "user_id": user_id,
@@ -190,44 +555,31 @@ class MongoDataBase(DataBase):
             user_choice_idx: id of message user chosen
             answer_id: answer id storing in DB
         """
-
-        self.collection.update_one(
-            {
-                "user_id": user_id,
-                "context.id": answer_id,
-            },
-            {"$set": {"context.$.user_choice": user_choice_idx}},
+        candidates = self.candidates.find_one(
+            {"_id": answer_id, "user_id": user_id, "ids": user_choice_idx}
         )
-
-        user_message = self.collection.find_one(
-            {
-                "user_id": user_id,
-                "context.id": answer_id,
-            },
-            {"context.$": 1},
-        )
-        if not user_message:
-            raise ValueError(
-                f"Can not find user message. user_id: {user_id} answer_id: {answer_id}"
+        if candidates is not None:
+            # candidates are not changed after insert, so chosen text is stored by one update
+            text = chosen_text(candidates, user_choice_idx)
+            result = self.collection.update_one(
+                {"user_id": user_id, "context.id": answer_id},
+                answer_choice_update("context", user_choice_idx, text),
             )
-
-        message = user_message["context"][0]
-
-        possible_contexts = message["possible_contexts"]
-        user_choice = message["user_choice"]
-        possible_contexts_ids: list = message["possible_contexts_ids"]
-        index_of_user_choice = possible_contexts_ids.index(user_choice)
-        user_choice_text = possible_contexts[index_of_user_choice]
-
-        self.collection.update_one(
-            {
-                "user_id": user_id,
-                "context.id": answer_id,
-            },
-            {"$set": {"context.$.context": user_choice_text}},
+            if not result.matched_count:
+                raise ChoiceNotFoundError(
+                    f"Can not find user message. user_id: {user_id} answer_id: {answer_id}"
+                )
+            return text
+
+        # candidates stored inline, chosen text is resolved from possible_contexts_ids on the
+        # server in one atomic update
+        user_message = self.collection.find_one_and_update(
+            **inline_choice_arguments(user_id, answer_id, user_choice_idx)
         )
+        if not user_message:
+            raise choice_not_found(user_id, answer_id, user_choice_idx)
 
-        return user_choice_text
+        return user_message["context"][0]["context"]
 
     def update_user_custom_choice(
         self, user_id: str, message_choice_id: str, custom_text: str
@@ -239,19 +591,12 @@ class MongoDataBase(DataBase):
             custom_text: text of user variant of answer
             message_choice_id: id of message that was variant of model output
         """
-        print(user_id, message_choice_id)
-        print(
-            self.collection.find_one(
-                {
-                    "user_id": user_id,
-                    "context.possible_contexts_ids": message_choice_id,
-                }
-            )
+        candidates = self.candidates.find_one(
+            {"user_id": user_id, "ids": message_choice_id}, {"_id": 1}
         )
-        self.collection.update_one(
-            {
-                "user_id": user_id,
-                "context.possible_contexts_ids": message_choice_id,
-            },
-            {"$set": {"context.$.user_choice": "custom", "context.$.context": custom_text}},
+        message_filter = custom_choice_filter(user_id, "context", message_choice_id, candidates)
+        result = self.collection.update_one(
+            message_filter, answer_choice_update("context", "custom", custom_text)
         )
+        if not result.matched_count:
+            raise custom_choice_not_found(user_id, message_choice_id)
@@ -0,0 +1,358 @@
+from __future__ import annotations
+
+from collections.abc import AsyncIterator
+from typing import Any
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+
+from data.user_context import BaseMessage, User, message_from_bson
+from database.archive import (
+    ARCHIVE_CHUNK_SIZE,
+    ARCHIVE_MAX_MESSAGES,
+    archive_collection_name,
+    archive_plan,
+    cleared_window_projection,
+    decompress_messages,
+)
+from database.AsyncInterface import AsyncDataBase
+from database.candidates import (
+    CANDIDATES_TTL_SECONDS,
+    answer_choice_update,
+    candidates_collection_name,
+    candidates_indexes,
+    candidates_requests,
+    choice_not_found,
+    chosen_text,
+    custom_choice_filter,
+    custom_choice_not_found,
+    inline_message,
+)
+from database.Interface import ChoiceNotFoundError
+from database.mongo import (
+    CANDIDATES_HOT_QUERIES,
+    HOT_QUERIES,
+    MAX_POOL_SIZE,
+    USERS_BATCH_SIZE,
+    append_texts_requests,
+    context_from_bson,
+    context_pipeline,
+    inline_choice_arguments,
+    is_collection_scan,
+    new_user_document,
+    users_query,
+)
+from utils.logger import get_pylogger
+
+log = get_pylogger(__name__)
+
+
+class AsyncMongoDataBase(AsyncDataBase):
+    r"""
+    Database storing user messages inside user document, same as MongoDataBase.
+
+    Queries are sent by asyncio driver, so waiting for database does not hold a thread and
+    number of concurrent requests is limited only by max_pool_size connections.
+    """
+
+    def __init__(
+        self,
+        connection_string: str,
+        database_name: str,
+        table_name: str,
+        max_pool_size: int = MAX_POOL_SIZE,
+        archive_on_clear: bool = False,
+        candidates_ttl_seconds: float = CANDIDATES_TTL_SECONDS,
+    ):
+        self.client: AsyncIOMotorClient = AsyncIOMotorClient(
+            connection_string, maxPoolSize=max_pool_size
+        )
+        db = self.client.get_database(database_name)
+        self.collection = db.get_collection(table_name)
+        self.archive = db.get_collection(archive_collection_name(table_name))
+        self.candidates = db.get_collection(candidates_collection_name(table_name))
+        self.archive_on_clear = archive_on_clear
+        self.candidates_ttl_seconds = candidates_ttl_seconds
+
+    async def ensure_indexes(self) -> None:
+        r"""Create indexes used by queries, existing indexes are left untouched."""
+        try:
+            await self.collection.create_index([("user_id", ASCENDING)], unique=True)
+        except OperationFailure as exception:
+            # duplicated users created before the index existed, queries still work without it
+            log.error("Can not create unique user_id index: %s", exception)
+        await self.archive.create_index(
+            [("user_id", ASCENDING), ("first_idx", ASCENDING)], unique=True
+        )
+        try:
+            await self.candidates.create_indexes(candidates_indexes(self.candidates_ttl_seconds))
+        except OperationFailure as exception:
+            # index made with another TTL must be changed by collMod, candidates are still found
+            log.error("Can not create candidates indexes: %s", exception)
+
+    async def find_collection_scans(self) -> list[str]:
+        r"""Return names of hot queries which scan the whole collection."""
+        return [
+            name
+            for name, query in HOT_QUERIES.items()
+            if is_collection_scan(await self.collection.find(query).explain())
+        ] + [
+            name
+            for name, query in CANDIDATES_HOT_QUERIES.items()
+            if is_collection_scan(await self.candidates.find(query).explain())
+        ]
+
+    def close(self) -> None:
+        r"""Close pooled database connections."""
+        self.client.close()
+
+    async def create_user(self, user_id: str, username: str | None, chat_id: str):
+        r"""
+        Create new user
+        Args:
+            user_id:
+            username:
+            chat_id:
+        """
+        bson = new_user_document(user_id, username, chat_id)
+        result = await self.collection.update_one(
+            {"user_id": user_id}, {"$setOnInsert": bson}, upsert=True
+        )
+        if result.upserted_id is None:
+            raise ValueError(f"User with user_id:{user_id} already exists")
+
+    async def update_model_answer(self, user_id: str, message_id: str, content: str) -> Any:
+        r"""
+        Update model answer
+        Args:
+            user_id:
+            message_id:
+            content:
+        """
+
+    async def get_all_users(self) -> Any:
+        return [user async for user in self.iter_users()]
+
+    async def iter_users(
+        self,
+        after_user_id: str | None = None,
+        limit: int | None = None,
+        include_history: bool = True,
+    ) -> AsyncIterator[User]:
+        r"""
+        Yield users sorted by user id, users are read from database while iterating
+        Args:
+            after_user_id: only users with greater user id are returned
+            limit: max number of users
+            include_history: if false, users are returned without messages
+        """
+        query, projection = users_query(after_user_id, include_history)
+        cursor = self.collection.find(query, projection, batch_size=USERS_BATCH_SIZE).sort(
+            "user_id", ASCENDING
+        )
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        async for document in cursor:
+            yield User.from_bson(document)
+
+    async def update_user_text(self, user_id: str, texts: list[BaseMessage]) -> None:
+        r"""
+        Add conversation to exists user
+        Args:
+            user_id: unique user id
+            texts: Tuple of conversation parts
+        """
+        requests = candidates_requests([(user_id, texts)])
+        if requests:
+            # candidates are written first, so answer is never stored without them
+            await self.candidates.bulk_write(requests, ordered=False)
+        texts_mapped = [inline_message(text) for text in texts]
+        await self.collection.update_one(
+            {"user_id": user_id}, {"$push": {"context": {"$each": texts_mapped}}}
+        )
+
+    async def update_users_texts(self, updates: list[tuple[str, list[BaseMessage]]]) -> None:
+        r"""
+        Add conversations to exists users by one ordered bulk write, replayed updates are skipped
+        Args:
+            updates: user id with conversation parts
+        """
+        candidates = candidates_requests(updates)
+        if candidates:
+            await self.candidates.bulk_write(candidates, ordered=False)
+        requests = append_texts_requests(updates)
+        if requests:
+            await self.collection.bulk_write(requests, ordered=True)
+
+    async def get_object_id_by_user_id(self, user_id: str) -> Any:
+        r"""
+        Return Mongo database ID by user id
+        Args:
+            user_id: User id passed to store in database
+        """
+        doc = await self.collection.find_one({"user_id": user_id}, {"_id": 1})
+        if doc:
+            return doc["_id"]
+        return None
+
+    async def remove_user(self, user_id: str) -> None:
+        r"""
+        Remove user by user id or doing nothing if it not exists
+        Args:
+            user_id: User id passed to store in database
+        """
+        await self.collection.delete_one({"user_id": user_id})
+        await self.archive.delete_many({"user_id": user_id})
+        await self.candidates.delete_many({"user_id": user_id})
+
+    async def clear_history(self, user_id: str) -> None:
+        r"""
+        Remove messages of user, they are moved into archive when archive_on_clear is set
+        Args:
+            user_id: User id passed to store in database
+        """
+        await self.collection.update_one(
+            {"user_id": user_id},
+            [{"$set": {"current_context_start_idx": {"$size": "$context"}}}],
+        )
+        if self.archive_on_clear:
+            await self.archive_history(user_id)
+
+    async def archive_history(
+        self,
+        user_id: str,
+        chunk_size: int = ARCHIVE_CHUNK_SIZE,
+        max_messages: int = ARCHIVE_MAX_MESSAGES,
+    ) -> int:
+        r"""
+        Move messages before live window into archive collection, return number of moved messages
+        Args:
+            user_id: User id passed to store in database
+            chunk_size: max number of messages in one compressed chunk
+            max_messages: max number of messages moved by this call
+        """
+        document = await self.collection.find_one(
+            {"user_id": user_id, "current_context_start_idx": {"$gt": 0}},
+            cleared_window_projection(max_messages),
+        )
+        plan = archive_plan(user_id, document, chunk_size) if document else None
+        if plan is None:
+            return 0
+        await self.archive.bulk_write(plan.chunks, ordered=False)
+        result = await self.collection.update_one(plan.trim_filter, plan.trim_update)
+        return plan.count if result.modified_count else 0
+
+    async def iter_archived_messages(self, user_id: str) -> AsyncIterator[BaseMessage]:
+        r"""
+        Yield archived messages of user from the oldest one, chunks are read while iterating
+        Args:
+            user_id: User id passed to store in database
+        """
+        chunks = self.archive.find({"user_id": user_id}, {"_id": 0, "data": 1}, batch_size=1)
+        async for chunk in chunks.sort("first_idx", ASCENDING):
+            for message in decompress_messages(chunk["data"]):
+                yield message_from_bson(message)
+
+    async def get_user(self, user_id: str) -> User | None:
+        r"""
+        Get user object by user id
+        Args:
+            user_id: unique user id
+        """
+        user_bson = await self.collection.find_one({"user_id": user_id})
+        if not user_bson:
+            return None
+
+        return User.from_bson(user_bson)
+
+    async def get_context(
+        self, user_id: str, limit: int, max_tokens: int | None = None
+    ) -> tuple[BaseMessage, list[BaseMessage]]:
+        r"""
+        Get user object by object id
+        Args:
+            user_id: user id
+            limit: max number of messages
+            max_tokens: max sum of message token counts
+        """
+        pipeline = context_pipeline(user_id, limit, max_tokens)
+        elements = await self.collection.aggregate(pipeline).to_list(length=1)
+        return context_from_bson(elements[0] if elements else None)
+
+    async def set_message_possible_context_ids(
+        self, user_id: str, answer_id: str, possible_contexts_ids: list[str]
+    ) -> None:
+        r"""
+        Update ids in message
+        Args:
+            user_id: User id passed to store in database
+            possible_contexts_ids: ids of model answer messages
+            answer_id: id of answer storing in database
+        """
+        result = await self.candidates.update_one(
+            {"_id": answer_id, "user_id": user_id}, {"$set": {"ids": possible_contexts_ids}}
+        )
+        if result.matched_count:
+            return
+        # answers stored before candidates collection keep their candidates inline
+        await self.collection.update_one(
+            {
+                "user_id": user_id,
+                "context.id": answer_id,
+            },
+            {"$set": {"context.$.possible_contexts_ids": possible_contexts_ids}},
+        )
+
+    async def update_user_choice(self, user_id: str, answer_id: str, user_choice_idx: str) -> str:
+        r"""
+        Update ids in message
+        Args:
+            user_id: User id passed to store in database
+            user_choice_idx: id of message user chosen
+            answer_id: answer id storing in DB
+        """
+        candidates = await self.candidates.find_one(
+            {"_id": answer_id, "user_id": user_id, "ids": user_choice_idx}
+        )
+        if candidates is not None:
+            # candidates are not changed after insert, so chosen text is stored by one update
+            text = chosen_text(candidates, user_choice_idx)
+            result = await self.collection.update_one(
+                {"user_id": user_id, "context.id": answer_id},
+                answer_choice_update("context", user_choice_idx, text),
+            )
+            if not result.matched_count:
+                raise ChoiceNotFoundError(
+                    f"Can not find user message. user_id: {user_id} answer_id: {answer_id}"
+                )
+            return text
+
+        # candidates stored inline are resolved on the server in one atomic update
+        user_message = await self.collection.find_one_and_update(
+            **inline_choice_arguments(user_id, answer_id, user_choice_idx)
+        )
+        if not user_message:
+            raise choice_not_found(user_id, answer_id, user_choice_idx)
+
+        return user_message["context"][0]["context"]
+
+    async def update_user_custom_choice(
+        self, user_id: str, message_choice_id: str, custom_text: str
+    ) -> None:
+        r"""
+        Update ids in message
+        Args:
+            user_id: User id passed to store in database
+            custom_text: text of user variant of answer
+            message_choice_id: id of message that was variant of model output
+        """
+        candidates = await self.candidates.find_one(
+            {"user_id": user_id, "ids": message_choice_id}, {"_id": 1}
+        )
+        message_filter = custom_choice_filter(user_id, "context", message_choice_id, candidates)
+        result = await self.collection.update_one(
+            message_filter, answer_choice_update("context", "custom", custom_text)
+        )
+        if not result.matched_count:
+            raise custom_choice_not_found(user_id, message_choice_id)
@@ -0,0 +1,608 @@
+from __future__ import annotations
+
+from collections.abc import Iterator
+from itertools import groupby
+from typing import Any
+
+from pymongo import ASCENDING, MongoClient, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from data.user_context import BaseMessage, RoleEnum, User, message_from_bson
+from database.archive import archive_collection_name, decompress_messages
+from database.candidates import (
+    CANDIDATES_TTL_SECONDS,
+    answer_choice_update,
+    candidates_collection_name,
+    candidates_indexes,
+    candidates_requests,
+    choice_not_found,
+    chosen_text,
+    custom_choice_filter,
+    custom_choice_not_found,
+    inline_message,
+)
+from database.Interface import ChoiceNotFoundError, DataBase
+from database.mongo import (
+    BASE_PROMPT,
+    CANDIDATES_HOT_QUERIES,
+    MAX_POOL_SIZE,
+    USERS_BATCH_SIZE,
+    find_collection_scans,
+    user_choice_update,
+)
+from database.utils import trim_to_token_budget
+from utils.logger import get_pylogger
+
+log = get_pylogger(__name__)
+
+BUCKET_SIZE = 64
+# processes handing over the same user at once retry after the loser's copy is rejected
+HANDOVER_ATTEMPTS = 3
+
+
+class MigrationConflictError(ValueError):
+    r"""User was written by another process while its messages were copied from source."""
+
+
+def bucket_requests(
+    user_id: str, messages: list[dict], first_seq: int, bucket_size: int
+) -> list[ReplaceOne]:
+    r"""
+    Build writes of buckets holding source messages from first_seq to the end. Every bucket is
+    replaced by all its messages, so writing it again leaves the same bucket. Bucket holding
+    more messages, appended by service after its user was copied, is not replaced, its write
+    fails on unique index
+    Args:
+        user_id: user id
+        messages: source messages from first_seq to the end
+        first_seq: sequence number of the first message, it starts a bucket
+        bucket_size: max number of messages in bucket
+    """
+    requests = []
+    for start in range(0, len(messages), bucket_size):
+        bucket_seq = first_seq + start
+        bucket_messages = [
+            {**inline_message(message_from_bson(message)), "seq": seq}
+            for seq, message in enumerate(messages[start : start + bucket_size], start=bucket_seq)
+        ]
+        bucket_filter = {"user_id": user_id, "seq": bucket_seq}
+        bucket = {**bucket_filter, "messages": bucket_messages, "count": len(bucket_messages)}
+        requests.append(
+            ReplaceOne(
+                {**bucket_filter, "count": {"$lte": len(bucket_messages)}}, bucket, upsert=True
+            )
+        )
+    return requests
+
+
+def source_messages(source: Collection, source_bson: dict, first_seq: int) -> list[dict]:
+    r"""
+    Return messages of source user from first_seq to the end, messages before archived_count
+    are read from archive collection
+    Args:
+        source: collection of users with embedded context array
+        source_bson: user document
+        first_seq: sequence number of the first returned message
+    """
+    user_id = source_bson["user_id"]
+    archived_count = source_bson.get("archived_count", 0)
+    messages: list[dict] = []
+    if first_seq < archived_count:
+        archive = source.database.get_collection(archive_collection_name(source.name))
+        # chunks of interrupted archiving start at archived_count, their messages are in context
+        chunks = archive.find(
+            {"user_id": user_id, "first_idx": {"$lt": archived_count}},
+            {"_id": 0, "first_idx": 1, "data": 1},
+        )
+        for chunk in chunks.sort("first_idx", 1):
+            chunk_messages = decompress_messages(chunk["data"])
+            if chunk["first_idx"] + len(chunk_messages) > first_seq:
+                messages += chunk_messages[max(first_seq - chunk["first_idx"], 0) :]
+        if len(messages) != archived_count - first_seq:
+            raise ValueError(f"Archive of user {user_id} misses messages")
+    return messages + source_bson["context"][max(first_seq - archived_count, 0) :]
+
+
+class BucketedMongoDataBase(DataBase):
+    r"""
+    Database storing user messages out of user document.
+
+    Messages are numbered by per user sequence number and grouped into bucket documents of
+    BUCKET_SIZE messages in separate collection, so user document has fixed size and every
+    write touches only the newest bucket.
+
+    While users are migrated from embedded storage, migration_source_table names its table:
+    messages written there since the last migration pass are copied before this process serves
+    the user for the first time, so service is switched to buckets without stopping it.
+    """
+
+    def __init__(
+        self,
+        connection_string: str,
+        database_name: str,
+        table_name: str,
+        bucket_size: int = BUCKET_SIZE,
+        max_pool_size: int = MAX_POOL_SIZE,
+        candidates_ttl_seconds: float = CANDIDATES_TTL_SECONDS,
+        migration_source_table: str | None = None,
+    ):
+        client: MongoClient = MongoClient(connection_string, maxPoolSize=max_pool_size)
+        db = client.get_database(database_name)
+        self.collection = db.get_collection(table_name)
+        self.messages = db.get_collection(f"{table_name}_messages")
+        self.candidates = db.get_collection(candidates_collection_name(table_name))
+        self.bucket_size = bucket_size
+        self.candidates_ttl_seconds = candidates_ttl_seconds
+        self.migration_source = (
+            None if migration_source_table is None else db.get_collection(migration_source_table)
+        )
+        # ids of users whose messages were copied from migration source by this process
+        self.handed_over: set[str] = set()
+        self.ensure_indexes()
+
+    def ensure_indexes(self) -> None:
+        r"""Create indexes used by queries, existing indexes are left untouched."""
+        self.collection.create_index([("user_id", ASCENDING)], unique=True)
+        self.messages.create_index([("user_id", ASCENDING), ("seq", ASCENDING)], unique=True)
+        self.messages.create_index([("user_id", ASCENDING), ("messages.id", ASCENDING)])
+        self.messages.create_index(
+            [("user_id", ASCENDING), ("messages.possible_contexts_ids", ASCENDING)]
+        )
+        try:
+            self.candidates.create_indexes(candidates_indexes(self.candidates_ttl_seconds))
+        except OperationFailure as exception:
+            # index made with another TTL must be changed by collMod, candidates are still found
+            log.error("Can not create candidates indexes: %s", exception)
+
+    def find_collection_scans(self) -> list[str]:
+        r"""Return names of hot queries which scan the whole collection."""
+        user_queries = {"user": {"user_id": ""}, "users_page": {"user_id": {"$gt": ""}}}
+        bucket_queries = {
+            "buckets": {"user_id": "", "seq": {"$gte": 0, "$lte": 0}},
+            "answer": {"user_id": "", "messages.id": ""},
+            "answer_by_candidate": {"user_id": "", "messages.possible_contexts_ids": ""},
+        }
+        return (
+            find_collection_scans(self.collection, user_queries)
+            + find_collection_scans(self.messages, bucket_queries)
+            + find_collection_scans(self.candidates, CANDIDATES_HOT_QUERIES)
+        )
+
+    def create_user(self, user_id: str, username: str | None, chat_id: str):
+        r"""
+        Create new user
+        Args:
+            user_id:
+            username:
+            chat_id:
+        """
+        self._hand_over(user_id)
+        system_prompt = BaseMessage(RoleEnum.system, RoleEnum.system, BASE_PROMPT)
+        result = self.collection.update_one(
+            {"user_id": user_id},
+            {
+                "$setOnInsert": {
+                    "user_id": user_id,
+                    "username": username,
+                    "chat_id": chat_id,
+                    "system_prompt": system_prompt.to_bson(),
+                    "current_context_start_idx": 0,
+                    "message_count": 0,
+                }
+            },
+            upsert=True,
+        )
+        if result.upserted_id is None:
+            raise ValueError(f"User with user_id:{user_id} already exists")
+
+    def update_model_answer(self, user_id: str, message_id: str, content: str) -> Any:
+        r"""
+        Update model answer
+        Args:
+            user_id:
+            message_id:
+            content:
+        """
+
+    def get_all_users(self) -> Any:
+        return list(self.iter_users())
+
+    def iter_users(
+        self,
+        after_user_id: str | None = None,
+        limit: int | None = None,
+        include_history: bool = True,
+    ) -> Iterator[User]:
+        r"""
+        Yield users sorted by user id, users are read from database while iterating
+        Args:
+            after_user_id: only users with greater user id are returned
+            limit: max number of users
+            include_history: if false, users are returned without messages
+        """
+        query = {} if after_user_id is None else {"user_id": {"$gt": after_user_id}}
+        users = self.collection.find(query, batch_size=USERS_BATCH_SIZE).sort("user_id", ASCENDING)
+        if limit is not None:
+            users = users.limit(limit)
+        if not include_history:
+            for document in users:
+                yield User.from_bson(document)
+            return
+
+        buckets = self.messages.find(
+            query, {"_id": 0, "user_id": 1, "messages": 1}, batch_size=USERS_BATCH_SIZE
+        ).sort([("user_id", ASCENDING), ("seq", ASCENDING)])
+        users_buckets = groupby(buckets, key=lambda bucket: bucket["user_id"])
+        next_user_buckets = next(users_buckets, None)
+        for document in users:
+            # both cursors are sorted by user id, so buckets are joined without extra queries
+            while next_user_buckets is not None and next_user_buckets[0] < document["user_id"]:
+                next_user_buckets = next(users_buckets, None)
+            context: list[dict] = []
+            if next_user_buckets is not None and next_user_buckets[0] == document["user_id"]:
+                for bucket in next_user_buckets[1]:
+                    context.extend(bucket["messages"])
+                next_user_buckets = next(users_buckets, None)
+            yield User.from_bson({**document, "context": context})
+
+    def update_user_text(self, user_id: str, texts: list[BaseMessage]) -> None:
+        r"""
+        Add conversation to exists user
+        Args:
+            user_id: unique user id
+            texts: Tuple of conversation parts
+        """
+        if not texts:
+            return
+        self._hand_over(user_id)
+        self._append_texts(user_id, texts)
+
+    def _append_texts(self, user_id: str, texts: list[BaseMessage]) -> None:
+        r"""Store messages after the last message of user."""
+        user = self.collection.find_one_and_update(
+            {"user_id": user_id},
+            {"$inc": {"message_count": len(texts)}},
+            projection={"_id": 0, "message_count": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+        if not user:
+            return
+
+        candidates = candidates_requests([(user_id, texts)])
+        if candidates:
+            # candidates are written first, so answer is never stored without them
+            self.candidates.bulk_write(candidates, ordered=False)
+        first_seq = user["message_count"] - len(texts)
+        texts_mapped = [
+            {**inline_message(text), "seq": seq} for seq, text in enumerate(texts, start=first_seq)
+        ]
+        requests = []
+        for bucket_seq, grouped in groupby(texts_mapped, key=self._bucket_seq):
+            messages = list(grouped)
+            requests.append(
+                UpdateOne(
+                    {"user_id": user_id, "seq": bucket_seq},
+                    {
+                        # concurrent writers may reach the bucket out of order
+                        "$push": {"messages": {"$each": messages, "$sort": {"seq": 1}}},
+                        "$inc": {"count": len(messages)},
+                    },
+                    upsert=True,
+                )
+            )
+        self.messages.bulk_write(requests, ordered=True)
+
+    def get_object_id_by_user_id(self, user_id: str) -> Any:
+        r"""
+        Return Mongo database ID by user id
+        Args:
+            user_id: User id passed to store in database
+        """
+        self._hand_over(user_id)
+        doc = self.collection.find_one({"user_id": user_id}, {"_id": 1})
+        if doc:
+            return doc["_id"]
+        return None
+
+    def remove_user(self, user_id: str) -> None:
+        r"""
+        Remove user by user id or doing nothing if it not exists
+        Args:
+            user_id: User id passed to store in database
+        """
+        if self.migration_source is not None:
+            # otherwise the next migration pass would copy removed user back
+            self.migration_source.delete_one({"user_id": user_id})
+            self.migration_source.database.get_collection(
+                archive_collection_name(self.migration_source.name)
+            ).delete_many({"user_id": user_id})
+            self.handed_over.discard(user_id)
+        self.collection.delete_one({"user_id": user_id})
+        self.messages.delete_many({"user_id": user_id})
+        self.candidates.delete_many({"user_id": user_id})
+
+    def clear_history(self, user_id: str) -> None:
+        r"""
+        Remove messages of user
+        Args:
+            user_id: User id passed to store in database
+        """
+        self._hand_over(user_id)
+        self.collection.update_one(
+            {"user_id": user_id},
+            [{"$set": {"current_context_start_idx": "$message_count"}}],
+        )
+
+    def get_user(self, user_id: str) -> User | None:
+        r"""
+        Get user object by user id
+        Args:
+            user_id: unique user id
+        """
+        self._hand_over(user_id)
+        user_bson = self.collection.find_one({"user_id": user_id})
+        if not user_bson:
+            return None
+
+        context = list(self._iter_messages(user_id, 0, user_bson["message_count"]))
+        return User.from_bson({**user_bson, "context": context})
+
+    def get_context(
+        self, user_id: str, limit: int, max_tokens: int | None = None
+    ) -> tuple[BaseMessage, list[BaseMessage]]:
+        r"""
+        Get user object by object id
+        Args:
+            user_id: user id
+            limit: max number of messages
+            max_tokens: max sum of message token counts
+        """
+        self._hand_over(user_id)
+        user = self.collection.find_one(
+            {"user_id": user_id},
+            {"_id": 0, "system_prompt": 1, "current_context_start_idx": 1, "message_count": 1},
+        )
+        if not user:
+            raise ValueError("Cannot find user!")
+        system_prompt = BaseMessage(**user["system_prompt"])
+
+        end_seq = user["message_count"]
+        start_seq = max(user["current_context_start_idx"], end_seq - limit)
+        responses = [
+            message_from_bson(message)
+            for message in self._iter_messages(user_id, start_seq, end_seq)
+        ]
+        if max_tokens is not None:
+            responses = trim_to_token_budget(responses, max_tokens)
+        return system_prompt, responses
+
+    def set_message_possible_context_ids(
+        self, user_id: str, answer_id: str, possible_contexts_ids: list[str]
+    ) -> None:
+        r"""
+        Update ids in message
+        Args:
+            user_id: User id passed to store in database
+            possible_contexts_ids: ids of model answer messages
+            answer_id: id of answer storing in database
+        """
+        self._hand_over(user_id)
+        result = self.candidates.update_one(
+            {"_id": answer_id, "user_id": user_id}, {"$set": {"ids": possible_contexts_ids}}
+        )
+        if result.matched_count:
+            return
+        # answers stored before candidates collection keep their candidates inline
+        self.messages.update_one(
+            {"user_id": user_id, "messages.id": answer_id},
+            {"$set": {"messages.$.possible_contexts_ids": possible_contexts_ids}},
+        )
+
+    def update_user_choice(self, user_id: str, answer_id: str, user_choice_idx: str) -> str:
+        r"""
+        Update ids in message
+        Args:
+            user_id: User id passed to store in database
+            user_choice_idx: id of message user chosen
+            answer_id: answer id storing in DB
+        """
+        self._hand_over(user_id)
+        candidates = self.candidates.find_one(
+            {"_id": answer_id, "user_id": user_id, "ids": user_choice_idx}
+        )
+        if candidates is not None:
+            # candidates are not changed after insert, so chosen text is stored by one update
+            text = chosen_text(candidates, user_choice_idx)
+            result = self.messages.update_one(
+                {"user_id": user_id, "messages.id": answer_id},
+                answer_choice_update("messages", user_choice_idx, text),
+            )
+            if not result.matched_count:
+                raise ChoiceNotFoundError(
+                    f"Can not find user message. user_id: {user_id} answer_id: {answer_id}"
+                )
+            return text
+
+        bucket = self.messages.find_one_and_update(
+            {
+                "user_id": user_id,
+                "messages": {
+                    "$elemMatch": {"id": answer_id, "possible_contexts_ids": user_choice_idx}
+                },
+            },
+            user_choice_update("messages", answer_id, user_choice_idx),
+            projection={"_id": 0, "messages": {"$elemMatch": {"id": answer_id}}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if not bucket:
+            raise choice_not_found(user_id, answer_id, user_choice_idx)
+
+        return bucket["messages"][0]["context"]
+
+    def update_user_custom_choice(
+        self, user_id: str, message_choice_id: str, custom_text: str
+    ) -> None:
+        r"""
+        Update ids in message
+        Args:
+            user_id: User id passed to store in database
+            custom_text: text of user variant of answer
+            message_choice_id: id of message that was variant of model output
+        """
+        self._hand_over(user_id)
+        candidates = self.candidates.find_one(
+            {"user_id": user_id, "ids": message_choice_id}, {"_id": 1}
+        )
+        message_filter = custom_choice_filter(user_id, "messages", message_choice_id, candidates)
+        result = self.messages.update_one(
+            message_filter, answer_choice_update("messages", "custom", custom_text)
+        )
+        if not result.matched_count:
+            raise custom_choice_not_found(user_id, message_choice_id)
+
+    def migrate_user(self, source: Collection, source_bson: dict) -> int:
+        r"""
+        Copy not yet copied messages of user with embedded context array. Messages keep their
+        position among all messages of user as sequence number, messages written to source
+        after user was written by bucketed service are appended after its messages
+        Args:
+            source: collection of users with embedded context array
+            source_bson: user document with embedded context array
+        Returns:
+            number of copied messages
+        """
+        user_id = source_bson["user_id"]
+        # positions in document are shifted by messages moved into archive
+        archived_count = source_bson.get("archived_count", 0)
+        message_count = archived_count + len(source_bson["context"])
+        target_bson = self.collection.find_one_and_update(
+            {"user_id": user_id},
+            {
+                "$setOnInsert": {
+                    "user_id": user_id,
+                    "username": source_bson["username"],
+                    "chat_id": source_bson["chat_id"],
+                    "system_prompt": source_bson["system_prompt"],
+                    "current_context_start_idx": 0,
+                    "message_count": 0,
+                    "migrated_count": 0,
+                },
+            },
+            projection={"_id": 0, "message_count": 1, "migrated_count": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        # users created by bucketed service have no migrated count, users it wrote messages to
+        # have more messages than were migrated
+        migrated_count = target_bson.get("migrated_count")
+        if target_bson["message_count"] != migrated_count:
+            return self._append_source_messages(source, source_bson, migrated_count)
+
+        new_messages: list[BaseMessage] = []
+        if message_count > migrated_count:
+            first_seq = migrated_count - migrated_count % self.bucket_size
+            messages = source_messages(source, source_bson, first_seq)
+            new_messages = [
+                message_from_bson(message) for message in messages[migrated_count - first_seq :]
+            ]
+            candidates = candidates_requests([(user_id, new_messages)])
+            if candidates:
+                self.candidates.bulk_write(candidates, ordered=False)
+            try:
+                self.messages.bulk_write(
+                    bucket_requests(user_id, messages, first_seq, self.bucket_size), ordered=True
+                )
+            except BulkWriteError as exception:
+                raise MigrationConflictError(
+                    f"User {user_id} was changed while migrating"
+                ) from exception
+        # counts are moved only from values read above, so messages written by service are kept
+        result = self.collection.update_one(
+            {
+                "user_id": user_id,
+                "message_count": migrated_count,
+                "migrated_count": migrated_count,
+            },
+            {
+                "$max": {
+                    "message_count": message_count,
+                    "migrated_count": message_count,
+                    "current_context_start_idx": archived_count
+                    + source_bson["current_context_start_idx"],
+                }
+            },
+        )
+        if not result.matched_count:
+            raise MigrationConflictError(f"User {user_id} was changed while migrating")
+        return len(new_messages)
+
+    def _append_source_messages(
+        self, source: Collection, source_bson: dict, migrated_count: int | None
+    ) -> int:
+        r"""
+        Append messages written to source after user was written by bucketed service, e.g. by
+        embedded service still running during switch
+        Args:
+            source: collection of users with embedded context array
+            source_bson: user document with embedded context array
+            migrated_count: number of source messages already copied, None for users created by
+                bucketed service
+        Returns:
+            number of copied messages
+        """
+        user_id = source_bson["user_id"]
+        messages = source_messages(source, source_bson, migrated_count or 0)
+        if not messages:
+            return 0
+        # messages are appended before they are counted, so a crash in between copies them twice
+        self._append_texts(user_id, [message_from_bson(message) for message in messages])
+        result = self.collection.update_one(
+            # null matches missing migrated count too
+            {"user_id": user_id, "migrated_count": migrated_count},
+            {"$set": {"migrated_count": (migrated_count or 0) + len(messages)}},
+        )
+        if not result.matched_count:
+            raise MigrationConflictError(f"User {user_id} was changed while migrating")
+        log.warning(
+            "Appended %s messages of user %s written to source after switch",
+            len(messages),
+            user_id,
+        )
+        return len(messages)
+
+    def _hand_over(self, user_id: str) -> None:
+        r"""Copy messages of user written to migration source before it is served first time."""
+        if self.migration_source is None or user_id in self.handed_over:
+            return
+        for attempt in range(1, HANDOVER_ATTEMPTS + 1):
+            source_bson = self.migration_source.find_one({"user_id": user_id}, {"_id": 0})
+            try:
+                if source_bson is not None:
+                    self.migrate_user(self.migration_source, source_bson)
+            except MigrationConflictError:
+                if attempt == HANDOVER_ATTEMPTS:
+                    raise
+            else:
+                self.handed_over.add(user_id)
+                return
+
+    def _bucket_seq(self, message: dict) -> int:
+        return message["seq"] - message["seq"] % self.bucket_size
+
+    def _iter_messages(self, user_id: str, start_seq: int, end_seq: int) -> Iterator[dict]:
+        r"""Yield stored messages with sequence number in [start_seq, end_seq) without seq."""
+        if start_seq >= end_seq:
+            return
+        buckets = self.messages.find(
+            {
+                "user_id": user_id,
+                "seq": {"$gte": start_seq - start_seq % self.bucket_size, "$lt": end_seq},
+            },
+            {"_id": 0, "messages": 1},
+        ).sort("seq", ASCENDING)
+        for bucket in buckets:
+            for message in bucket["messages"]:
+                seq = message.pop("seq")
+                if start_seq <= seq < end_seq:
+                    yield message
@@ -0,0 +1,25 @@
+from __future__ import annotations
+
+from data.user_context import BaseMessage
+
+
+def trim_to_token_budget(messages: list[BaseMessage], max_tokens: int) -> list[BaseMessage]:
+    r"""
+    Keep the newest messages which fit into token budget.
+    Messages are dropped by pairs from the oldest one as Conversation.shrink does, messages
+    stored without token_count are counted as empty.
+    Args:
+        messages: user messages, oldest first
+        max_tokens: max sum of message token counts
+    """
+    tokens = 0
+    kept = 0
+    for message in reversed(messages):
+        tokens += message.token_count or 0
+        if tokens > max_tokens:
+            break
+        kept += 1
+
+    dropped = len(messages) - kept
+    dropped += dropped % 2
+    return messages[dropped:]
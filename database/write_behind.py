@@ -0,0 +1,347 @@
+from __future__ import annotations
+
+import asyncio
+from collections.abc import AsyncIterator
+from dataclasses import asdict, dataclass
+from typing import Any
+
+from data.user_context import BaseMessage, User
+from database.AsyncInterface import AsyncDataBase
+from database.journal import WriteJournal
+from database.utils import trim_to_token_budget
+from utils.logger import get_pylogger
+
+log = get_pylogger(__name__)
+
+DEFAULT_FLUSH_INTERVAL_MS = 50
+DEFAULT_MAX_BATCH_SIZE = 500
+DEFAULT_MAX_RETRIES = 10
+
+
+@dataclass
+class WriteBehindMetrics:
+    """Counters of updates written in background."""
+
+    pending: int = 0
+    flushes: int = 0
+    flushed_updates: int = 0
+    failed_flushes: int = 0
+    consecutive_failed_flushes: int = 0
+    recovered_updates: int = 0
+    dead_letter_updates: int = 0
+
+    def as_dict(self) -> dict:
+        """Return counters."""
+        return asdict(self)
+
+
+# buffers, locks and worker of background flush are kept together
+class WriteBehindDataBase(AsyncDataBase):  # pylint: disable=too-many-instance-attributes
+    r"""
+    Database acknowledging conversation updates once they are stored in local journal.
+
+    Updates are written to database in background by one bulk write per flush. Context and user
+    reads merge updates which are not written yet, other changes of user wait until its pending
+    updates are written. Journal segments left by crashed process are replayed by start.
+
+    Batch failed max_retries flushes in a row is written update by update, updates which still
+    fail are saved to dead letter file of journal and logged, so one broken update does not block
+    the others.
+    """
+
+    def __init__(
+        self,
+        database: AsyncDataBase,
+        journal: WriteJournal,
+        flush_interval_ms: float = DEFAULT_FLUSH_INTERVAL_MS,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+    ):
+        self.database = database
+        self.journal = journal
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.max_retries = max_retries
+        self.metrics = WriteBehindMetrics()
+        self._pending: list[tuple[str, list[BaseMessage]]] = []
+        self._flushing: list[tuple[str, list[BaseMessage]]] = []
+        # segments of failed flushes are discarded by the next successful one
+        self._flushed_segments: list[str] = []
+        self._flush_lock = asyncio.Lock()
+        # update is added to pending list together with its journal segment
+        self._journal_lock = asyncio.Lock()
+        self._batch_full = asyncio.Event()
+        self._worker: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        r"""Write updates of journals left by stopped processes and start background flushes."""
+        for path, updates in await asyncio.to_thread(lambda: list(self.journal.recover())):
+            # replayed updates already written before crash are skipped by database
+            await self.database.update_users_texts(updates)
+            await asyncio.to_thread(self.journal.discard, [path])
+            self.metrics.recovered_updates += len(updates)
+            log.info("Recovered %s updates of journal %s", len(updates), path)
+        self._worker = asyncio.create_task(self._flush_periodically())
+
+    async def aclose(self) -> None:
+        r"""Stop background flushes and write all pending updates."""
+        if self._worker is not None:
+            self._worker.cancel()
+        try:
+            await self.flush()
+        finally:
+            await asyncio.to_thread(self.journal.close)
+
+    async def flush(self) -> None:
+        r"""Write all pending updates to database."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            async with self._journal_lock:
+                self._flushing, self._pending = self._pending, []
+                self.metrics.pending = 0
+                self._flushed_segments.append(await asyncio.to_thread(self.journal.rotate))
+            try:
+                flushed = await self._write(self._flushing)
+            finally:
+                self._flushing = []
+            await asyncio.to_thread(self.journal.discard, self._flushed_segments)
+            self._flushed_segments = []
+            self.metrics.flushes += 1
+            self.metrics.flushed_updates += flushed
+
+    async def _write(self, updates: list[tuple[str, list[BaseMessage]]]) -> int:
+        try:
+            await self.database.update_users_texts(updates)
+        except Exception:  # pylint: disable=broad-except
+            self.metrics.failed_flushes += 1
+            self.metrics.consecutive_failed_flushes += 1
+            if self.metrics.consecutive_failed_flushes < self.max_retries:
+                # updates stay in journal and are written again by the next flush
+                self._pending = updates + self._pending
+                self.metrics.pending = len(self._pending)
+                raise
+            log.exception(
+                "Flush failed %s times in a row, write updates one by one",
+                self.metrics.consecutive_failed_flushes,
+            )
+            dead_letter = await self._write_one_by_one(updates)
+            self.metrics.consecutive_failed_flushes = 0
+            return len(updates) - dead_letter
+        self.metrics.consecutive_failed_flushes = 0
+        return len(updates)
+
+    async def _write_one_by_one(self, updates: list[tuple[str, list[BaseMessage]]]) -> int:
+        dead_letter: list[tuple[str, list[BaseMessage]]] = []
+        dead_users: set[str] = set()
+        for user_id, texts in updates:
+            # later updates of user follow its failed one, so order of messages is kept
+            if user_id not in dead_users:
+                try:
+                    await self.database.update_users_texts([(user_id, texts)])
+                    continue
+                except Exception:  # pylint: disable=broad-except
+                    log.exception("Can not write update of user %s", user_id)
+                    dead_users.add(user_id)
+            dead_letter.append((user_id, texts))
+        if dead_letter:
+            path = await asyncio.to_thread(self.journal.dead_letter, dead_letter)
+            self.metrics.dead_letter_updates += len(dead_letter)
+            log.error(
+                "Saved %s updates of users %s to dead letter file %s",
+                len(dead_letter),
+                ", ".join(sorted(dead_users)),
+                path,
+            )
+        return len(dead_letter)
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_full.clear()
+            try:
+                await self.flush()
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Can not write pending updates, retry on the next flush")
+
+    def _pending_texts(self, user_id: str) -> list[BaseMessage]:
+        return [
+            text
+            for pending_user_id, texts in self._flushing + self._pending
+            if pending_user_id == user_id
+            for text in texts
+        ]
+
+    async def _flush_user(self, user_id: str) -> None:
+        if self._pending_texts(user_id):
+            await self.flush()
+
+    async def get_all_users(self) -> Any:
+        return [user async for user in self.iter_users()]
+
+    async def iter_users(
+        self,
+        after_user_id: str | None = None,
+        limit: int | None = None,
+        include_history: bool = True,
+    ) -> AsyncIterator[User]:
+        r"""
+        Yield users sorted by user id, users are read from database while iterating
+        Args:
+            after_user_id: only users with greater user id are returned
+            limit: max number of users
+            include_history: if false, users are returned without messages
+        """
+        await self.flush()
+        async for user in self.database.iter_users(after_user_id, limit, include_history):
+            yield user
+
+    async def update_model_answer(self, user_id: str, message_id: str, content: str) -> Any:
+        r"""
+        Update model answer
+        Args:
+            user_id:
+            message_id:
+            content:
+        """
+        await self._flush_user(user_id)
+        return await self.database.update_model_answer(user_id, message_id, content)
+
+    async def create_user(self, user_id: str, username: str | None, chat_id: str):
+        r"""
+        Create new user
+        Args:
+            user_id:
+            username:
+            chat_id:
+        """
+        return await self.database.create_user(user_id=user_id, username=username, chat_id=chat_id)
+
+    async def get_object_id_by_user_id(self, user_id: str) -> Any:
+        r"""
+        Return Mongo database ID by user id
+        Args:
+            user_id: unique user id
+        """
+        return await self.database.get_object_id_by_user_id(user_id)
+
+    async def update_user_text(self, user_id: str, texts: list[BaseMessage]) -> None:
+        r"""
+        Store conversation in journal, it is written to database by background flush
+        Args:
+            user_id: unique user id
+            texts: Tuple of conversation parts
+        """
+        async with self._journal_lock:
+            written = await asyncio.to_thread(self.journal.write, user_id, texts)
+            self._pending.append((user_id, texts))
+        self.metrics.pending = len(self._pending)
+        if len(self._pending) >= self.max_batch_size:
+            self._batch_full.set()
+        # fsync is waited without the lock, so concurrent updates share it
+        await asyncio.to_thread(self.journal.sync, written)
+
+    async def update_users_texts(self, updates: list[tuple[str, list[BaseMessage]]]) -> None:
+        r"""
+        Store conversations in journal, they are written to database by background flush
+        Args:
+            updates: user id with conversation parts
+        """
+        for user_id, texts in updates:
+            await self.update_user_text(user_id, texts)
+
+    async def remove_user(self, user_id: str) -> None:
+        r"""
+        Remove user by user id or doing nothing if it not exists
+        Args:
+            user_id: unique user id
+        """
+        await self._flush_user(user_id)
+        await self.database.remove_user(user_id=user_id)
+
+    async def get_user(self, user_id: str) -> User | None:
+        r"""
+        Get user object with messages which are not written yet
+        Args:
+            user_id: unique user id
+        """
+        pending_texts = self._pending_texts(user_id)
+        user = await self.database.get_user(user_id=user_id)
+        if user is not None:
+            stored_ids = {message.id for message in user.context}
+            user.context += [text for text in pending_texts if text.id not in stored_ids]
+        return user
+
+    async def get_context(
+        self, user_id: str, limit: int, max_tokens: int | None = None
+    ) -> tuple[BaseMessage, list[BaseMessage]]:
+        r"""Get context of user with messages which are not written yet.
+
+        Args:
+            user_id: unique user id
+            limit: max number of messages
+            max_tokens: max sum of message token counts
+        """
+        # pending messages are taken before read, messages flushed meanwhile are in database
+        pending_texts = self._pending_texts(user_id)
+        system_prompt, messages = await self.database.get_context(user_id, limit, max_tokens)
+        if not pending_texts:
+            return system_prompt, messages
+
+        stored_ids = {message.id for message in messages}
+        messages = messages + [text for text in pending_texts if text.id not in stored_ids]
+        messages = messages[-limit:] if limit > 0 else []
+        if max_tokens is not None:
+            messages = trim_to_token_budget(messages, max_tokens)
+        return system_prompt, messages
+
+    async def clear_history(self, user_id: str) -> None:
+        r"""
+        Remove messages of user
+        Args:
+            user_id: User id passed to store in database
+        """
+        await self._flush_user(user_id)
+        await self.database.clear_history(user_id=user_id)
+
+    async def set_message_possible_context_ids(
+        self, user_id: str, answer_id: str, possible_contexts_ids: list[str]
+    ) -> None:
+        r"""
+        Update ids in message
+        Args:
+            user_id: User id passed to store in database
+            possible_contexts_ids: ids of model answer messages
+            answer_id: id of answer storing in database
+        """
+        await self._flush_user(user_id)
+        await self.database.set_message_possible_context_ids(
+            user_id, answer_id, possible_contexts_ids
+        )
+
+    async def update_user_choice(self, user_id: str, answer_id: str, user_choice_idx: str) -> str:
+        r"""
+        Update ids in message
+        Args:
+            user_id: User id passed to store in database
+            user_choice_idx: id of message user chosen
+            answer_id: answer id storing in DB
+        """
+        await self._flush_user(user_id)
+        return await self.database.update_user_choice(user_id, answer_id, user_choice_idx)
+
+    async def update_user_custom_choice(
+        self, user_id: str, message_choice_id: str, custom_text: str
+    ) -> None:
+        r"""
+        Update ids in message
+        Args:
+            user_id: User id passed to store in database
+            custom_text: text of user variant of answer
+            message_choice_id: id of message that was variant of model output
+        """
+        await self._flush_user(user_id)
+        await self.database.update_user_custom_choice(user_id, message_choice_id, custom_text)
@@ -0,0 +1,45 @@
+"""Gunicorn config running several uvicorn workers forked from one preloaded app.
+
+Tokenizer and templates are loaded once by master process before fork, so workers share their
+memory pages. Database and LLM api clients are created by every worker in app lifespan:
+
+    WEB_CONCURRENCY=4 gunicorn app:app -c gunicorn.conf.py
+"""
+import gc
+import multiprocessing
+import os
+
+from prometheus_client import multiprocess
+
+# rust tokenizers thread pool does not survive fork, workers tokenize in their own threadpools
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+os.environ.setdefault("TOKENIZER_PRELOAD", "1")
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 52111)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = int(os.environ.get("WORKER_TIMEOUT", 300))
+graceful_timeout = 30
+keepalive = 5
+
+
+def on_starting(server):
+    r"""Warn that context windows cached by every worker are not shared."""
+    if server.cfg.workers > 1 and int(os.environ.get("USER_CACHE_SIZE", 0)) > 0:
+        server.log.warning(
+            "USER_CACHE_SIZE is set with %s workers, every worker caches its own context windows "
+            "and serves windows missing turns saved by other workers for USER_CACHE_TTL seconds",
+            server.cfg.workers,
+        )
+
+
+def pre_fork(server, worker):  # pylint: disable=unused-argument
+    r"""Move preloaded objects out of garbage collector, so its passes do not copy shared pages."""
+    gc.freeze()
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    r"""Drop live gauges of exited worker from merged Prometheus metrics."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(worker.pid)
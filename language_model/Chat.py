@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 import json
 
 from transformers import PreTrainedTokenizer
@@ -20,13 +22,21 @@ class Conversation:
         start_token_id=DEFAULT_START_TOKEN_ID,
         end_token_id=DEFAULT_END_TOKEN_ID,
         bot_token_id=DEFAULT_BOT_TOKEN_ID,
+        generation_suffix=None,
     ):
         self.message_template = message_template
         self.role_mapping = role_mapping or {}
         self.start_token_id = start_token_id
         self.end_token_id = end_token_id
         self.bot_token_id = bot_token_id
+        # decoded start and bot tokens, decoded on every call when it is not passed
+        self.generation_suffix = generation_suffix
         self.messages = [{"role": "system", "content": system_prompt}]
+        # formatted text and token count of every message, filled lazily and reused by shrink
+        self.formatted_messages: list[str | None] = [None]
+        self.message_token_counts: list[int | None] = [None]
+        # sum of token counts of messages kept in the last prompt shrunk by max_tokens
+        self.prompt_token_count: int | None = None
 
     def get_end_token_id(self):
         r"""Return end of generation token id."""
@@ -42,11 +52,42 @@ class Conversation:
 
     def add_user_message(self, message: str):
         r"""Add new user message to previous messages."""
-        self.messages.append({"role": "user", "content": message})
+        self._append_message({"role": "user", "content": message})
 
     def add_bot_message(self, message: str):
         r"""Add bot message to previous messages."""
-        self.messages.append({"role": "bot", "content": message})
+        self._append_message({"role": "bot", "content": message})
+
+    def _append_message(
+        self, message: dict, formatted: str | None = None, token_count: int | None = None
+    ):
+        self.messages.append(message)
+        self.formatted_messages.append(formatted)
+        self.message_token_counts.append(token_count)
+
+    def extend_tokenized(
+        self, messages: list[dict], formatted: list[str], token_counts: list[int | None]
+    ):
+        r"""Add messages which were already formatted and tokenized by this template."""
+        for message, message_text, token_count in zip(messages, formatted, token_counts):
+            self._append_message(message, message_text, token_count)
+
+    def get_formatted_messages(self) -> list[str]:
+        r"""Return text of every message formatted by template."""
+        for idx, message_text in enumerate(self.formatted_messages):
+            if message_text is None:
+                self.formatted_messages[idx] = self.message_template.format(**self.messages[idx])
+        return self.formatted_messages
+
+    def get_message_token_counts(self, tokenizer: PreTrainedTokenizer) -> list[int]:
+        r"""Return number of tokens of every message, only new messages are tokenized."""
+        missing = [idx for idx, count in enumerate(self.message_token_counts) if count is None]
+        if missing:
+            formatted = self.get_formatted_messages()
+            counts = self._count_text_tokens(tokenizer, [formatted[idx] for idx in missing])
+            for idx, count in zip(missing, counts):
+                self.message_token_counts[idx] = count
+        return self.message_token_counts
 
     def count_tokens(self, tokenizer: PreTrainedTokenizer, messages: list[dict]):
         r"""Count tokens after tokenization."""
@@ -57,36 +98,101 @@ class Conversation:
         tokens = tokenizer([final_text])["input_ids"][0]
         return len(tokens)
 
-    def shrink(self, tokenizer: PreTrainedTokenizer, messages: list[dict], max_tokens: int):
+    def count_message_tokens(self, tokenizer: PreTrainedTokenizer, messages: list[dict]):
+        r"""Count tokens of every formatted message separately, special tokens are not added."""
+        texts = [self.message_template.format(**message) for message in messages]
+        return self._count_text_tokens(tokenizer, texts)
+
+    @staticmethod
+    def _count_text_tokens(tokenizer: PreTrainedTokenizer, texts: list[str]) -> list[int]:
+        if not texts:
+            return []
+        input_ids = tokenizer(texts, add_special_tokens=False)["input_ids"]
+        return [len(tokens) for tokens in input_ids]
+
+    def shrink(
+        self,
+        tokenizer: PreTrainedTokenizer,
+        messages: list[dict],
+        max_tokens: int,
+        token_counts: list[int] | None = None,
+    ):
+        r"""Drop oldest messages by pairs until prompt fits into max_tokens.
+
+        Every message is tokenized once and cut point is found by scan over suffix sums of message
+        token counts. When every message starts with special token, tokenizer splits prompt on it
+        before tokenization, so prompt has exactly the sum of tokens of its messages and the cut
+        needs no more tokenization. Otherwise tokens can merge on message borders and the cut is
+        confirmed by exact count of the concatenated prompt: it moves back while longer prompt
+        fits and forward while prompt does not fit. As dropping messages does not add tokens, the
+        result is the same as dropping pairs one by one and re-tokenizing whole prompt each time,
+        and the prompt is re-tokenized once per pair between estimated and exact cut plus once.
+        Already known token_counts of messages can be passed to skip their tokenization.
+        """
         system_message = messages[0]
         other_messages = messages[1:]
-        while self.count_tokens(tokenizer, [system_message] + other_messages) > max_tokens:
-            other_messages = other_messages[2:]
-        return [system_message] + other_messages
+        if token_counts is None:
+            token_counts = self.count_message_tokens(tokenizer, messages)
+        fixed_tokens = tokenizer.num_special_tokens_to_add() + token_counts[0]
+
+        # suffix_tokens[i] is number of tokens in other_messages[i:]
+        suffix_tokens = [0] * (len(other_messages) + 1)
+        for idx in reversed(range(len(other_messages))):
+            suffix_tokens[idx] = suffix_tokens[idx + 1] + token_counts[idx + 1]
+
+        cut = 0
+        while cut < len(other_messages) and fixed_tokens + suffix_tokens[cut] > max_tokens:
+            cut += 2
+        if self.has_exact_token_counts(tokenizer):
+            return [system_message] + other_messages[cut:]
+
+        def fits(start: int) -> bool:
+            prompt_messages = [system_message] + other_messages[start:]
+            return self.count_tokens(tokenizer, prompt_messages) <= max_tokens
+
+        while cut > 0 and fits(cut - 2):
+            cut -= 2
+        while cut < len(other_messages) and not fits(cut):
+            cut += 2
+        return [system_message] + other_messages[cut:]
+
+    def has_exact_token_counts(self, tokenizer: PreTrainedTokenizer) -> bool:
+        r"""
+        Return True when token count of prompt is the sum of token counts of its messages, it is
+        so when message template starts with special token which does not strip text before it
+        Args:
+            tokenizer: tokenizer of prompt
+        """
+        if getattr(tokenizer, "split_special_tokens", False):
+            return False
+        template_prefix = self.message_template.format(role="", content="")
+        return any(
+            token.special and not token.lstrip and template_prefix.startswith(token.content)
+            for token in getattr(tokenizer, "added_tokens_decoder", {}).values()
+        )
+
+    def _get_prompt_messages(self, tokenizer: PreTrainedTokenizer, max_tokens: int | None):
+        formatted = self.get_formatted_messages()
+        if max_tokens is None:
+            return formatted
+        token_counts = self.get_message_token_counts(tokenizer)
+        messages = self.shrink(tokenizer, self.messages, max_tokens, token_counts)
+        dropped = len(self.messages) - len(messages)
+        self.prompt_token_count = token_counts[0] + sum(token_counts[1 + dropped :])
+        return formatted[:1] + formatted[1 + dropped :]
 
     def get_prompt(self, tokenizer: PreTrainedTokenizer, max_tokens: int = 512):
         r"""Return text for passing to LLM."""
-        final_text = ""
-        messages = self.messages
-        if max_tokens is not None:
-            messages = self.shrink(tokenizer, messages, max_tokens)
-
-        for message in messages:
-            message_text = self.message_template.format(**message)
-            final_text += message_text
+        final_text = "".join(self._get_prompt_messages(tokenizer, max_tokens))
         return final_text.strip()
 
     def get_prompt_for_generate(self, tokenizer, max_tokens: int = 512):
         r"""Return text for passing to LLM with prefix for future generation."""
-        final_text = ""
-        messages = self.messages
-        if max_tokens is not None:
-            messages = self.shrink(tokenizer, messages, max_tokens)
-
-        for message in messages:
-            message_text = self.message_template.format(**message)
-            final_text += message_text
-        final_text += tokenizer.decode([self.start_token_id, self.bot_token_id])
+        final_text = "".join(self._get_prompt_messages(tokenizer, max_tokens))
+        if self.generation_suffix is None:
+            final_text += tokenizer.decode([self.start_token_id, self.bot_token_id])
+        else:
+            final_text += self.generation_suffix
         return final_text.strip()
 
     @classmethod
@@ -100,9 +206,11 @@ class Conversation:
         r"""Add multiple messages."""
         if len(messages) and (messages[0].role == "system"):
             self.messages = []
+            self.formatted_messages = []
+            self.message_token_counts = []
 
         for message in messages:
-            self.messages.append(
+            self._append_message(
                 {
                     "role": self.role_mapping.get(message.role, message.role),
                     "content": message.context,
@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from data.user_context import BaseMessage
+from language_model.Chat import Conversation
+
+
+@dataclass
+class PromptPrefix:
+    r"""Formatted and tokenized messages of user conversation without system prompt."""
+
+    message_template: str
+    system_prompt: str
+    message_ids: list[str]
+    messages: list[dict]
+    formatted_messages: list[str]
+    token_counts: list[int | None]
+
+    @property
+    def last_message_id(self) -> str | None:
+        r"""Return id of the newest cached message."""
+        return self.message_ids[-1] if self.message_ids else None
+
+
+class PromptPrefixCache:
+    r"""LRU cache of per user conversation prefix reused between generate requests."""
+
+    def __init__(self, max_users: int):
+        self.max_users = max_users
+        self._entries: OrderedDict[str, PromptPrefix] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str, last_message_id: str | None) -> PromptPrefix | None:
+        r"""
+        Return cached prefix if it ends with message last_message_id
+        Args:
+            user_id: unique user id
+            last_message_id: id of the newest message of user conversation
+        """
+        with self._lock:
+            prefix = self._entries.get(user_id)
+            if prefix is None or prefix.last_message_id != last_message_id:
+                return None
+            self._entries.move_to_end(user_id)
+            return prefix
+
+    def put(self, user_id: str, prefix: PromptPrefix) -> None:
+        r"""
+        Store user prefix, the least recently used user is evicted when cache is full
+        Args:
+            user_id: unique user id
+            prefix: formatted and tokenized user messages
+        """
+        if self.max_users <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = prefix
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: str) -> None:
+        r"""
+        Remove cached prefix of user
+        Args:
+            user_id: unique user id
+        """
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def expand(self, user_id: str, conversation: Conversation, messages: list[BaseMessage]):
+        r"""
+        Add messages to conversation reusing already formatted and tokenized ones
+        Args:
+            user_id: unique user id
+            conversation: conversation holding only system prompt
+            messages: user messages from database, oldest first
+        """
+        reused = 0
+        prefix = self.get(user_id, messages[-1].id if messages else None)
+        if prefix is not None and self._is_compatible(prefix, conversation, messages):
+            reused = len(messages)
+            start = len(prefix.message_ids) - reused
+            conversation.extend_tokenized(
+                prefix.messages[start:],
+                prefix.formatted_messages[start:],
+                prefix.token_counts[start:],
+            )
+        conversation.expand(messages[reused:])
+
+    def remember(self, user_id: str, conversation: Conversation, message_ids: list[str]):
+        r"""
+        Store conversation messages as prefix for the next user request
+        Args:
+            user_id: unique user id
+            conversation: conversation with system prompt and all user messages
+            message_ids: database ids of conversation messages without system prompt
+        """
+        self.put(
+            user_id,
+            PromptPrefix(
+                message_template=conversation.message_template,
+                system_prompt=conversation.messages[0]["content"],
+                message_ids=list(message_ids),
+                messages=conversation.messages[1:],
+                formatted_messages=conversation.get_formatted_messages()[1:],
+                token_counts=conversation.message_token_counts[1:],
+            ),
+        )
+
+    @staticmethod
+    def _is_compatible(
+        prefix: PromptPrefix, conversation: Conversation, messages: list[BaseMessage]
+    ) -> bool:
+        if prefix.message_template != conversation.message_template:
+            return False
+        if prefix.system_prompt != conversation.messages[0]["content"]:
+            return False
+        if len(conversation.messages) != 1 or len(messages) > len(prefix.message_ids):
+            return False
+
+        # messages window slides, so database messages must be the tail of cached ones
+        start = len(prefix.message_ids) - len(messages)
+        return all(
+            message.id == message_id and message.context == cached["content"]
+            for message, message_id, cached in zip(
+                messages, prefix.message_ids[start:], prefix.messages[start:]
+            )
+        )
@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+import json
+import os
+import string
+import threading
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from typing import Any
+
+from transformers import PreTrainedTokenizer
+
+from language_model.Chat import (
+    DEFAULT_BOT_TOKEN_ID,
+    DEFAULT_START_TOKEN_ID,
+    Conversation,
+)
+from utils.logger import get_pylogger
+
+log = get_pylogger(__name__)
+
+DEFAULT_TEMPLATE_NAME = "default"
+
+
+class CompiledMessageTemplate:
+    r"""Message template parsed once, formatting only joins literal parts with values."""
+
+    def __init__(self, template: str):
+        self.template = template
+        self._parts: list[tuple[str, str | None]] = []
+        self._is_simple = True
+        for literal, field_name, format_spec, conversion in string.Formatter().parse(template):
+            if field_name is not None and (
+                format_spec or conversion or not field_name.isidentifier()
+            ):
+                self._is_simple = False
+            self._parts.append((literal, field_name))
+
+    def format(self, **kwargs) -> str:
+        r"""Format message same as str.format of the template."""
+        if not self._is_simple:
+            return self.template.format(**kwargs)
+        return "".join(
+            literal if field_name is None else literal + str(kwargs[field_name])
+            for literal, field_name in self._parts
+        )
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, CompiledMessageTemplate):
+            return self.template == other.template
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash(self.template)
+
+
+@dataclass
+class ConversationTemplate:
+    r"""Conversation template loaded from json file."""
+
+    name: str
+    path: str
+    mtime_ns: int
+    message_template: CompiledMessageTemplate
+    params: dict[str, Any]
+    _generation_suffix: tuple[Any, str] | None = field(default=None, repr=False)
+
+    @classmethod
+    def load(cls, name: str, path: str) -> ConversationTemplate:
+        r"""Read and compile template file."""
+        mtime_ns = os.stat(path).st_mtime_ns
+        with open(path, encoding="UTF-8") as r:
+            params = json.load(r)
+        message_template = CompiledMessageTemplate(params.pop("message_template"))
+        return cls(
+            name=name,
+            path=path,
+            mtime_ns=mtime_ns,
+            message_template=message_template,
+            params=params,
+        )
+
+    def get_generation_suffix(self, tokenizer: PreTrainedTokenizer) -> str:
+        r"""Return decoded start and bot tokens appended to prompt, decoded once per tokenizer."""
+        if self._generation_suffix is None or self._generation_suffix[0] is not tokenizer:
+            token_ids = [
+                self.params.get("start_token_id", DEFAULT_START_TOKEN_ID),
+                self.params.get("bot_token_id", DEFAULT_BOT_TOKEN_ID),
+            ]
+            self._generation_suffix = (tokenizer, tokenizer.decode(token_ids))
+        return self._generation_suffix[1]
+
+    def create_conversation(
+        self, system_prompt: str, tokenizer: PreTrainedTokenizer | None = None
+    ) -> Conversation:
+        r"""
+        Create conversation formatted by this template
+        Args:
+            system_prompt: first message of conversation
+            tokenizer: tokenizer used to precompute generation suffix
+        """
+        generation_suffix = None
+        if tokenizer is not None:
+            generation_suffix = self.get_generation_suffix(tokenizer)
+        return Conversation(
+            message_template=self.message_template,
+            system_prompt=system_prompt,
+            generation_suffix=generation_suffix,
+            **self.params,
+        )
+
+
+class TemplateRegistry:
+    r"""Named conversation templates loaded at startup and reloaded when file changes."""
+
+    def __init__(self, paths: dict[str, str], default_name: str = DEFAULT_TEMPLATE_NAME):
+        self.default_name = default_name
+        self._lock = threading.Lock()
+        self._templates = {
+            name: ConversationTemplate.load(name, path) for name, path in paths.items()
+        }
+        self._missing: set[str] = set()
+
+    @classmethod
+    def from_paths(cls, default_path: str, templates_dir: str | None = None) -> TemplateRegistry:
+        r"""
+        Register default template and every json template of directory by file name
+        Args:
+            default_path: path of template used when name is not passed
+            templates_dir: directory with additional templates
+        """
+        paths = {}
+        if templates_dir:
+            paths = {path.stem: str(path) for path in sorted(Path(templates_dir).glob("*.json"))}
+        paths[DEFAULT_TEMPLATE_NAME] = default_path
+        return cls(paths)
+
+    def get(self, name: str | None = None) -> ConversationTemplate:
+        r"""
+        Return template by name, file is read again only when its mtime changes. Template whose
+        file is removed or invalid keeps its last loaded version until the file is fixed
+        Args:
+            name: template name, default template is returned when it is not set
+        """
+        name = name or self.default_name
+        template = self._templates[name]
+        try:
+            mtime_ns = os.stat(template.path).st_mtime_ns
+        except OSError as exception:
+            if name not in self._missing:
+                self._missing.add(name)
+                log.error("Template %s is used without its file: %r", name, exception)
+            return template
+        self._missing.discard(name)
+        if mtime_ns != template.mtime_ns:
+            with self._lock:
+                template = self._templates[name]
+                if mtime_ns != template.mtime_ns:
+                    template = self._reload(template, mtime_ns)
+                    self._templates[name] = template
+        return template
+
+    @staticmethod
+    def _reload(template: ConversationTemplate, mtime_ns: int) -> ConversationTemplate:
+        try:
+            return ConversationTemplate.load(template.name, template.path)
+        except (OSError, ValueError, KeyError) as exception:
+            log.error(
+                "Can not reload template %s, previous version is used: %r",
+                template.name,
+                exception,
+            )
+            # broken file is read again only after it changes
+            return replace(template, mtime_ns=mtime_ns)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._templates
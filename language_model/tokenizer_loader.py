@@ -0,0 +1,91 @@
+"""Load tokenizer in background and save its local snapshot.
+
+Snapshot is saved once at image build time, so service starts without Hugging Face Hub:
+
+    MODEL_NAME=... HF_TOKEN=... python -m language_model.tokenizer_loader --output tokenizer
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import time
+
+from huggingface_hub import login as hf_login
+from transformers import AutoTokenizer, PreTrainedTokenizer
+
+from utils.logger import get_pylogger
+
+log = get_pylogger(__name__)
+
+
+class TokenizerLoader:
+    r"""
+    Tokenizer loaded in background thread, so service accepts requests while it is loading.
+
+    When local_path is set tokenizer is read only from that snapshot and Hugging Face Hub is not
+    contacted. Failed load is started again by the next wait call.
+    """
+
+    def __init__(
+        self, model_name: str, local_path: str | None = None, hf_token: str | None = None
+    ):
+        self.model_name = model_name
+        self.local_path = local_path
+        self.hf_token = hf_token
+        self.load_seconds: float | None = None
+        self._tokenizer: PreTrainedTokenizer | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def ready(self) -> bool:
+        r"""Return whether tokenizer is loaded."""
+        return self._tokenizer is not None
+
+    @property
+    def tokenizer(self) -> PreTrainedTokenizer:
+        r"""Return loaded tokenizer."""
+        if self._tokenizer is None:
+            raise RuntimeError("Tokenizer is not loaded yet")
+        return self._tokenizer
+
+    def load(self) -> PreTrainedTokenizer:
+        r"""Load tokenizer, blocking so must run in thread."""
+        started_at = time.perf_counter()
+        if self.local_path:
+            tokenizer = AutoTokenizer.from_pretrained(self.local_path, local_files_only=True)
+        else:
+            if self.hf_token:
+                hf_login(self.hf_token)
+            tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        self.load_seconds = time.perf_counter() - started_at
+        self._tokenizer = tokenizer
+        return tokenizer
+
+    def start(self) -> None:
+        r"""Start loading tokenizer in running event loop if it is not loaded or loading."""
+        if self._task is None or (self._task.done() and self._task.exception() is not None):
+            self._task = asyncio.create_task(asyncio.to_thread(self.load))
+
+    async def wait(self) -> PreTrainedTokenizer:
+        r"""Return tokenizer when it is loaded, raise error of failed load."""
+        if self._tokenizer is not None:
+            return self._tokenizer
+        self.start()
+        # one cancelled waiter does not cancel load shared by other waiters
+        return await asyncio.shield(self._task)
+
+
+def main():
+    r"""Save tokenizer of MODEL_NAME into local directory."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", required=True, help="directory of tokenizer snapshot")
+    args = parser.parse_args()
+
+    loader = TokenizerLoader(os.environ["MODEL_NAME"], hf_token=os.environ.get("HF_TOKEN"))
+    loader.load().save_pretrained(args.output)
+    log.info("Saved tokenizer %s to %s", loader.model_name, args.output)
+
+
+if __name__ == "__main__":
+    main()
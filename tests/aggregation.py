@@ -0,0 +1,150 @@
+r"""Evaluation of aggregation expressions and update pipelines missing in mongomock."""
+from __future__ import annotations
+
+from pymongo import ReturnDocument
+
+
+def field_value(document: dict | None, path: str):
+    for key in path.split("."):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(key)
+    return document
+
+
+def evaluate(expression, variables: dict):
+    r"""Evaluate aggregation expression with operators used by pipelines of database modules."""
+    if isinstance(expression, str) and expression.startswith("$$"):
+        name, _, path = expression[2:].partition(".")
+        return field_value(variables[name], path) if path else variables[name]
+    if isinstance(expression, str) and expression.startswith("$"):
+        return field_value(variables["ROOT"], expression[1:])
+    if isinstance(expression, list):
+        return [evaluate(value, variables) for value in expression]
+    if not isinstance(expression, dict):
+        return expression
+    if len(expression) != 1 or not next(iter(expression)).startswith("$"):
+        return {key: evaluate(value, variables) for key, value in expression.items()}
+
+    operator, argument = next(iter(expression.items()))
+    if operator == "$literal":
+        return argument
+    if operator == "$let":
+        scope = {name: evaluate(value, variables) for name, value in argument["vars"].items()}
+        return evaluate(argument["in"], {**variables, **scope})
+    if operator == "$reduce":
+        value = evaluate(argument["initialValue"], variables)
+        for this in evaluate(argument["input"], variables):
+            value = evaluate(argument["in"], {**variables, "value": value, "this": this})
+        return value
+    if operator == "$map":
+        name = argument.get("as", "this")
+        return [
+            evaluate(argument["in"], {**variables, name: item})
+            for item in evaluate(argument["input"], variables)
+        ]
+    if operator == "$cond":
+        condition, if_true, if_false = argument
+        chosen = if_true if evaluate(condition, variables) else if_false
+        return evaluate(chosen, variables)
+    if operator == "$lastN":
+        argument = [argument["input"], argument["n"]]
+
+    args = evaluate(argument if isinstance(argument, list) else [argument], variables)
+    return OPERATORS[operator](*args)
+
+
+def index_of(values: list, value) -> int:
+    return values.index(value) if value in values else -1
+
+
+OPERATORS = {
+    "$lastN": lambda values, count: values[len(values) - count :],
+    "$slice": lambda values, position, count: values[position : position + count],
+    "$reverseArray": lambda values: values[::-1],
+    "$size": len,
+    "$add": lambda *values: sum(values),
+    "$subtract": lambda left, right: left - right,
+    "$mod": lambda left, right: left % right,
+    "$eq": lambda left, right: left == right,
+    "$lte": lambda left, right: left <= right,
+    "$not": lambda value: not value,
+    "$and": lambda *values: all(values),
+    "$ifNull": lambda value, default: default if value is None else value,
+    "$arrayElemAt": lambda values, index: values[index],
+    "$indexOfArray": index_of,
+    "$mergeObjects": lambda *documents: {
+        key: value for doc in documents for key, value in doc.items()
+    },
+}
+
+
+def project(document: dict, projection: dict) -> dict:
+    result = {}
+    for key, value in projection.items():
+        if value == 1:
+            result[key] = document[key]
+        elif value != 0:
+            result[key] = evaluate(value, {"ROOT": document})
+    return result
+
+
+def apply_pipeline_update(document: dict, pipeline: list[dict]) -> dict:
+    r"""Return document updated by $set stages of update pipeline."""
+    for stage in pipeline:
+        ((operator, fields),) = stage.items()
+        assert operator == "$set", operator
+        document = {**document, **project(document, fields)}
+    return document
+
+
+class CollectionWrapper:
+    r"""Collection passing calls it does not override to wrapped collection."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+class PipelineUpdates(CollectionWrapper):
+    r"""Collection evaluating update pipelines of find_one_and_update."""
+
+    # keywords of pymongo, callers pass filter by name
+    def find_one_and_update(  # pylint: disable=redefined-builtin
+        self, filter, update, projection=None, return_document=None
+    ):
+        if not isinstance(update, list):
+            return self.collection.find_one_and_update(
+                filter, update, projection=projection, return_document=return_document
+            )
+        assert return_document == ReturnDocument.AFTER
+        document = self.collection.find_one(filter)
+        if document is None:
+            return None
+        self.collection.replace_one(
+            {"_id": document["_id"]}, apply_pipeline_update(document, update)
+        )
+        return self.collection.find_one({"_id": document["_id"]}, projection)
+
+
+class AsyncPipelineUpdates(CollectionWrapper):
+    r"""PipelineUpdates of motor collection."""
+
+    # keywords of pymongo, callers pass filter by name
+    async def find_one_and_update(  # pylint: disable=redefined-builtin
+        self, filter, update, projection=None, return_document=None
+    ):
+        if not isinstance(update, list):
+            return await self.collection.find_one_and_update(
+                filter, update, projection=projection, return_document=return_document
+            )
+        assert return_document == ReturnDocument.AFTER
+        document = await self.collection.find_one(filter)
+        if document is None:
+            return None
+        await self.collection.replace_one(
+            {"_id": document["_id"]}, apply_pipeline_update(document, update)
+        )
+        return await self.collection.find_one({"_id": document["_id"]}, projection)
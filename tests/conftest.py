@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import importlib
+import os
+from pathlib import Path
+
+import mongomock
+import mongomock_motor
+import pytest
+from fastapi.testclient import TestClient
+
+import database.mongo
+import database.mongo_async
+import database.mongo_bucketed
+from benchmarks.toy_tokenizer import build_toy_tokenizer
+from data.base_classes import GenerationLLMResponse
+from database.mongo import MongoDataBase
+from database.mongo_async import AsyncMongoDataBase
+from database.mongo_bucketed import BucketedMongoDataBase
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+class StubLanguageModelAPI:
+    r"""LLM api answering every prompt with the same texts, stream adds one word at a time."""
+
+    texts = ("first answer", "second answer")
+
+    def __init__(self, address: str, **_):
+        self.address = address
+        self.prompts: list[str] = []
+
+    async def generate(self, text: str) -> GenerationLLMResponse:
+        self.prompts.append(text)
+        return GenerationLLMResponse(list(self.texts))
+
+    async def generate_stream(self, text: str):
+        self.prompts.append(text)
+        words = [answer.split() for answer in self.texts]
+        for size in range(1, max(len(answer) for answer in words) + 1):
+            yield GenerationLLMResponse([" ".join(answer[:size]) for answer in words])
+
+    async def aclose(self) -> None:
+        pass
+
+
+@pytest.fixture(name="tokenizer", scope="session")
+def fixture_tokenizer():
+    r"""Small tokenizer with special tokens of the service template, trained in memory."""
+    return build_toy_tokenizer()
+
+
+@pytest.fixture
+def mongo_database(monkeypatch):
+    r"""Embedded storage backed by in-memory mongomock client."""
+    monkeypatch.setattr(database.mongo, "MongoClient", mongomock.MongoClient)
+    return MongoDataBase("mongodb://localhost", "chat", "users")
+
+
+@pytest.fixture
+def bucketed_database(monkeypatch):
+    r"""Bucketed storage with small buckets backed by in-memory mongomock client."""
+    monkeypatch.setattr(database.mongo_bucketed, "MongoClient", mongomock.MongoClient)
+    return BucketedMongoDataBase("mongodb://localhost", "chat", "buckets", bucket_size=4)
+
+
+@pytest.fixture
+def async_database(monkeypatch):
+    r"""Async storage backed by in-memory mongomock-motor client, indexes are not created."""
+    monkeypatch.setattr(
+        database.mongo_async,
+        "AsyncIOMotorClient",
+        lambda *args, **kwargs: mongomock_motor.AsyncMongoMockClient(),
+    )
+    return AsyncMongoDataBase("mongodb://localhost", "chat", "users")
+
+
+@pytest.fixture(name="app_module", scope="session")
+def fixture_app_module(tokenizer, tmp_path_factory):
+    r"""Service module imported with environment of in-memory database and toy tokenizer."""
+    tokenizer_path = tmp_path_factory.mktemp("tokenizer")
+    tokenizer.save_pretrained(tokenizer_path)
+    os.environ.update(
+        DATABASE_CONNECTION_STRING="mongodb://localhost",
+        DATABASE_BACKEND="memory",
+        TEMPLATE_PATH=str(ROOT / "templates" / "chat_conversation_template.json"),
+        MODEL_NAME="toy",
+        TOKENIZER_PATH=str(tokenizer_path),
+        LM_API_ADDRESS="http://127.0.0.1:1",
+        CONTEXT_SIZE="8",
+        TABLE_NAME="users",
+        LOG_PROMPTS="0",
+    )
+    return importlib.import_module("app")
+
+
+@pytest.fixture(name="stub_lm_api")
+def fixture_stub_lm_api(app_module, monkeypatch):
+    r"""
+    Replace LLM api of service by stub, client fixture must be requested after this one.
+    Stub is returned by lm_api.api of app_module
+    """
+    monkeypatch.setattr(app_module, "LanguageModelAPI", StubLanguageModelAPI)
+    monkeypatch.setattr(app_module, "LM_BATCH_SIZE", 1)
+    monkeypatch.setattr(app_module, "LM_API_ADDRESSES", ["http://stub"])
+    # every prompt reaches the stub
+    monkeypatch.setattr(app_module, "LM_RESPONSE_CACHE_SIZE", 0)
+    return StubLanguageModelAPI
+
+
+@pytest.fixture
+def client(app_module, monkeypatch):
+    r"""
+    Client of service started by lifespan, storage is chosen by DATABASE_BACKEND attribute of
+    app_module patched before the fixture is used. MongoDB storage uses mongomock client
+    """
+    monkeypatch.setattr(database.mongo, "MongoClient", mongomock.MongoClient)
+    monkeypatch.setattr(database.mongo_bucketed, "MongoClient", mongomock.MongoClient)
+    monkeypatch.setattr(app_module, "user_cache", None)
+    monkeypatch.setattr(app_module, "threaded_database", None)
+    monkeypatch.setattr(app_module, "write_behind", None)
+    with TestClient(app_module.app) as test_client:
+        yield test_client
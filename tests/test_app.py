@@ -0,0 +1,26 @@
+from __future__ import annotations
+
+from fastapi.routing import APIRoute
+
+
+def test_route_annotations_are_evaluated_by_python_39(app_module):
+    # FastAPI evaluates annotations of routes at import, X | Y fails on Python 3.9 of the image
+    for route in app_module.app.routes:
+        if isinstance(route, APIRoute):
+            for name, annotation in route.endpoint.__annotations__.items():
+                assert "|" not in str(annotation), f"{route.path} {name}: {annotation}"
+
+
+def test_users_are_paged_by_user_id(client):
+    for user_id in ("c", "a", "b"):
+        response = client.post(
+            "/users", json={"user_id": user_id, "username": user_id, "chat_id": user_id}
+        )
+        assert response.status_code == 201
+
+    first = client.get("/users", params={"limit": 2, "include_history": False}).json()
+    second = client.get("/users", params={"after": first["next_after"], "limit": 2}).json()
+
+    assert [user["user_id"] for user in first["users"]] == ["a", "b"]
+    assert [user["user_id"] for user in second["users"]] == ["c"]
+    assert [user["user_id"] for user in client.get("/users").json()] == ["a", "b", "c"]
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import json
+
+import pytest
+
+from data.user_context import BaseMessage
+from database.archive import archive_plan, decompress_messages
+from database.archive_history import archive_history
+from database.migrate_to_buckets import migrate
+
+
+def add_messages(database, user_id: str, start: int, count: int) -> None:
+    database.update_user_text(
+        user_id,
+        [
+            BaseMessage(str(idx), "user", f"message {idx}", token_count=1)
+            for idx in range(start, start + count)
+        ],
+    )
+
+
+def message_ids(database, user_id: str) -> list[str]:
+    return [message.id for message in database.get_user(user_id).context]
+
+
+def archived_ids(database, user_id: str) -> list[str]:
+    return [message.id for message in database.iter_archived_messages(user_id)]
+
+
+def ids(start: int, stop: int) -> list[str]:
+    return [str(idx) for idx in range(start, stop)]
+
+
+@pytest.fixture(name="storage")
+def fixture_storage(mongo_database):
+    mongo_database.create_user("user", "name", "chat")
+    add_messages(mongo_database, "user", 0, 10)
+    mongo_database.clear_history("user")
+    return mongo_database
+
+
+def test_archive_plan_moves_messages_before_live_window():
+    messages = [{"id": str(idx), "role": "user", "context": ""} for idx in range(5)]
+    document = {"current_context_start_idx": 3, "archived_count": 2, "context": messages}
+
+    plan = archive_plan("user", document, chunk_size=2)
+
+    assert plan.count == 3
+    chunks = [request._doc for request in plan.chunks]
+    assert [(chunk["first_idx"], chunk["count"]) for chunk in chunks] == [(2, 2), (4, 1)]
+    assert [decompress_messages(chunk["data"]) for chunk in chunks] == [
+        messages[:2],
+        messages[2:3],
+    ]
+    assert plan.trim_filter == {"user_id": "user", "archived_count": 2, "context.2.id": "2"}
+    assert plan.trim_update == {
+        "$pull": {"context": {"id": {"$in": ["0", "1", "2"]}}},
+        "$inc": {"current_context_start_idx": -3, "archived_count": 3},
+    }
+    assert archive_plan("user", {**document, "current_context_start_idx": 0}, 2) is None
+
+
+def test_archive_history_runs_again_without_duplicates(storage):
+    update_one = storage.collection.update_one
+
+    def crash(*args, **kwargs):
+        raise ConnectionError("connection lost")
+
+    # chunks are written, but messages are not removed from user document
+    storage.collection.update_one = crash
+    with pytest.raises(ConnectionError):
+        storage.archive_history("user", chunk_size=4)
+    storage.collection.update_one = update_one
+    assert message_ids(storage, "user") == ids(0, 10)
+
+    assert archive_history(storage, chunk_size=4) == 10
+    assert archive_history(storage, chunk_size=4) == 0
+    assert storage.archive.count_documents({"user_id": "user"}) == 3
+    assert archived_ids(storage, "user") == ids(0, 10)
+    assert message_ids(storage, "user") == []
+
+
+def test_messages_appended_while_archiving_are_kept(storage):
+    bulk_write = storage.archive.bulk_write
+
+    def append_meanwhile(*args, **kwargs):
+        add_messages(storage, "user", 10, 2)
+        return bulk_write(*args, **kwargs)
+
+    storage.archive.bulk_write = append_meanwhile
+    assert storage.archive_history("user", chunk_size=4) == 10
+
+    assert message_ids(storage, "user") == ids(10, 12)
+    assert archived_ids(storage, "user") == ids(0, 10)
+    document = storage.collection.find_one({"user_id": "user"})
+    assert (document["current_context_start_idx"], document["archived_count"]) == (0, 10)
+
+
+@pytest.fixture(name="embedded_backend")
+def fixture_embedded_backend(app_module, monkeypatch):
+    r"""Service storage is embedded, client fixture must be requested after this one."""
+    monkeypatch.setattr(app_module, "DATABASE_BACKEND", "embedded")
+    return app_module
+
+
+def test_archive_is_exported_from_the_oldest_message(embedded_backend, client):
+    client.post("/users", json={"user_id": "user", "username": "name", "chat_id": "chat"})
+    storage = embedded_backend.storage
+    for start in (0, 7):
+        add_messages(storage, "user", start, 7)
+        storage.clear_history("user")
+        storage.archive_history("user", chunk_size=3)
+
+    response = client.get("/users/user/archive")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert [json.loads(line)["id"] for line in response.text.splitlines()] == ids(0, 14)
+
+
+def test_archive_export_needs_mongo_storage(client):
+    response = client.get("/users/user/archive")
+
+    assert response.status_code == 501
+
+
+def test_migration_copies_messages_archived_between_passes(storage, bucketed_database):
+    add_messages(storage, "user", 10, 2)
+    storage.archive_history("user", chunk_size=4)
+    assert migrate(storage.collection, bucketed_database) == 12
+
+    add_messages(storage, "user", 12, 3)
+    storage.clear_history("user")
+    storage.archive_history("user", chunk_size=4)
+    add_messages(storage, "user", 15, 1)
+
+    assert migrate(storage.collection, bucketed_database) == 4
+    assert migrate(storage.collection, bucketed_database) == 0
+    assert message_ids(bucketed_database, "user") == ids(0, 16)
+    _, context = bucketed_database.get_context("user", 10)
+    assert [message.id for message in context] == ["15"]
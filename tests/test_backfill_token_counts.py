@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+from data.user_context import BaseMessage
+from database.backfill_token_counts import backfill_token_counts
+from language_model.Chat import Conversation
+
+TEMPLATE = "<s>{role}\n{content}</s>\n"
+
+
+def test_backfill_counts_messages_without_token_count_or_with_null(mongo_database, tokenizer):
+    mongo_database.create_user("user", "name", "chat")
+    mongo_database.update_user_text(
+        "user",
+        [
+            BaseMessage("1", "user", "hi how are you", token_count=None),
+            BaseMessage("2", "bot", "fine thanks", token_count=7),
+        ],
+    )
+    # message stored before token counts had no such field
+    mongo_database.collection.update_one(
+        {"user_id": "user"}, {"$push": {"context": {"id": "3", "role": "user", "context": "ok"}}}
+    )
+    conversation = Conversation(TEMPLATE, "")
+
+    updated = backfill_token_counts(mongo_database, conversation, tokenizer)
+
+    context = mongo_database.collection.find_one({"user_id": "user"})["context"]
+    expected = conversation.count_message_tokens(
+        tokenizer,
+        [{"role": "user", "content": "hi how are you"}, {"role": "user", "content": "ok"}],
+    )
+    assert updated == 2
+    assert [message["token_count"] for message in context] == [expected[0], 7, expected[1]]
+    assert backfill_token_counts(mongo_database, conversation, tokenizer) == 0
@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import asyncio
+
+import httpx
+import pytest
+
+from api.balancer import OPEN, BalancedLanguageModelAPI
+from api.language_model import LanguageModelAPI
+
+
+class Node:
+    r"""LLM api node served by mock transport, answers with status and records its requests."""
+
+    def __init__(self, name: str, status: int = 200, health_status: int = 200):
+        self.name = name
+        self.status = status
+        self.health_status = health_status
+        self.requests: list[str] = []
+        self.api = LanguageModelAPI(f"http://{name}")
+        self.api.client = httpx.AsyncClient(
+            base_url=f"http://{name}", transport=httpx.MockTransport(self.handle)
+        )
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/health":
+            return httpx.Response(self.health_status)
+        self.requests.append(request.url.path)
+        await asyncio.sleep(0.01)
+        if self.status != 200:
+            return httpx.Response(self.status)
+        return httpx.Response(200, json={"texts": [self.name]})
+
+
+def balanced(nodes: list[Node], **kwargs) -> BalancedLanguageModelAPI:
+    return BalancedLanguageModelAPI(
+        [node.api for node in nodes], **{"health_interval": 0, **kwargs}
+    )
+
+
+async def generate_all(api: BalancedLanguageModelAPI, count: int) -> list[str]:
+    try:
+        responses = await asyncio.gather(*(api.generate(f"prompt {idx}") for idx in range(count)))
+    finally:
+        await api.aclose()
+    return [response.texts[0] for response in responses]
+
+
+def test_concurrent_requests_go_to_least_loaded_nodes():
+    nodes = [Node("first"), Node("second"), Node("third")]
+
+    answers = asyncio.run(generate_all(balanced(nodes), 6))
+
+    assert sorted(answers) == ["first", "first", "second", "second", "third", "third"]
+
+
+@pytest.mark.parametrize("status", [502, 503, 504])
+def test_request_failed_by_gateway_is_sent_to_another_node(status):
+    failing, working = Node("failing", status=status), Node("working")
+    api = balanced([failing, working])
+
+    answers = asyncio.run(generate_all(api, 4))
+
+    assert answers == ["working"] * 4
+    assert api.metrics.retries == len(failing.requests) > 0
+
+
+def test_request_failed_by_node_error_is_not_retried():
+    failing, working = Node("failing", status=500), Node("working")
+    api = balanced([failing, working])
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(generate_all(api, 4))
+
+    assert api.metrics.retries == 0
+    assert failing.requests
+
+
+def test_failing_node_is_skipped_after_failure_threshold():
+    failing, working = Node("failing", status=503), Node("working")
+    api = balanced([failing, working], failure_threshold=2)
+
+    async def generate_one_by_one() -> list[str]:
+        answers = [(await api.generate(f"prompt {idx}")).texts[0] for idx in range(6)]
+        await api.aclose()
+        return answers
+
+    assert asyncio.run(generate_one_by_one()) == ["working"] * 6
+    assert len(failing.requests) == 2
+    assert api.backends[0].state == OPEN
+    assert api.metrics.circuit_opens == 1
+
+
+def test_node_failing_health_check_gets_no_requests():
+    down, up = Node("down", health_status=500), Node("up")
+    api = balanced([down, up], health_interval=60)
+
+    async def scenario() -> list[str]:
+        api._start_health_checks()
+        while api.backends[0].healthy:
+            await asyncio.sleep(0.01)
+        return await generate_all(api, 4)
+
+    assert asyncio.run(scenario()) == ["up"] * 4
+    assert not down.requests
@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+import asyncio
+
+from prometheus_client import REGISTRY
+
+from api.batching import BatchingLanguageModelAPI
+from data.base_classes import GenerationLLMResponse
+
+MAX_BATCH_SIZE = 4
+
+
+class RecordingAPI:
+    r"""LLM api answering every prompt by its text and recording sent batches."""
+
+    def __init__(self):
+        self.batches: list[list[str]] = []
+
+    async def generate_batch(self, texts: list[str]) -> list[GenerationLLMResponse]:
+        self.batches.append(texts)
+        await asyncio.sleep(0.01)
+        return [GenerationLLMResponse([text]) for text in texts]
+
+    async def aclose(self) -> None:
+        pass
+
+
+def sample(name: str) -> float:
+    return REGISTRY.get_sample_value(name) or 0.0
+
+
+async def generate_all(api: BatchingLanguageModelAPI, texts: list[str]) -> list[list[str]]:
+    try:
+        responses = await asyncio.gather(*(api.generate(text) for text in texts))
+    finally:
+        await api.aclose()
+    return [response.texts for response in responses]
+
+
+def test_concurrent_prompts_are_batched_and_answered_in_order():
+    inner = RecordingAPI()
+    api = BatchingLanguageModelAPI(inner, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=50)
+    texts = [f"prompt {idx}" for idx in range(6)]
+    batches_before = sample("llm_batch_fill_rate_count")
+    fill_before = sample("llm_batch_fill_rate_sum")
+    delays_before = sample("llm_batch_queue_delay_seconds_count")
+
+    answers = asyncio.run(generate_all(api, texts))
+
+    assert answers == [[text] for text in texts]
+    assert [len(batch) for batch in inner.batches] == [4, 2]
+    assert sample("llm_batch_fill_rate_count") - batches_before == 2
+    assert sample("llm_batch_fill_rate_sum") - fill_before == 6 / MAX_BATCH_SIZE
+    assert sample("llm_batch_queue_delay_seconds_count") - delays_before == len(texts)
+    assert api.metrics.fill_rate == 6 / (2 * MAX_BATCH_SIZE)
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import runpy
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+import pytest
+
+from data.user_context import BaseMessage
+from database.cached import CachedDataBase
+from database.memory import InMemoryDataBase
+
+
+class PausedReads(InMemoryDataBase):
+    r"""Database pausing every context read after the window was read."""
+
+    def __init__(self):
+        super().__init__()
+        self.read_done = threading.Event()
+        self.resume = threading.Event()
+
+    def get_context(self, user_id: str, limit: int, max_tokens: int | None = None):
+        result = super().get_context(user_id, limit, max_tokens)
+        self.read_done.set()
+        self.resume.wait(timeout=10)
+        return result
+
+
+def message(idx: int) -> BaseMessage:
+    return BaseMessage(str(idx), "user", f"message {idx}", token_count=1)
+
+
+@pytest.fixture(name="storage")
+def fixture_storage():
+    storage = PausedReads()
+    storage.create_user("user", "name", "chat")
+    storage.update_user_text("user", [message(0), message(1)])
+    return storage
+
+
+def read_racing_with(cache: CachedDataBase, storage: PausedReads, write) -> None:
+    r"""Read context of user while write is made after the read and before it is cached."""
+    reader = threading.Thread(target=cache.get_context, args=("user", 10))
+    reader.start()
+    assert storage.read_done.wait(timeout=10)
+    write()
+    storage.resume.set()
+    reader.join()
+
+
+def context_ids(cache: CachedDataBase) -> list[str]:
+    return [message.id for message in cache.get_context("user", 10)[1]]
+
+
+def test_window_read_before_append_is_not_cached(storage):
+    cache = CachedDataBase(storage, window_size=10)
+
+    read_racing_with(cache, storage, lambda: cache.update_user_text("user", [message(2)]))
+
+    assert context_ids(cache) == ["0", "1", "2"]
+    assert cache.stats()["misses"] == 2
+    assert context_ids(cache) == ["0", "1", "2"]
+    assert cache.stats()["hits"] == 1
+
+
+def test_window_read_before_clear_is_not_cached(storage):
+    cache = CachedDataBase(storage, window_size=10)
+
+    read_racing_with(cache, storage, lambda: cache.clear_history("user"))
+
+    assert context_ids(cache) == []
+
+
+def test_failed_read_is_not_cached(storage, monkeypatch):
+    cache = CachedDataBase(storage, window_size=10)
+
+    def fail(*args, **kwargs):
+        raise ConnectionError("connection lost")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(storage, "get_context", fail)
+        with pytest.raises(ConnectionError):
+            cache.get_context("user", 10)
+    storage.resume.set()
+
+    assert context_ids(cache) == ["0", "1"]
+    assert cache.stats()["users"] == 1
+
+
+@pytest.fixture(name="users")
+def fixture_users():
+    storage = InMemoryDataBase()
+    for user_id in ("a", "b", "c"):
+        storage.create_user(user_id, user_id, user_id)
+        storage.update_user_text(user_id, [message(0), message(1)])
+    return storage
+
+
+def read_users(cache: CachedDataBase, user_ids: str) -> list[str]:
+    r"""Read windows of users and return users whose windows were read from database."""
+    missed = []
+    for user_id in user_ids:
+        misses = cache.stats()["misses"]
+        cache.get_context(user_id, 10)
+        if cache.stats()["misses"] > misses:
+            missed.append(user_id)
+    return missed
+
+
+def test_least_recently_read_window_is_evicted(users):
+    cache = CachedDataBase(users, window_size=10, max_users=2)
+
+    assert read_users(cache, "abac") == ["a", "b", "c"]
+    assert read_users(cache, "acb") == ["b"]
+    assert cache.stats()["users"] == 2
+
+
+def test_windows_over_memory_limit_are_evicted(users):
+    measured = CachedDataBase(users, window_size=10)
+    measured.get_context("a", 10)
+    window_bytes = measured.stats()["bytes"]
+    cache = CachedDataBase(users, window_size=10, max_bytes=window_bytes)
+
+    assert read_users(cache, "aab") == ["a", "b"]
+    assert read_users(cache, "ba") == ["a"]
+    assert cache.stats()["users"] == 1
+    assert cache.stats()["bytes"] == window_bytes
+
+
+def test_expired_window_is_read_again(users):
+    cache = CachedDataBase(users, window_size=10, ttl_seconds=0.05)
+
+    assert read_users(cache, "aa") == ["a"]
+    time.sleep(0.1)
+    assert read_users(cache, "aa") == ["a"]
+
+
+@pytest.mark.parametrize(("workers", "warned"), [(1, False), (2, True)])
+def test_gunicorn_warns_about_cache_of_several_workers(monkeypatch, workers, warned):
+    config = runpy.run_path(str(Path(__file__).parents[1] / "gunicorn.conf.py"))
+    server = SimpleNamespace(cfg=SimpleNamespace(workers=workers), log=Mock())
+    monkeypatch.setenv("USER_CACHE_SIZE", "100")
+
+    config["on_starting"](server)
+
+    assert server.log.warning.called == warned
@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import random
+
+import pytest
+
+from benchmarks.toy_tokenizer import synthetic_lines
+from language_model.Chat import Conversation
+
+SPECIAL_TOKEN_TEMPLATE = "<s>{role}\n{content}</s>\n"
+# messages are not separated by special tokens, so tokens can merge on their borders
+PLAIN_TEMPLATE = "{role}:{content}"
+
+
+def old_shrink(conversation, tokenizer, messages, max_tokens):
+    r"""Drop pairs one by one re-tokenizing whole prompt each time."""
+    system_message = messages[0]
+    other_messages = messages[1:]
+    while conversation.count_tokens(tokenizer, [system_message] + other_messages) > max_tokens:
+        other_messages = other_messages[2:]
+    return [system_message] + other_messages
+
+
+def conversation_messages(count: int, seed: int) -> list[dict]:
+    lines = synthetic_lines(count + 1, seed)
+    messages = [{"role": "system", "content": lines[0]}]
+    for idx, line in enumerate(lines[1:]):
+        messages.append({"role": "user" if idx % 2 == 0 else "bot", "content": line})
+    return messages
+
+
+@pytest.mark.parametrize("template", [SPECIAL_TOKEN_TEMPLATE, PLAIN_TEMPLATE])
+@pytest.mark.parametrize("seed", range(5))
+def test_shrink_keeps_same_messages_as_dropping_pairs_one_by_one(tokenizer, template, seed):
+    conversation = Conversation(template, "")
+    messages = conversation_messages(2 * random.Random(seed).randint(1, 15), seed)
+    # old algorithm never stops when even system message does not fit
+    min_count = conversation.count_tokens(tokenizer, messages[:1])
+    full_count = conversation.count_tokens(tokenizer, messages)
+    for max_tokens in range(min_count, full_count + 10, 3):
+        expected = old_shrink(conversation, tokenizer, messages, max_tokens)
+        assert conversation.shrink(tokenizer, messages, max_tokens) == expected
+
+
+def test_shrink_does_not_tokenize_prompt_split_by_special_tokens(tokenizer, monkeypatch):
+    conversation = Conversation(SPECIAL_TOKEN_TEMPLATE, "")
+    messages = conversation_messages(20, 0)
+    expected = old_shrink(conversation, tokenizer, messages, 200)
+
+    def count_tokens(*args):
+        raise AssertionError("prompt is tokenized again")
+
+    monkeypatch.setattr(conversation, "count_tokens", count_tokens)
+    assert conversation.has_exact_token_counts(tokenizer)
+    assert conversation.shrink(tokenizer, messages, 200) == expected
+
+
+def test_plain_template_has_no_exact_token_counts(tokenizer):
+    assert not Conversation(PLAIN_TEMPLATE, "").has_exact_token_counts(tokenizer)
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import bson
+import pytest
+
+from data.user_context import BaseMessage
+from database.utils import trim_to_token_budget
+from tests.aggregation import project
+
+MESSAGES = 10_000
+LIMIT = 8
+MESSAGE_TEXT = "hi how are you what is up fine thanks " * 2
+
+
+class CountingCollection:
+    r"""
+    Collection recording every command sent to database with size of its reply. Matching stages
+    run on mongomock collection, stages with operators missing in mongomock are evaluated here.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.commands: list[str] = []
+        self.reply_bytes = 0
+
+    def __getattr__(self, name):
+        self.commands.append(name)
+        return getattr(self.collection, name)
+
+    def aggregate(self, pipeline: list[dict]):
+        self.commands.append("aggregate")
+        matched = [stage for stage in pipeline if "$match" in stage or "$limit" in stage]
+        documents = list(self.collection.aggregate(matched))
+        for stage in pipeline[len(matched) :]:
+            if "$project" in stage:
+                documents = [project(document, stage["$project"]) for document in documents]
+            else:
+                documents = [
+                    {**document, **project(document, stage["$set"])} for document in documents
+                ]
+        self.reply_bytes += sum(len(bson.encode(document)) for document in documents)
+        return iter(documents)
+
+
+@pytest.fixture(name="long_history_database")
+def fixture_long_history_database(mongo_database):
+    mongo_database.create_user("user", "name", "chat")
+    mongo_database.update_user_text(
+        "user",
+        [
+            BaseMessage(str(idx), "user" if idx % 2 else "bot", MESSAGE_TEXT, token_count=idx % 7)
+            for idx in range(MESSAGES)
+        ],
+    )
+    mongo_database.collection.update_one(
+        {"user_id": "user"}, {"$set": {"current_context_start_idx": 10}}
+    )
+    document_bytes = len(bson.encode(mongo_database.collection.find_one({"user_id": "user"})))
+    mongo_database.collection = CountingCollection(mongo_database.collection)
+    return mongo_database, document_bytes
+
+
+@pytest.mark.parametrize("max_tokens", [None, 20])
+def test_get_context_reads_window_by_one_aggregate(long_history_database, max_tokens):
+    database, document_bytes = long_history_database
+    messages = [
+        BaseMessage(str(idx), "user" if idx % 2 else "bot", MESSAGE_TEXT, token_count=idx % 7)
+        for idx in range(MESSAGES - LIMIT, MESSAGES)
+    ]
+    if max_tokens is not None:
+        messages = trim_to_token_budget(messages, max_tokens)
+
+    system_prompt, context = database.get_context("user", LIMIT, max_tokens)
+
+    assert database.collection.commands == ["aggregate"]
+    assert [(message.id, message.context) for message in context] == [
+        (message.id, message.context) for message in messages
+    ]
+    assert system_prompt.role == "system"
+    # reply has system prompt and the window only, the whole user document is far bigger
+    message_bytes = len(bson.encode(messages[0].to_bson()))
+    assert database.collection.reply_bytes < LIMIT * message_bytes + 1024
+    assert database.collection.reply_bytes * 100 < document_bytes
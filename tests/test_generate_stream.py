@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+import pytest
+
+from data.base_classes import GenerateRequest
+
+
+@pytest.fixture(name="service")
+def fixture_service(app_module, stub_lm_api, client):
+    client.post("/users", json={"user_id": "user", "username": "name", "chat_id": "chat"})
+    return app_module, client, stub_lm_api
+
+
+def stored_texts(client) -> list[str]:
+    _, messages = client.get("/users/user/context", params={"limit": 10}).json()
+    return [message["context"] for message in messages]
+
+
+def parse_sse(text: str) -> list[tuple[str | None, dict]]:
+    r"""Return name and data of every server-sent event."""
+    events = []
+    assert text.endswith("\n\n")
+    for block in text[:-2].split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.split("\n"))
+        assert set(fields) <= {"event", "data"}
+        events.append((fields.get("event"), json.loads(fields["data"])))
+    return events
+
+
+def test_sse_stream_ends_with_done_event_of_stored_answer(service):
+    _, client, stub = service
+
+    response = client.patch("/users/user/context/generate/stream", json={"text": "question"})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = parse_sse(response.text)
+    partial, (event, done) = events[:-1], events[-1]
+    assert [name for name, _ in partial] == [None] * len(partial)
+    assert partial[0][1] == {"messages": ["first", "second"]}
+    assert partial[-1][1] == {"messages": list(stub.texts)}
+    assert event == "done"
+    assert done == {"messages": list(stub.texts), "answer_id": done["answer_id"], "done": True}
+    assert stored_texts(client) == ["question", stub.texts[0]]
+    # stored answer is chosen by id sent in done event
+    client.post(
+        f"/users/user/context/{done['answer_id']}/possible_contexts_ids",
+        json={"possible_contexts_ids": ["candidate 0", "candidate 1"]},
+    )
+    response = client.post(
+        f"/users/user/context/{done['answer_id']}/user_choice",
+        json={"message_id": "candidate 1"},
+    )
+    assert response.json() == {"text": stub.texts[1]}
+
+
+def test_ndjson_stream_has_one_record_per_line(service):
+    _, client, stub = service
+
+    response = client.patch(
+        "/users/user/context/generate/stream",
+        json={"text": "question"},
+        params={"stream_format": "ndjson"},
+    )
+
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert response.text.endswith("\n")
+    records = [json.loads(line) for line in response.text.splitlines()]
+    assert [record.get("done", False) for record in records] == [False] * (len(records) - 1) + [
+        True
+    ]
+    assert records[-1]["messages"] == list(stub.texts)
+    assert stored_texts(client) == ["question", stub.texts[0]]
+
+
+def test_answer_is_stored_when_client_disconnects_while_saving(service, monkeypatch):
+    app_module, client, stub = service
+    update_user_text = app_module.database.update_user_text
+
+    async def disconnect_while_saving():
+        release = asyncio.Event()
+
+        async def slow_update_user_text(**kwargs):
+            await release.wait()
+            await update_user_text(**kwargs)
+
+        monkeypatch.setattr(app_module.database, "update_user_text", slow_update_user_text)
+        response = await app_module.generate_stream(
+            "user", GenerateRequest(text="question"), "ndjson"
+        )
+        records = []
+
+        async def read_stream():
+            async for chunk in response.body_iterator:
+                records.append(json.loads(chunk))
+
+        reading = asyncio.create_task(read_stream())
+        while not app_module.saving_tasks:
+            await asyncio.sleep(0.01)
+        # client is gone before the answer is stored
+        reading.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await reading
+        release.set()
+        await asyncio.gather(*app_module.saving_tasks)
+        return records
+
+    records = client.portal.call(disconnect_while_saving)
+
+    assert not any(record.get("done") for record in records)
+    assert stored_texts(client) == ["question", stub.texts[0]]
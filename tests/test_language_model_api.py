@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+
+import pytest
+import uvicorn
+
+from api.language_model import LanguageModelAPI
+from benchmarks.load_test import free_port
+from benchmarks.stub_llm import create_stub_llm
+
+LATENCY_MS = 100
+MAX_CONNECTIONS = 16
+REQUESTS = 96
+# every pooled connection serves one generation at a time, stub shares the process with client,
+# so a third of that rate is required
+MIN_REQUESTS_PER_SECOND = MAX_CONNECTIONS * 1000 / LATENCY_MS / 3
+
+
+@pytest.fixture(name="stub_llm", scope="module")
+def fixture_stub_llm():
+    r"""Stub LLM api served in background thread, yields its url and ports of its clients."""
+    stub = create_stub_llm(LATENCY_MS)
+    client_ports: set[int] = set()
+
+    @stub.middleware("http")
+    async def record_client(request, call_next):
+        client_ports.add(request.client.port)
+        return await call_next(request)
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(stub, port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    yield f"http://127.0.0.1:{port}", client_ports
+    server.should_exit = True
+    thread.join()
+
+
+async def run_waves(api: LanguageModelAPI, call, waves: int = 2) -> list[float]:
+    r"""Send REQUESTS concurrent calls waves times, return seconds of every wave."""
+    seconds = []
+    try:
+        for _ in range(waves):
+            start = time.perf_counter()
+            results = await asyncio.gather(*(call(api, idx) for idx in range(REQUESTS)))
+            seconds.append(time.perf_counter() - start)
+            assert len(results) == REQUESTS
+    finally:
+        await api.aclose()
+    return seconds
+
+
+@pytest.mark.parametrize(
+    "call",
+    [
+        lambda api, idx: api.generate(f"prompt {idx}"),
+        lambda api, idx: api.generate_batch([f"prompt {idx}", f"other prompt {idx}"]),
+    ],
+    ids=["generate", "generate_batch"],
+)
+def test_concurrent_calls_reuse_pooled_connections(stub_llm, call):
+    url, client_ports = stub_llm
+    client_ports.clear()
+    api = LanguageModelAPI(url, max_connections=MAX_CONNECTIONS)
+
+    seconds = asyncio.run(run_waves(api, call))
+
+    # both waves are sent over the same keep-alive connections
+    assert len(client_ports) <= MAX_CONNECTIONS
+    assert REQUESTS / max(seconds) >= MIN_REQUESTS_PER_SECOND
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+from prometheus_client import REGISTRY
+
+from data.user_context import BaseMessage, RoleEnum
+from database.instrumented import InstrumentedDataBase
+from database.Interface import ChoiceNotFoundError
+from database.memory import InMemoryDataBase
+from database.threaded import ThreadedDataBase
+
+
+def calls(method: str) -> float:
+    return REGISTRY.get_sample_value("database_call_seconds_count", {"method": method}) or 0.0
+
+
+def test_metrics_expose_generate_stages_and_database_calls(stub_lm_api, client):
+    assert stub_lm_api
+    client.post("/users", json={"user_id": "user", "username": "name", "chat_id": "chat"})
+    response = client.patch("/users/user/context/generate", json={"text": "hi"})
+    assert response.status_code == 200
+
+    metrics = client.get("/metrics")
+
+    assert metrics.status_code == 200
+    assert metrics.headers["content-type"].startswith("text/plain")
+    for stage in (
+        "get_context",
+        "template",
+        "prompt",
+        "llm",
+        "answer_tokens",
+        "update_user_text",
+    ):
+        assert f'generate_stage_seconds_count{{stage="{stage}"}}' in metrics.text
+    for method in ("create_user", "get_context", "update_user_text"):
+        assert f'database_call_seconds_count{{method="{method}"}}' in metrics.text
+    assert "generated_tokens_total" in metrics.text
+
+
+@pytest.fixture(name="storage")
+def fixture_storage():
+    storage = InMemoryDataBase()
+    storage.create_user("user", "name", "chat")
+    storage.update_user_text("user", [BaseMessage("question", RoleEnum.user, "hi", token_count=1)])
+    return storage
+
+
+def test_instrumented_database_returns_results_unchanged(storage):
+    database = InstrumentedDataBase(ThreadedDataBase(storage, max_workers=1))
+    before = calls("get_context")
+
+    async def read():
+        context = await database.get_context("user", 8)
+        users = [user async for user in database.iter_users(limit=1)]
+        missing = [user async for user in database.iter_users(after_user_id="user")]
+        return context, users, missing, await database.get_user("missing")
+
+    context, users, missing, missing_user = asyncio.run(read())
+
+    assert context == storage.get_context("user", 8)
+    assert [user.user_id for user in users] == ["user"]
+    assert not missing
+    assert missing_user is None
+    assert calls("get_context") == before + 1
+
+
+def test_instrumented_database_raises_errors_unchanged(storage):
+    database = InstrumentedDataBase(ThreadedDataBase(storage, max_workers=1))
+    before = calls("update_user_choice")
+
+    with pytest.raises(ChoiceNotFoundError) as error:
+        asyncio.run(database.update_user_choice("user", "question", "unknown"))
+    with pytest.raises(ValueError, match="already exists"):
+        asyncio.run(database.create_user("user", "name", "chat"))
+
+    assert isinstance(error.value, ChoiceNotFoundError)
+    # failed calls are measured too
+    assert calls("update_user_choice") == before + 1
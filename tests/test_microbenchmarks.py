@@ -0,0 +1,29 @@
+from __future__ import annotations
+
+import json
+
+from benchmarks.microbenchmarks import (
+    DEFAULT_BASELINE,
+    MIN_DELTA,
+    collect_cases,
+    find_regressions,
+)
+
+
+def test_slowdown_must_exceed_threshold_and_noise_floor():
+    baseline = {"cases": {"fast": 0.0002, "slow": 1.0, "removed": 1.0}}
+    results = {"fast": 0.0002 + MIN_DELTA / 2, "slow": 1.25, "new": 5.0}
+
+    assert find_regressions(results, baseline, threshold=0.2) == ["slow"]
+    assert find_regressions(results, baseline, threshold=0.3) == []
+    assert find_regressions(results, baseline, threshold=0.2, min_delta=0) == ["fast", "slow"]
+
+
+def test_committed_baseline_has_every_case(tokenizer):
+    with open(DEFAULT_BASELINE, encoding="UTF-8") as stored:
+        baseline = json.load(stored)
+
+    assert baseline["tokenizer"] == "toy"
+    # default histories and sizes of the command
+    assert set(baseline["cases"]) == set(collect_cases(tokenizer, [10, 100, 1000], [50, 1000]))
+    assert all(value > 0 for value in baseline["cases"].values())
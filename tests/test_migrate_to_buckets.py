@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import mongomock
+import pytest
+
+import database.mongo
+import database.mongo_bucketed
+from data.user_context import BaseMessage
+from database.migrate_to_buckets import migrate
+from database.mongo import MongoDataBase
+from database.mongo_bucketed import BucketedMongoDataBase, MigrationConflictError
+
+
+def add_messages(storage, user_id: str, start: int, count: int) -> None:
+    storage.update_user_text(
+        user_id,
+        [
+            BaseMessage(str(idx), "user", f"message {idx}", token_count=1)
+            for idx in range(start, start + count)
+        ],
+    )
+
+
+def message_ids(storage, user_id: str) -> list[str]:
+    return [message.id for message in storage.get_user(user_id).context]
+
+
+def ids(start: int, stop: int) -> list[str]:
+    return [str(idx) for idx in range(start, stop)]
+
+
+@pytest.fixture(name="source")
+def fixture_source(mongo_database):
+    mongo_database.create_user("user", "name", "chat")
+    add_messages(mongo_database, "user", 0, 10)
+    return mongo_database
+
+
+def test_migrate_copies_only_new_messages(source, bucketed_database):
+    assert migrate(source.collection, bucketed_database) == 10
+    add_messages(source, "user", 10, 3)
+
+    assert migrate(source.collection, bucketed_database) == 3
+    assert migrate(source.collection, bucketed_database) == 0
+    assert message_ids(bucketed_database, "user") == [str(idx) for idx in range(13)]
+
+
+def test_interrupted_migration_does_not_duplicate_messages(source, bucketed_database):
+    update_one = bucketed_database.collection.update_one
+
+    def crash(*args, **kwargs):
+        raise ConnectionError("connection lost")
+
+    # buckets are written, but migrated count is not
+    bucketed_database.collection.update_one = crash
+    with pytest.raises(ConnectionError):
+        migrate(source.collection, bucketed_database)
+    bucketed_database.collection.update_one = update_one
+    add_messages(source, "user", 10, 3)
+
+    assert migrate(source.collection, bucketed_database) == 13
+    assert message_ids(bucketed_database, "user") == [str(idx) for idx in range(13)]
+
+
+def test_messages_written_to_source_after_switch_are_appended(source, bucketed_database):
+    migrate(source.collection, bucketed_database)
+    add_messages(bucketed_database, "user", 100, 2)
+    add_messages(source, "user", 10, 3)
+
+    assert migrate(source.collection, bucketed_database) == 3
+    assert migrate(source.collection, bucketed_database) == 0
+    assert message_ids(bucketed_database, "user") == ids(0, 10) + ["100", "101"] + ids(10, 13)
+
+
+def test_source_messages_of_user_created_by_bucketed_service_are_appended(
+    source, bucketed_database
+):
+    bucketed_database.create_user("user", "name", "chat")
+    add_messages(bucketed_database, "user", 100, 1)
+
+    assert migrate(source.collection, bucketed_database) == 10
+    assert migrate(source.collection, bucketed_database) == 0
+    assert message_ids(bucketed_database, "user") == ["100"] + ids(0, 10)
+
+
+def test_stale_copy_does_not_replace_messages_of_service(source, bucketed_database, monkeypatch):
+    migrate(source.collection, bucketed_database)
+    add_messages(bucketed_database, "user", 100, 1)
+    # another process read the user before its last two messages were copied
+    monkeypatch.setattr(
+        bucketed_database.collection,
+        "find_one_and_update",
+        lambda *args, **kwargs: {"message_count": 8, "migrated_count": 8},
+    )
+    source_bson = source.collection.find_one({"user_id": "user"}, {"_id": 0})
+
+    with pytest.raises(MigrationConflictError):
+        bucketed_database.migrate_user(source.collection, source_bson)
+    assert message_ids(bucketed_database, "user") == ids(0, 10) + ["100"]
+
+
+@pytest.fixture(name="switched")
+def fixture_switched(monkeypatch):
+    r"""
+    Embedded source after the last migration pass and bucketed storage taking it over, both
+    storages use one mongomock client
+    """
+    shared_client = mongomock.MongoClient()
+    monkeypatch.setattr(database.mongo, "MongoClient", lambda *args, **kwargs: shared_client)
+    monkeypatch.setattr(
+        database.mongo_bucketed, "MongoClient", lambda *args, **kwargs: shared_client
+    )
+    source = MongoDataBase("mongodb://localhost", "chat", "users")
+    source.create_user("user", "name", "chat")
+    add_messages(source, "user", 0, 10)
+    target = BucketedMongoDataBase(
+        "mongodb://localhost", "chat", "buckets", bucket_size=4, migration_source_table="users"
+    )
+    migrate(source.collection, target)
+    return source, target
+
+
+def test_user_is_handed_over_when_it_is_served_first_time(switched):
+    source, target = switched
+    add_messages(source, "user", 10, 3)
+    source.clear_history("user")
+
+    _, context = target.get_context("user", 10)
+    assert context == []
+    add_messages(target, "user", 100, 2)
+
+    assert message_ids(target, "user") == ids(0, 13) + ["100", "101"]
+    assert "user" in target.handed_over
+    assert migrate(source.collection, target) == 0
+
+
+def test_messages_written_by_embedded_process_after_handover_are_appended(switched):
+    source, target = switched
+    add_messages(target, "user", 100, 1)
+    # request served by embedded process still running during rolling restart
+    add_messages(source, "user", 10, 1)
+
+    assert message_ids(target, "user") == ids(0, 10) + ["100"]
+    assert migrate(source.collection, target) == 1
+    assert message_ids(target, "user") == ids(0, 10) + ["100", "10"]
+
+
+def test_removed_user_is_not_copied_again(switched):
+    source, target = switched
+
+    target.remove_user("user")
+
+    assert source.get_user("user") is None
+    assert migrate(source.collection, target) == 0
+    assert target.get_user("user") is None
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+from data.user_context import BaseMessage, ModelAnswer
+from database.mongo import find_collection_scans, is_collection_scan
+
+
+def message(idx: int) -> BaseMessage:
+    return BaseMessage(str(idx), "user", f"message {idx}", token_count=1)
+
+
+def test_replayed_appends_store_messages_once(mongo_database):
+    for user_id in ("first", "second"):
+        mongo_database.create_user(user_id, "name", "chat")
+    answer = ModelAnswer(
+        "answer",
+        "bot",
+        "text",
+        possible_contexts=["text", "other"],
+        possible_contexts_ids=["a", "b"],
+    )
+    updates = [("first", [message(0), answer]), ("second", [message(1)])]
+
+    mongo_database.update_users_texts(updates)
+    # write of the same journal segment is retried after a lost reply
+    mongo_database.update_users_texts(updates + [("first", [message(2)])])
+
+    assert [text.id for text in mongo_database.get_user("first").context] == ["0", "answer", "2"]
+    assert [text.id for text in mongo_database.get_user("second").context] == ["1"]
+    assert mongo_database.candidates.count_documents({}) == 1
+
+
+def index_scan(field: str) -> dict:
+    return {"stage": "IXSCAN", "keyPattern": {field: 1}}
+
+
+class ExplainedCollection:
+    r"""Collection explaining queries by index scan of their first field when it is indexed."""
+
+    def __init__(self, indexed: set[str]):
+        self.indexed = indexed
+        self.query: dict = {}
+
+    def find(self, query: dict) -> ExplainedCollection:
+        self.query = query
+        return self
+
+    def explain(self) -> dict:
+        field = next(iter(self.query))
+        if field in self.indexed:
+            plan = {"stage": "FETCH", "inputStage": index_scan(field)}
+        else:
+            plan = {"stage": "COLLSCAN", "filter": self.query}
+        return {"queryPlanner": {"winningPlan": plan, "rejectedPlans": []}}
+
+
+def test_queries_without_index_are_found():
+    collection = ExplainedCollection({"user_id"})
+    queries = {"user": {"user_id": ""}, "chat": {"chat_id": ""}, "page": {"user_id": {"$gt": ""}}}
+
+    assert find_collection_scans(collection, queries) == ["chat"]
+
+
+def test_collection_scan_is_found_in_shards_of_plan():
+    sharded = {
+        "queryPlanner": {
+            "winningPlan": {
+                "stage": "SHARD_MERGE",
+                "shards": [
+                    {"winningPlan": {"stage": "FETCH", "inputStage": index_scan("user_id")}},
+                    {
+                        "winningPlan": {
+                            "stage": "SHARDING_FILTER",
+                            "inputStage": {"stage": "COLLSCAN"},
+                        }
+                    },
+                ],
+            }
+        }
+    }
+
+    assert is_collection_scan(sharded)
+    assert not is_collection_scan({"queryPlanner": {"winningPlan": index_scan("user_id")}})
@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from data.user_context import BaseMessage
+
+
+def message(idx: int) -> BaseMessage:
+    return BaseMessage(str(idx), "user", f"message {idx}", token_count=1)
+
+
+def test_users_are_created_updated_and_removed(async_database):
+    async def scenario():
+        await async_database.ensure_indexes()
+        for user_id in ("b", "a", "c"):
+            await async_database.create_user(user_id, user_id, user_id)
+        with pytest.raises(ValueError):
+            await async_database.create_user("a", "a", "a")
+        await async_database.update_user_text("a", [message(0), message(1)])
+        user = await async_database.get_user("a")
+        assert [text.id for text in user.context] == ["0", "1"]
+
+        page = [user.user_id async for user in async_database.iter_users("a", limit=1)]
+        assert page == ["b"]
+
+        await async_database.clear_history("a")
+        assert (await async_database.get_user("a")).current_context_start_idx == 2
+        await async_database.remove_user("a")
+        assert await async_database.get_user("a") is None
+        assert [user.user_id async for user in async_database.iter_users()] == ["b", "c"]
+
+    asyncio.run(scenario())
@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import json
+from pathlib import Path
+
+import pytest
+
+from data.user_context import BaseMessage, RoleEnum
+from language_model.Chat import Conversation
+from language_model.prompt_cache import PromptPrefix, PromptPrefixCache
+from language_model.templates import ConversationTemplate
+
+DEFAULT_TEMPLATE = (
+    Path(__file__).resolve().parents[1] / "templates" / "chat_conversation_template.json"
+)
+MAX_TOKENS = 4096
+
+
+def messages(start: int, stop: int) -> list[BaseMessage]:
+    return [
+        BaseMessage(str(idx), RoleEnum.user if idx % 2 == 0 else RoleEnum.bot, f"message {idx}")
+        for idx in range(start, stop)
+    ]
+
+
+def build_prompt(
+    template: ConversationTemplate,
+    tokenizer,
+    user_messages: list[BaseMessage],
+    cache: PromptPrefixCache | None = None,
+    system_prompt: str = "system",
+) -> tuple[str, Conversation, bool]:
+    r"""Return prompt, its conversation and whether cached messages were reused."""
+    conversation = template.create_conversation(system_prompt, tokenizer)
+    if cache is None:
+        conversation.expand(user_messages)
+    else:
+        cache.expand("user", conversation, user_messages)
+    # reused messages are added already formatted
+    reused = bool(user_messages) and None not in conversation.formatted_messages[1:]
+    return conversation.get_prompt_for_generate(tokenizer, MAX_TOKENS), conversation, reused
+
+
+def remember(cache: PromptPrefixCache, conversation: Conversation, user_messages) -> None:
+    cache.remember("user", conversation, [message.id for message in user_messages])
+
+
+@pytest.fixture(name="template")
+def fixture_template():
+    return ConversationTemplate.load("default", str(DEFAULT_TEMPLATE))
+
+
+@pytest.fixture(name="cache")
+def fixture_cache(template, tokenizer):
+    cache = PromptPrefixCache(max_users=8)
+    _, conversation, _ = build_prompt(template, tokenizer, messages(0, 6))
+    remember(cache, conversation, messages(0, 6))
+    return cache
+
+
+@pytest.mark.parametrize("window", [(0, 6), (2, 6)], ids=["same", "slid"])
+def test_prefix_is_reused_after_turn(template, tokenizer, cache, window):
+    user_messages = messages(*window)
+
+    prompt, _, reused = build_prompt(template, tokenizer, user_messages, cache)
+
+    assert reused
+    assert prompt == build_prompt(template, tokenizer, user_messages)[0]
+
+
+def test_prefix_is_missed_when_last_message_differs(template, tokenizer, cache):
+    assert cache.get("user", "6") is None
+    user_messages = messages(0, 7)
+
+    prompt, _, reused = build_prompt(template, tokenizer, user_messages, cache)
+
+    assert not reused
+    assert prompt == build_prompt(template, tokenizer, user_messages)[0]
+
+
+def test_prefix_is_missed_when_cached_message_is_changed(template, tokenizer, cache):
+    user_messages = messages(0, 6)
+    # chosen candidate replaced text of answer with the same id
+    user_messages[3].context = "chosen candidate"
+
+    prompt, _, reused = build_prompt(template, tokenizer, user_messages, cache)
+
+    assert not reused
+    assert "chosen candidate" in prompt
+    assert prompt == build_prompt(template, tokenizer, user_messages)[0]
+
+
+def test_prefix_is_rejected_for_other_template(tokenizer, cache, tmp_path):
+    path = tmp_path / "other.json"
+    path.write_text(json.dumps({"message_template": "{role}: {content}\n"}), encoding="UTF-8")
+    other = ConversationTemplate.load("other", str(path))
+
+    prompt, _, reused = build_prompt(other, tokenizer, messages(0, 6), cache)
+
+    assert not reused
+    assert prompt == build_prompt(other, tokenizer, messages(0, 6))[0]
+    assert "user: message 0" in prompt
+
+
+def test_prefix_is_rejected_for_other_system_prompt(template, tokenizer, cache):
+    prompt, _, reused = build_prompt(
+        template, tokenizer, messages(0, 6), cache, system_prompt="changed"
+    )
+
+    assert not reused
+    assert prompt == build_prompt(template, tokenizer, messages(0, 6), system_prompt="changed")[0]
+
+
+def prefix(message_id: str) -> PromptPrefix:
+    return PromptPrefix("{content}", "system", [message_id], [{}], [""], [1])
+
+
+def test_least_recently_used_user_is_evicted():
+    cache = PromptPrefixCache(max_users=2)
+    cache.put("a", prefix("1"))
+    cache.put("b", prefix("1"))
+    assert cache.get("a", "1") is not None
+
+    cache.put("c", prefix("1"))
+
+    assert cache.get("b", "1") is None
+    assert cache.get("a", "1") is not None
+    assert cache.get("c", "1") is not None
+
+
+def test_disabled_cache_stores_nothing():
+    cache = PromptPrefixCache(max_users=0)
+    cache.put("a", prefix("1"))
+
+    assert cache.get("a", "1") is None
+
+
+@pytest.fixture(name="service")
+def fixture_service(app_module, stub_lm_api, client):
+    client.post("/users", json={"user_id": "user", "username": "name", "chat_id": "chat"})
+    return app_module, client, stub_lm_api
+
+
+def generate(client, text: str) -> str:
+    response = client.patch("/users/user/context/generate", json={"text": text})
+    assert response.status_code == 200
+    return response.json()["answer_id"]
+
+
+def test_prefix_is_invalidated_by_choice_and_custom_answer(service):
+    app_module, client, stub = service
+    candidate_ids = ["candidate 0", "candidate 1"]
+
+    answer_id = generate(client, "question 0")
+    assert app_module.prompt_cache.get("user", answer_id) is not None
+    client.post(
+        f"/users/user/context/{answer_id}/possible_contexts_ids",
+        json={"possible_contexts_ids": candidate_ids},
+    )
+    response = client.post(
+        f"/users/user/context/{answer_id}/user_choice", json={"message_id": candidate_ids[1]}
+    )
+    assert response.json() == {"text": stub.texts[1]}
+    assert app_module.prompt_cache.get("user", answer_id) is None
+
+    answer_id = generate(client, "question 1")
+    assert stub.texts[1] in app_module.lm_api.api.prompts[-1]
+    client.post(
+        f"/users/user/context/{answer_id}/possible_contexts_ids",
+        json={"possible_contexts_ids": candidate_ids},
+    )
+    client.post(
+        "/users/user/context/messages/custom_answer",
+        json={"message_id": candidate_ids[0], "custom_text": "custom answer"},
+    )
+    assert app_module.prompt_cache.get("user", answer_id) is None
+
+    generate(client, "question 2")
+    assert "custom answer" in app_module.lm_api.api.prompts[-1]
+
+
+def test_prompts_are_the_same_without_cache(service, monkeypatch):
+    app_module, client, _ = service
+    reused: list[int] = []
+    extend_tokenized = Conversation.extend_tokenized
+
+    def record_reused(conversation, cached_messages, *args):
+        reused.append(len(cached_messages))
+        extend_tokenized(conversation, cached_messages, *args)
+
+    monkeypatch.setattr(Conversation, "extend_tokenized", record_reused)
+    # window of CONTEXT_SIZE (8) messages slides after four turns
+    for turn in range(6):
+        generate(client, f"question {turn}")
+    cached_prompts = list(app_module.lm_api.api.prompts)
+    # every turn after the first one reuses messages of the previous one
+    assert reused == [2, 4, 6, 8, 8]
+
+    monkeypatch.setattr(app_module, "prompt_cache", PromptPrefixCache(max_users=0))
+    client.delete("/users/user/context")
+    client.delete("/users/user")
+    client.post("/users", json={"user_id": "user", "username": "name", "chat_id": "chat"})
+    for turn in range(6):
+        generate(client, f"question {turn}")
+
+    assert app_module.lm_api.api.prompts[len(cached_prompts) :] == cached_prompts
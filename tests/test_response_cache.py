@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import asyncio
+from collections.abc import AsyncIterator
+
+from prometheus_client import REGISTRY
+
+from api.response_cache import CachingLanguageModelAPI
+from data.base_classes import GenerationLLMResponse
+
+
+class CountingAPI:
+    r"""LLM api answering every prompt by its text and counting calls."""
+
+    def __init__(self):
+        self.calls: list[str] = []
+
+    async def generate(self, text: str) -> GenerationLLMResponse:
+        self.calls.append(text)
+        await asyncio.sleep(0.01)
+        return GenerationLLMResponse([f"answer to {text}"])
+
+    async def generate_stream(self, text: str) -> AsyncIterator[GenerationLLMResponse]:
+        self.calls.append(text)
+        yield GenerationLLMResponse(["answer"])
+        yield GenerationLLMResponse([f"answer to {text}"])
+
+    async def aclose(self) -> None:
+        pass
+
+
+def saved_calls(reason: str) -> float:
+    return REGISTRY.get_sample_value("llm_calls_saved_total", {"reason": reason}) or 0.0
+
+
+def test_identical_prompts_share_one_call():
+    inner = CountingAPI()
+    api = CachingLanguageModelAPI(inner)
+    coalesced_before = saved_calls("coalesced")
+    cached_before = saved_calls("cache")
+
+    async def scenario():
+        concurrent = await asyncio.gather(*(api.generate("prompt") for _ in range(3)))
+        repeated = await api.generate("prompt")
+        other = await api.generate("other prompt")
+        await api.aclose()
+        return concurrent + [repeated, other]
+
+    answers = [response.texts for response in asyncio.run(scenario())]
+
+    assert answers == [["answer to prompt"]] * 4 + [["answer to other prompt"]]
+    assert inner.calls == ["prompt", "other prompt"]
+    assert (api.metrics.misses, api.metrics.coalesced, api.metrics.hits) == (2, 2, 1)
+    assert saved_calls("coalesced") - coalesced_before == 2
+    assert saved_calls("cache") - cached_before == 1
+
+
+def test_expired_and_evicted_responses_are_generated_again():
+    inner = CountingAPI()
+    api = CachingLanguageModelAPI(inner, max_entries=1, ttl_seconds=0.05)
+
+    async def scenario():
+        await api.generate("first")
+        await api.generate("second")  # evicts first
+        await api.generate("first")  # evicts second
+        await asyncio.sleep(0.1)
+        await api.generate("first")  # expired
+        await api.aclose()
+
+    asyncio.run(scenario())
+
+    assert inner.calls == ["first", "second", "first", "first"]
+    assert api.metrics.evictions == 2
+    assert api.metrics.entries == 1
+
+
+def test_completed_stream_is_cached():
+    inner = CountingAPI()
+    api = CachingLanguageModelAPI(inner)
+
+    async def stream_texts() -> list[list[list[str]]]:
+        streams = []
+        for _ in range(2):
+            streams.append([response.texts async for response in api.generate_stream("prompt")])
+        await api.aclose()
+        return streams
+
+    first, second = asyncio.run(stream_texts())
+
+    assert first == [["answer"], ["answer to prompt"]]
+    assert second == [["answer to prompt"]]
+    assert inner.calls == ["prompt"]
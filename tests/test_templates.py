@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import json
+import os
+
+import pytest
+
+from language_model.templates import CompiledMessageTemplate, TemplateRegistry
+
+
+@pytest.mark.parametrize(
+    "template",
+    [
+        "<s>{role}\n{content}</s>\n",
+        "{role}: {content}{role}",
+        "no fields {{escaped}}",
+        "{role!r}: {content:>12}",
+        "{message[role]}: {message[content]}",
+    ],
+)
+def test_compiled_template_formats_like_str_format(template):
+    values = {"role": "user", "content": "hello", "message": {"role": "bot", "content": "hi"}}
+
+    assert CompiledMessageTemplate(template).format(**values) == template.format(**values)
+
+
+def write_template(path, message_template: str, mtime_ns: int) -> None:
+    path.write_text(json.dumps({"message_template": message_template}), encoding="UTF-8")
+    # mtime is set explicitly, file system may not see writes done in the same tick
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def default_template(registry: TemplateRegistry) -> str:
+    return registry.get().message_template.template
+
+
+def test_template_is_reloaded_when_its_file_changes(tmp_path):
+    path = tmp_path / "template.json"
+    write_template(path, "{role}: {content}", 1_000_000_000)
+    registry = TemplateRegistry.from_paths(str(path))
+    first = registry.get()
+
+    assert registry.get() is first
+    write_template(path, "{role}> {content}", 2_000_000_000)
+    assert default_template(registry) == "{role}> {content}"
+
+
+def test_last_loaded_template_is_used_while_file_is_broken(tmp_path, caplog):
+    path = tmp_path / "template.json"
+    write_template(path, "{role}: {content}", 1_000_000_000)
+    registry = TemplateRegistry.from_paths(str(path))
+
+    path.write_text("{not json", encoding="UTF-8")
+    os.utime(path, ns=(2_000_000_000, 2_000_000_000))
+    assert default_template(registry) == "{role}: {content}"
+    write_template(path, "{role}", 3_000_000_000)
+    path.write_text(json.dumps({"no_message_template": ""}), encoding="UTF-8")
+    assert default_template(registry) == "{role}: {content}"
+    path.unlink()
+    assert default_template(registry) == "{role}: {content}"
+    assert default_template(registry) == "{role}: {content}"
+
+    write_template(path, "{role}> {content}", 4_000_000_000)
+    assert default_template(registry) == "{role}> {content}"
+    # every broken version is logged once
+    assert len([record for record in caplog.records if record.levelname == "ERROR"]) == 3
+
+
+def test_generate_with_unknown_template_is_rejected(client):
+    client.post("/users", json={"user_id": "user", "username": "name", "chat_id": "chat"})
+
+    response = client.patch(
+        "/users/user/context/generate", json={"text": "hi", "template_name": "missing"}
+    )
+
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Unknown template missing"}
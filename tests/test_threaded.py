@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from database.memory import InMemoryDataBase
+from database.threaded import ThreadedDataBase
+
+MAX_WORKERS = 2
+
+
+class SlowReads(InMemoryDataBase):
+    r"""Database recording threads of calls and how many of them ran at once."""
+
+    def __init__(self):
+        super().__init__()
+        self.threads: set[str] = set()
+        self.running = 0
+        self.max_running = 0
+        self.counter_lock = threading.Lock()
+
+    def get_user(self, user_id: str):
+        with self.counter_lock:
+            self.threads.add(threading.current_thread().name)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.02)
+        with self.counter_lock:
+            self.running -= 1
+        return super().get_user(user_id)
+
+
+async def get_users(database: ThreadedDataBase, count: int) -> list:
+    return await asyncio.gather(*(database.get_user("user") for _ in range(count)))
+
+
+def test_calls_run_in_own_threads_limited_by_max_workers():
+    storage = SlowReads()
+    storage.create_user("user", "name", "chat")
+    database = ThreadedDataBase(storage, max_workers=MAX_WORKERS)
+
+    users = asyncio.run(get_users(database, 8))
+
+    assert [user.user_id for user in users] == ["user"] * 8
+    assert storage.max_running == MAX_WORKERS
+    assert all(name.startswith("database") for name in storage.threads)
+
+
+def test_close_stops_threads():
+    storage = SlowReads()
+    database = ThreadedDataBase(storage, max_workers=MAX_WORKERS)
+    asyncio.run(get_users(database, 2))
+
+    database.close()
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(get_users(database, 1))
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from language_model.tokenizer_loader import TokenizerLoader
+
+
+class BlockedLoader(TokenizerLoader):
+    r"""Loader which waits for release before tokenizer is read."""
+
+    def __init__(self, local_path: str):
+        super().__init__("toy", local_path=local_path)
+        self.release = threading.Event()
+
+    def load(self):
+        self.release.wait(10)
+        return super().load()
+
+
+def wait_until_ready(loader: TokenizerLoader) -> None:
+    deadline = time.monotonic() + 10
+    while not loader.ready and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+@pytest.fixture(name="tokenizer_path")
+def fixture_tokenizer_path(app_module):
+    return app_module.tokenizer_loader.local_path
+
+
+@pytest.fixture(name="loader")
+def fixture_loader(request, app_module, tokenizer_path, tmp_path, monkeypatch):
+    r"""
+    Loader of service started by client fixture requested after this one, kind of loader is
+    parametrized: blocked, failing or preloaded
+    """
+    if request.param == "blocked":
+        loader = BlockedLoader(tokenizer_path)
+    elif request.param == "failing":
+        # empty directory has no tokenizer snapshot
+        loader = TokenizerLoader("toy", local_path=str(tmp_path))
+    else:
+        loader = TokenizerLoader("toy", local_path=tokenizer_path)
+        # TOKENIZER_PRELOAD loads tokenizer at import, before event loop is running
+        loader.load()
+    monkeypatch.setattr(app_module, "tokenizer_loader", loader)
+    monkeypatch.setattr(app_module, "startup_phases", {})
+    yield loader
+    if isinstance(loader, BlockedLoader):
+        loader.release.set()
+
+
+@pytest.mark.parametrize("loader", ["blocked"], indirect=True)
+def test_ready_is_unavailable_until_tokenizer_is_loaded(loader, client):
+    assert client.get("/ping").status_code == 200
+    response = client.get("/ready")
+    assert response.status_code == 503
+    assert response.json() == {"detail": "Tokenizer is loading"}
+
+    loader.release.set()
+    wait_until_ready(loader)
+
+    assert client.get("/ready").json() == {"ready": True}
+    assert loader.load_seconds is not None
+
+
+@pytest.mark.parametrize("loader", ["failing"], indirect=True)
+def test_generate_is_unavailable_when_tokenizer_can_not_be_loaded(loader, client):
+    client.post("/users", json={"user_id": "user", "username": "name", "chat_id": "chat"})
+
+    response = client.patch("/users/user/context/generate", json={"text": "hi"})
+
+    assert response.status_code == 503
+    assert response.json() == {"detail": "Tokenizer is not loaded"}
+    assert client.get("/ready").status_code == 503
+    assert not loader.ready
+
+
+def test_failed_load_is_started_again_by_next_wait(tokenizer_path, tmp_path):
+    loader = TokenizerLoader("toy", local_path=str(tmp_path))
+
+    async def wait_twice():
+        with pytest.raises(OSError):
+            await loader.wait()
+        loader.local_path = tokenizer_path
+        return await loader.wait()
+
+    tokenizer = asyncio.run(wait_twice())
+
+    assert loader.ready
+    assert loader.tokenizer is tokenizer
+
+
+@pytest.mark.parametrize("loader", ["preloaded"], indirect=True)
+def test_preloaded_tokenizer_is_ready_at_startup(app_module, loader, client):
+    tokenizer = loader.tokenizer
+
+    assert client.get("/ready").json() == {"ready": True}
+    assert asyncio.run(loader.wait()) is tokenizer
+    assert app_module.startup_phases["tokenizer"] == loader.load_seconds
@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from data.user_context import BaseMessage, ModelAnswer
+from database.Interface import ChoiceNotFoundError
+from tests.aggregation import AsyncPipelineUpdates, PipelineUpdates
+
+
+def conversation() -> list[BaseMessage]:
+    return [
+        BaseMessage("question", "user", "question"),
+        ModelAnswer(
+            "answer",
+            "bot",
+            "first",
+            possible_contexts=["first", "second"],
+            possible_contexts_ids=["first_id", "second_id"],
+        ),
+    ]
+
+
+# candidates of answers stored in the message before candidates collection was added
+CANDIDATE_TEXTS = ["first", "second"]
+CANDIDATE_IDS = ["first_id", "second_id"]
+
+
+def inline_candidates_update(messages_field: str) -> dict:
+    return {
+        "$set": {
+            f"{messages_field}.$.possible_contexts": CANDIDATE_TEXTS,
+            f"{messages_field}.$.possible_contexts_ids": CANDIDATE_IDS,
+        }
+    }
+
+
+def answer_text(user) -> str:
+    return [message.context for message in user.context if message.id == "answer"][0]
+
+
+@pytest.fixture(name="storage", params=["mongo_database", "bucketed_database"])
+def fixture_storage(request):
+    storage = request.getfixturevalue(request.param)
+    storage.create_user("user", "name", "chat")
+    storage.update_user_text("user", conversation())
+    return storage
+
+
+@pytest.fixture(
+    name="inline",
+    params=[
+        ("mongo_database", "collection", "context"),
+        ("bucketed_database", "messages", "messages"),
+    ],
+    ids=["embedded", "bucketed"],
+)
+def fixture_inline(request):
+    r"""Storage with answer having candidates in the message, its update pipelines are evaluated."""
+    name, collection_name, messages_field = request.param
+    storage = request.getfixturevalue(name)
+    storage.create_user("user", "name", "chat")
+    storage.update_user_text("user", conversation())
+    storage.candidates.delete_many({})
+    collection = PipelineUpdates(getattr(storage, collection_name))
+    setattr(storage, collection_name, collection)
+    collection.update_one(
+        {f"{messages_field}.id": "answer"}, inline_candidates_update(messages_field)
+    )
+
+    def stored_answer() -> dict:
+        document = collection.find_one({f"{messages_field}.id": "answer"})
+        return [message for message in document[messages_field] if message["id"] == "answer"][0]
+
+    return storage, stored_answer
+
+
+def test_inline_candidate_is_chosen_by_update_pipeline(inline):
+    storage, stored_answer = inline
+
+    assert storage.update_user_choice("user", "answer", "second_id") == "second"
+    assert stored_answer() == {
+        **stored_answer(),
+        "possible_contexts": CANDIDATE_TEXTS,
+        "possible_contexts_ids": CANDIDATE_IDS,
+        "context": "second",
+        "user_choice": "second_id",
+    }
+    assert answer_text(storage.get_user("user")) == "second"
+
+
+def test_custom_answer_replaces_answer_with_inline_candidates(inline):
+    storage, stored_answer = inline
+
+    storage.update_user_custom_choice("user", "first_id", "custom")
+
+    assert (stored_answer()["context"], stored_answer()["user_choice"]) == ("custom", "custom")
+
+
+def test_unknown_inline_candidate_is_not_found(inline):
+    storage, stored_answer = inline
+
+    with pytest.raises(ChoiceNotFoundError):
+        storage.update_user_choice("user", "answer", "third_id")
+    with pytest.raises(ChoiceNotFoundError):
+        storage.update_user_choice("user", "other_answer", "first_id")
+    with pytest.raises(ChoiceNotFoundError):
+        storage.update_user_custom_choice("user", "third_id", "custom")
+    assert stored_answer()["context"] == "first"
+
+
+def test_async_inline_candidate_is_chosen_by_update_pipeline(async_database):
+    async def scenario():
+        await async_database.create_user("user", "name", "chat")
+        await async_database.update_user_text("user", conversation())
+        await async_database.candidates.delete_many({})
+        async_database.collection = AsyncPipelineUpdates(async_database.collection)
+        await async_database.collection.update_one(
+            {"context.id": "answer"}, inline_candidates_update("context")
+        )
+
+        assert await async_database.update_user_choice("user", "answer", "second_id") == "second"
+        with pytest.raises(ChoiceNotFoundError):
+            await async_database.update_user_choice("user", "answer", "third_id")
+        return await async_database.get_user("user")
+
+    assert answer_text(asyncio.run(scenario())) == "second"
+
+
+def test_chosen_candidate_is_stored(storage):
+    assert storage.update_user_choice("user", "answer", "second_id") == "second"
+    assert answer_text(storage.get_user("user")) == "second"
+
+    storage.update_user_custom_choice("user", "first_id", "custom")
+    assert answer_text(storage.get_user("user")) == "custom"
+
+
+def test_choice_of_answer_with_expired_candidates_is_not_found(storage):
+    # TTL index removed candidates of the answer
+    storage.candidates.delete_many({})
+
+    with pytest.raises(ChoiceNotFoundError):
+        storage.update_user_choice("user", "answer", "second_id")
+    with pytest.raises(ChoiceNotFoundError):
+        storage.update_user_custom_choice("user", "second_id", "custom")
+    assert answer_text(storage.get_user("user")) == "first"
+
+
+def test_async_choice_of_answer_with_expired_candidates_is_not_found(async_database):
+    async def scenario():
+        await async_database.create_user("user", "name", "chat")
+        await async_database.update_user_text("user", conversation())
+        assert await async_database.update_user_choice("user", "answer", "second_id") == "second"
+
+        await async_database.candidates.delete_many({})
+        with pytest.raises(ChoiceNotFoundError):
+            await async_database.update_user_choice("user", "answer", "first_id")
+        with pytest.raises(ChoiceNotFoundError):
+            await async_database.update_user_custom_choice("user", "first_id", "custom")
+        return await async_database.get_user("user")
+
+    assert answer_text(asyncio.run(scenario())) == "second"
+
+
+def test_choice_of_unknown_answer_is_not_found(client):
+    client.post("/users", json={"user_id": "user", "username": "name", "chat_id": "chat"})
+
+    choice = client.post("/users/user/context/answer/user_choice", json={"message_id": "first_id"})
+    custom = client.post(
+        "/users/user/context/messages/custom_answer",
+        json={"message_id": "first_id", "custom_text": "custom"},
+    )
+
+    assert (choice.status_code, custom.status_code) == (404, 404)
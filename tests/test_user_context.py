@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import copy
+
+from data.user_context import BaseMessage, User
+
+
+def user_document() -> dict:
+    return {
+        "user_id": "user",
+        "username": "name",
+        "chat_id": "chat",
+        "current_context_start_idx": 0,
+        "system_prompt": {"id": "system", "role": "system", "context": "prompt", "token_count": 3},
+        "context": [
+            {"id": "0", "role": "user", "context": "question", "token_count": 5},
+            {"id": "1", "role": "bot", "context": "answer", "token_count": 7},
+            # stored before token counts were kept
+            {"id": "2", "role": "user", "context": "question"},
+        ],
+    }
+
+
+def test_stored_token_counts_are_kept_by_user_documents():
+    document = user_document()
+    user = User.from_bson(document)
+
+    assert user.to_bson() == {
+        **document,
+        "context": [*document["context"][:2], {**document["context"][2], "token_count": None}],
+    }
+    assert user.system_prompt.token_count == 3
+    assert user.context[1] == BaseMessage("1", "bot", "answer", 7)
+    assert [message.token_count for message in user.context] == [5, 7, None]
+    assert [message.token_count for message in copy.deepcopy(user.context)] == [5, 7, None]
+    assert user.to_bson()["context"] == [message.to_bson() for message in user.context]
+
+
+def test_get_user_returns_stored_token_counts(mongo_database):
+    mongo_database.create_user("user", "name", "chat")
+    mongo_database.update_user_text(
+        "user", [BaseMessage("0", "user", "question", 5), BaseMessage("1", "user", "question", 6)]
+    )
+
+    user = mongo_database.get_user("user")
+
+    assert user.to_bson()["context"][0]["token_count"] == 5
+    assert [message.token_count for message in user.context] == [5, 6]
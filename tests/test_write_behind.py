@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import asyncio
+import os
+
+import pytest
+
+from data.user_context import BaseMessage
+from database.journal import DEAD_LETTER_DIRECTORY, WriteJournal
+from database.threaded import ThreadedDataBase
+from database.write_behind import WriteBehindDataBase
+
+
+def message(idx: int) -> BaseMessage:
+    return BaseMessage(str(idx), "user", f"message {idx}", token_count=1)
+
+
+def stored_ids(storage) -> list[str]:
+    return [text.id for text in storage.get_user("user").context]
+
+
+@pytest.fixture(name="storage")
+def fixture_storage(mongo_database):
+    mongo_database.create_user("user", "name", "chat")
+    return mongo_database
+
+
+@pytest.fixture(name="threaded")
+def fixture_threaded(storage):
+    threaded = ThreadedDataBase(storage)
+    yield threaded
+    threaded.close()
+
+
+def write_behind(threaded: ThreadedDataBase, directory, **kwargs) -> WriteBehindDataBase:
+    # updates are written only by explicit flush
+    return WriteBehindDataBase(
+        threaded, WriteJournal(str(directory)), flush_interval_ms=60_000, **kwargs
+    )
+
+
+def test_update_is_acknowledged_before_database_write(storage, threaded, tmp_path):
+    async def scenario():
+        database = write_behind(threaded, tmp_path)
+        await database.start()
+        await database.update_user_text("user", [message(0), message(1)])
+
+        assert stored_ids(storage) == []
+        assert [text.id for text in (await database.get_user("user")).context] == ["0", "1"]
+        await database.flush()
+        assert stored_ids(storage) == ["0", "1"]
+        await database.aclose()
+
+    asyncio.run(scenario())
+    assert not os.listdir(tmp_path)
+
+
+def test_journal_of_crashed_process_is_replayed_once(storage, threaded, tmp_path):
+    async def crash():
+        database = write_behind(threaded, tmp_path)
+        await database.start()
+        await database.update_user_text("user", [message(0), message(1)])
+        await database.update_user_text("user", [message(2), message(3)])
+        # the first update reached database right before crash
+        storage.update_users_texts([("user", [message(0), message(1)])])
+        # process is gone without flush, locks of its segments are released
+        database.journal.close()
+
+    async def restart():
+        database = write_behind(threaded, tmp_path)
+        await database.start()
+        await database.aclose()
+        return database.metrics.recovered_updates
+
+    asyncio.run(crash())
+    assert asyncio.run(restart()) == 2
+    assert stored_ids(storage) == ["0", "1", "2", "3"]
+    assert not os.listdir(tmp_path)
+
+
+def test_failed_flush_keeps_updates_for_the_next_one(storage, threaded, tmp_path, monkeypatch):
+    async def scenario():
+        database = write_behind(threaded, tmp_path)
+        await database.start()
+        await database.update_user_text("user", [message(0)])
+        with monkeypatch.context() as patch:
+            patch.setattr(storage, "update_users_texts", fail)
+            with pytest.raises(ConnectionError):
+                await database.flush()
+        await database.update_user_text("user", [message(1)])
+
+        assert database.metrics.failed_flushes == 1
+        assert [text.id for text in (await database.get_user("user")).context] == ["0", "1"]
+        await database.aclose()
+
+    def fail(*args, **kwargs):
+        raise ConnectionError("connection lost")
+
+    asyncio.run(scenario())
+    assert stored_ids(storage) == ["0", "1"]
+    assert not os.listdir(tmp_path)
+
+
+def test_update_failing_every_retry_is_saved_to_dead_letter(
+    storage, threaded, tmp_path, monkeypatch, caplog
+):
+    storage.create_user("other", "name", "chat")
+    write_users_texts = storage.update_users_texts
+
+    def fail_on_poison(updates):
+        if any(text.id == "poison" for _, texts in updates for text in texts):
+            raise ValueError("document is rejected")
+        write_users_texts(updates)
+
+    async def scenario():
+        database = write_behind(threaded, tmp_path, max_retries=2)
+        await database.start()
+        await database.update_user_text("user", [message(0)])
+        await database.update_user_text("other", [BaseMessage("poison", "user", "", 1)])
+        await database.update_user_text("other", [message(2)])
+        await database.update_user_text("user", [message(3)])
+        with monkeypatch.context() as patch:
+            patch.setattr(storage, "update_users_texts", fail_on_poison)
+            with pytest.raises(ValueError):
+                await database.flush()
+            assert stored_ids(storage) == []
+            await database.flush()
+        await database.aclose()
+        return database.metrics
+
+    metrics = asyncio.run(scenario())
+
+    assert stored_ids(storage) == ["0", "3"]
+    # later update of the same user is kept after the failed one
+    assert [text.id for text in storage.get_user("other").context] == []
+    assert (metrics.failed_flushes, metrics.consecutive_failed_flushes) == (2, 0)
+    assert (metrics.flushed_updates, metrics.dead_letter_updates) == (2, 2)
+    assert "users other" in caplog.text
+    assert os.listdir(tmp_path) == [DEAD_LETTER_DIRECTORY]
+    (name,) = os.listdir(tmp_path / DEAD_LETTER_DIRECTORY)
+
+    async def replay():
+        database = write_behind(threaded, tmp_path)
+        await database.start()
+        await database.aclose()
+
+    # dead letter file is replayed when moved back to journal directory
+    os.rename(tmp_path / DEAD_LETTER_DIRECTORY / name, tmp_path / name)
+    asyncio.run(replay())
+    assert [text.id for text in storage.get_user("other").context] == ["poison", "2"]
+
+
+def test_appends_written_before_fsync_share_it(tmp_path, monkeypatch):
+    fsyncs = []
+    monkeypatch.setattr("database.journal.os.fsync", fsyncs.append)
+    journal = WriteJournal(str(tmp_path))
+    fsyncs.clear()
+
+    written = [journal.write("user", [message(idx)]) for idx in range(3)]
+    journal.sync(written[-1])
+    journal.sync(written[0])
+    assert len(fsyncs) == 1
+
+    journal.sync(journal.write("user", [message(3)]))
+    assert len(fsyncs) == 2
+    # rotate syncs new directory entry and the previous segment, its updates are not synced again
+    last = journal.write("user", [message(4)])
+    journal.rotate()
+    journal.sync(last)
+    assert len(fsyncs) == 4
+    journal.close()
@@ -0,0 +1,86 @@
+"""Prometheus metrics of the service.
+
+Every gunicorn worker has its own metrics, they are merged by /metrics when
+PROMETHEUS_MULTIPROC_DIR is set.
+"""
+from __future__ import annotations
+
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# LLM generation takes seconds, database and tokenization calls take milliseconds
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+)
+
+# share of batch slots filled by prompts
+FILL_RATE_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+GENERATE_STAGE_SECONDS = Histogram(
+    "generate_stage_seconds",
+    "Time of every stage of generate request",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+DATABASE_CALL_SECONDS = Histogram(
+    "database_call_seconds",
+    "Time of database method call",
+    ["method"],
+    buckets=LATENCY_BUCKETS,
+)
+PROMPT_TOKENS = Counter("prompt_tokens", "Tokens of prompts passed to LLM")
+GENERATED_TOKENS = Counter("generated_tokens", "Tokens of all answers generated by LLM")
+LLM_BACKEND_REQUESTS = Counter(
+    "llm_backend_requests",
+    "Requests sent to every LLM api node by outcome: success, failure of node or error of request",
+    ["backend", "outcome"],
+)
+LLM_CALLS_SAVED = Counter(
+    "llm_calls_saved",
+    "Generate calls answered from response cache or shared with identical in-flight prompt",
+    ["reason"],
+)
+
+LLM_BATCH_FILL_RATE = Histogram(
+    "llm_batch_fill_rate",
+    "Share of slots of every batch sent to LLM api filled by prompts",
+    buckets=FILL_RATE_BUCKETS,
+)
+LLM_BATCH_QUEUE_DELAY_SECONDS = Histogram(
+    "llm_batch_queue_delay_seconds",
+    "Time prompt waited for its batch to be sent to LLM api",
+    buckets=LATENCY_BUCKETS,
+)
+
+
+def export_metrics() -> tuple[bytes, str]:
+    r"""Return metrics of all processes in Prometheus text format and its content type."""
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST